@@ -18,335 +18,3843 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import bisect
+import errno
+import hashlib
+import heapq
 import json
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
+import stat
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+from fnmatch import fnmatch
+from functools import partial
+from itertools import count, groupby, islice, izip
+from Queue import Queue
 from calendar import timegm
+from collections import deque
+from contextlib import contextmanager
+from cStringIO import StringIO
 from datetime import datetime
 from boto.glacier.layer2 import Layer2
+from boto.connection import AWSAuthConnection
+from boto.glacier.exceptions import UnexpectedHTTPResponseError
+from boto.glacier.utils import DEFAULT_PART_SIZE, bytes_to_hex, chunk_hashes, compute_hashes_from_fileobj, minimum_part_size, tree_hash
 from boto.utils import parse_ts
 
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError: # LocalFilesystem falls back to listdir + lstat
+		scandir = None
+
+try:
+	import zstandard
+except ImportError: # only zlib compression then
+	zstandard = None
+
+try:
+	from cryptography.exceptions import InvalidTag
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError: # no encryption then
+	AESGCM = None
+
+MEGABYTE = 1024 * 1024
+NANOSECONDS = 10 ** 9
+PART_SUFFIX = '.glacsync-part'
+MULTIPART_MIN_PART_SIZE = 8 * MEGABYTE
+MULTIPART_MAX_PARTS = 10000
+SINGLE_UPLOAD_MAX_SIZE = 4 * 1024 * MEGABYTE
+CODEC_CHUNK_SIZE = MEGABYTE
+DEDUP_CHUNK_SIZE = MEGABYTE
+# already compressed formats, compressing them again only burns CPU
+COMPRESSED_EXTENSIONS = frozenset(('.gz', '.tgz', '.bz2', '.xz', '.lz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.jar',
+	'.docx', '.xlsx', '.pptx', '.odt', '.ods', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+	'.mp3', '.aac', '.ogg', '.opus', '.flac', '.mp4', '.m4a', '.m4v', '.mkv', '.mov', '.avi', '.webm'))
+# transfer rates plan() assumes when no throttle limits are set
+PLAN_BYTES_PER_SECOND = MEGABYTE
+PLAN_REQUESTS_PER_SECOND = 10
+
+def tree_hash_file(path, chunk_size=MEGABYTE):
+	''' Glacier SHA-256 tree hash of file, 1 MiB chunks are hashed straight from mmap'ed pages '''
+	with open(path, 'rb') as hashed_file:
+		size = os.fstat(hashed_file.fileno()).st_size
+
+		if not size: # mmap refuses empty files
+			return bytes_to_hex(hashlib.sha256().digest())
+
+		mapped = mmap.mmap(hashed_file.fileno(), size, access=mmap.ACCESS_READ)
+
+		try:
+			chunks = [hashlib.sha256(buffer(mapped, offset, chunk_size)).digest() for offset in xrange(0, size, chunk_size)]
+		finally:
+			mapped.close()
+
+	METRICS.count('bytes_hashed', size)
+
+	return bytes_to_hex(tree_hash(chunks))
+
+def multipart_part_size(size, minimum=MULTIPART_MIN_PART_SIZE):
+	''' Smallest part size Glacier accepts (power of two MiB, 10000 parts at most) not below minimum '''
+	part_size = minimum
+
+	while part_size * MULTIPART_MAX_PARTS < size:
+		part_size *= 2
+
+	return part_size
+
+def batches(iterable, size):
+	iterator = iter(iterable)
+
+	while True:
+		batch = list(islice(iterator, size))
+
+		if not batch:
+			return
+
+		yield batch
+
+def external_sort(items, key, run_size=100000):
+	'''
+	Reads all JSON-serializable items, returns iterator of them ordered by key(item). Items are
+	sorted run_size at a time and runs which don't fit are spilled to temporary files, which the
+	iterator merges, so memory use is bounded by run_size.
+	'''
+	runs = []
+	sequence = count() # keeps equal keys in input order, and items are never compared
+
+	for batch in batches(items, run_size):
+		run = sorted((key(item), next(sequence), item) for item in batch)
+
+		if len(batch) < run_size and not runs: # all fits in memory
+			return (item for item_key, item_sequence, item in run)
+
+		run_file = tempfile.TemporaryFile(prefix='glacsync-sort-')
+		for decorated in run:
+			run_file.write(json.dumps(decorated) + '\n')
+		run_file.seek(0)
+
+		runs.append(run_file)
+
+	def merged():
+		try:
+			for item_key, item_sequence, item in heapq.merge(*[(json.loads(line) for line in run_file) for run_file in runs]):
+				yield item
+		finally:
+			for run_file in runs:
+				run_file.close()
+
+	return merged()
+
+def merge_join(left, right, left_key, right_key):
+	''' Joins two streams ordered by their keys, yields (key, left items, right items) of every key in either of them '''
+	left = groupby(left, left_key)
+	right = groupby(right, right_key)
+	left_group = next(left, None)
+	right_group = next(right, None)
+
+	while left_group is not None or right_group is not None:
+		if right_group is None or (left_group is not None and left_group[0] < right_group[0]):
+			yield left_group[0], list(left_group[1]), []
+			left_group = next(left, None)
+		elif left_group is None or right_group[0] < left_group[0]:
+			yield right_group[0], [], list(right_group[1])
+			right_group = next(right, None)
+		else:
+			yield left_group[0], list(left_group[1]), list(right_group[1])
+			left_group, right_group = next(left, None), next(right, None)
+
+# random 64 bit number for every byte value, gear rolling hash adds them up
+GEAR = [struct.unpack('>Q', hashlib.sha256('glacsync gear %d' % byte).digest()[:8])[0] for byte in xrange(256)]
+
+def chunk_file(path, average_size=DEDUP_CHUNK_SIZE):
+	'''
+	Cuts file into content defined chunks, returns [sha256, offset, length] of each. Chunk ends
+	where gear rolling hash of the bytes before has its top bits zero, so data inserted or
+	removed only moves boundaries around it and the rest of the file cuts into the same chunks.
+	Chunks are average_size / 4 to average_size * 4 bytes long, about average_size on average.
+	'''
+	minimum, maximum = average_size // 4, average_size * 4
+	bits = (average_size - minimum).bit_length() - 1
+	mask = ((1 << bits) - 1) << (64 - bits)
+	gear = GEAR
+	chunks = []
+
+	with open(path, 'rb') as chunked_file:
+		size = os.fstat(chunked_file.fileno()).st_size
+
+		if not size: # mmap refuses empty files
+			return chunks
+
+		mapped = mmap.mmap(chunked_file.fileno(), size, access=mmap.ACCESS_READ)
+
+		try:
+			offset = 0
+
+			while offset < size:
+				# nothing before minimum can be a boundary, so it isn't even hashed
+				start, end = offset + minimum, min(offset + maximum, size)
+				boundary = end
+				rolling = 0
+
+				for index, byte in enumerate(bytearray(mapped[start:end])):
+					rolling = ((rolling << 1) + gear[byte]) & 0xffffffffffffffff
+
+					if not rolling & mask:
+						boundary = start + index + 1
+						break
+
+				chunks.append([hashlib.sha256(buffer(mapped, offset, boundary - offset)).hexdigest(), offset, boundary - offset])
+				offset = boundary
+		finally:
+			mapped.close()
+
+	METRICS.count('bytes_hashed', size)
+
+	return chunks
+
+class InventoryFormatError(Exception):
+	pass
+
+def iter_inventory_archives(inventory_file, chunk_size=64 * 1024, header=None):
+	'''
+	Yields archives from ArchiveList of Glacier inventory one by one, reading inventory_file in
+	chunk_size pieces, so memory use doesn't grow with vault size. Fields before ArchiveList
+	(VaultARN, InventoryDate) are put into header dict, when given, before first archive comes.
+	'''
+	decoder = json.JSONDecoder()
+	buffer = ''
+	end_of_file = False
+
+	def read_more(buffer):
+		data = inventory_file.read(chunk_size)
+		return buffer + data, not data
+
+	# everything before ArchiveList is a few short fields, we can skip it
+	while True:
+		list_start = buffer.find('"ArchiveList"')
+		if list_start != -1:
+			list_start = buffer.find('[', list_start)
+			if list_start != -1:
+				break
+
+		if end_of_file:
+			raise InventoryFormatError('No ArchiveList in inventory')
+
+		buffer, end_of_file = read_more(buffer)
+
+	if header is not None:
+		header.update(re.findall(r'"(\w+)"\s*:\s*"([^"]*)"', buffer[:list_start]))
+
+	position = list_start + 1
+
+	while True:
+		while position < len(buffer) and buffer[position] in ' \t\r\n,':
+			position += 1
+
+		if position < len(buffer) and buffer[position] == ']':
+			return
+
+		try:
+			if position == len(buffer):
+				raise ValueError('need more data')
+
+			archive, position = decoder.raw_decode(buffer, position)
+		except ValueError: # archive split between chunks
+			if end_of_file:
+				raise InventoryFormatError('Inventory ends in the middle of ArchiveList')
+
+			buffer, end_of_file = read_more(buffer[position:])
+			position = 0
+			continue
+
+		yield archive
+
+def open_job_output(vault, job_id, byte_range=None):
+	'''
+	Returns job output as raw HTTP response to read() from. boto's Job.get_output parses
+	JSON output (inventory) into memory at once, which we can't afford for large vaults.
+	'''
+	layer1 = vault.layer1
+
+	headers = {'x-amz-glacier-version': layer1.Version}
+	if byte_range is not None:
+		headers['Range'] = 'bytes=%d-%d' % byte_range
+
+	response = AWSAuthConnection.make_request(layer1, 'GET', '/%s/vaults/%s/jobs/%s/output' % (layer1.account_id, vault.name, job_id), headers=headers)
+
+	if response.status not in (200, 206):
+		raise UnexpectedHTTPResponseError((200, 206), response)
+
+	return response
+
+class ThrottledReader(object):
+	''' File-like wrapper paying throttle for bytes as they are read '''
+	def __init__(self, stream, throttle):
+		super(ThrottledReader, self).__init__()
+		self.stream = stream
+		self.throttle = throttle
+
+	def read(self, size=-1):
+		data = self.stream.read() if size is None or size < 0 else self.stream.read(size)
+		self.throttle.transfer(len(data))
+
+		return data
+
+def megabyte_aligned_range(offset, length, archive_size):
+	''' Smallest (first, last) byte range Glacier accepts for retrieval that covers given part of archive '''
+	first = offset // MEGABYTE * MEGABYTE
+	last = min(-(-(offset + length) // MEGABYTE) * MEGABYTE, archive_size) - 1
+
+	return first, last
+
+def read_exactly(stream, size):
+	data = []
+
+	while size:
+		piece = stream.read(size)
+		if not piece:
+			break
+
+		data.append(piece)
+		size -= len(piece)
+
+	return ''.join(data)
+
+class TreeHashMismatchError(Exception):
+	pass
+
+class CodecError(Exception):
+	pass
+
+def read_encryption_key(filename):
+	''' AES-256 key from file holding either 32 raw bytes or 64 hex digits '''
+	with open(filename, 'rb') as key_file:
+		key = key_file.read()
+
+	if len(key.strip()) == 64:
+		return binascii.unhexlify(key.strip())
+
+	if len(key) != 32:
+		raise CodecError('%s must hold 32 bytes or 64 hex digits of key' % filename)
+
+	return key
+
+def encode_chunk(arguments):
+	''' ChunkCodec.frame for CpuPool processes, which get only picklable arguments '''
+	compression, key, index, chunk = arguments
+
+	return ChunkCodec(compression, key).frame(index, chunk)
+
+class CpuPool(object):
+	'''
+	Process pool for CPU bound work (tree hashes, compression, encryption) which would otherwise
+	queue up behind one core. imap() keeps at most window items in flight per caller and
+	waits for the oldest before reading more, so memory stays capped while uploads drain it.
+	'''
+	def __init__(self, processes=None, window=None):
+		super(CpuPool, self).__init__()
+		self.processes = processes or multiprocessing.cpu_count()
+		self.window = window or 2 * self.processes
+
+		self._pool = multiprocessing.Pool(self.processes)
+
+	def imap(self, function, iterable):
+		''' Like itertools.imap (results in order), with bounded read-ahead '''
+		in_flight = deque()
+
+		for item in iterable:
+			in_flight.append(self._pool.apply_async(function, (item, )))
+
+			if len(in_flight) >= self.window:
+				yield in_flight.popleft().get()
+
+		while in_flight:
+			yield in_flight.popleft().get()
+
+	def call(self, function, *args):
+		return self._pool.apply_async(function, args).get()
+
+	def close(self):
+		self._pool.close()
+		self._pool.join()
+
+class ChunkCodec(object):
+	'''
+	Streaming transform of archive data, CODEC_CHUNK_SIZE chunks at a time. Every chunk is compressed
+	(kept as it is when that doesn't make it smaller), then encrypted with AES-256-GCM under random
+	nonce and chunk number as associated data, so chunks can't be swapped. Written as frames of
+	4 byte big-endian length and payload. name (e.g. "zstd+aes-gcm") is what catalogue keeps.
+	'''
+	COMPRESSIONS = ('zlib', 'zstd')
+	ENCRYPTION = 'aes-gcm'
+	NONCE_SIZE = 12
+	STORED = '\x00'
+	COMPRESSED = '\x01'
+
+	def __init__(self, compression=None, key=None):
+		super(ChunkCodec, self).__init__()
+
+		if compression is not None and compression not in self.COMPRESSIONS:
+			raise CodecError('Unknown compression %s' % compression)
+
+		if compression == 'zstd' and zstandard is None:
+			raise CodecError('zstd compression needs zstandard module')
+
+		if key is not None and AESGCM is None:
+			raise CodecError('Encryption needs cryptography module')
+
+		self.compression = compression
+		self.key = key
+
+	@property
+	def name(self):
+		return '+'.join(part for part in (self.compression, self.ENCRYPTION if self.key is not None else None) if part is not None)
+
+	@classmethod
+	def from_name(cls, name, key=None):
+		compression = None
+		encrypted = False
+
+		for part in name.split('+'):
+			if part == cls.ENCRYPTION:
+				encrypted = True
+			elif part in cls.COMPRESSIONS and compression is None:
+				compression = part
+			else:
+				raise CodecError('Unknown codec %s' % name)
+
+		if encrypted and key is None:
+			raise CodecError('Archive is encrypted (%s), encryption key is needed' % name)
+
+		return cls(compression, key if encrypted else None)
+
+	def _compressor(self):
+		if self.compression == 'zlib':
+			return zlib.compress
+
+		if self.compression == 'zstd': # compressor objects are not thread safe, one per stream
+			return zstandard.ZstdCompressor().compress
+
+	def _decompressor(self):
+		if self.compression == 'zlib':
+			return zlib.decompress
+
+		if self.compression == 'zstd':
+			return zstandard.ZstdDecompressor().decompress
+
+	@staticmethod
+	def _chunks(source, chunk_size):
+		index = 0
+
+		while True:
+			chunk = read_exactly(source, chunk_size)
+
+			if chunk or not index: # empty file still gets one frame
+				yield index, chunk
+
+			if len(chunk) < chunk_size:
+				return
+
+			index += 1
+
+	def frame(self, index, chunk, compress=None, cipher=None):
+		''' Encoded chunk with its length in front; compress and cipher are made when not given '''
+		compress = compress or self._compressor()
+		if cipher is None and self.key is not None:
+			cipher = AESGCM(self.key)
+
+		payload = self.STORED + chunk
+		if compress is not None:
+			compressed = compress(chunk)
+
+			if len(compressed) < len(chunk):
+				payload = self.COMPRESSED + compressed
+
+		if cipher is not None:
+			nonce = os.urandom(self.NONCE_SIZE)
+			payload = nonce + cipher.encrypt(nonce, payload, struct.pack('>Q', index))
+
+		return struct.pack('>I', len(payload)) + payload
+
+	def max_encoded_size(self, size, chunk_size=CODEC_CHUNK_SIZE):
+		''' Most bytes size bytes can take once encoded, every frame adds header and flag (and nonce and tag) '''
+		overhead = 4 + 1 + (self.NONCE_SIZE + 16 if self.key is not None else 0)
+
+		return size + max(1, -(-size // chunk_size)) * overhead
+
+	def frames(self, source, chunk_size=CODEC_CHUNK_SIZE, cpu_pool=None):
+		''' Encoded frames of source, in order. With cpu_pool chunks are encoded by its processes '''
+		chunks = self._chunks(source, chunk_size)
+
+		if cpu_pool is not None:
+			return cpu_pool.imap(encode_chunk, ((self.compression, self.key, index, chunk) for index, chunk in chunks))
+
+		compress = self._compressor()
+		cipher = AESGCM(self.key) if self.key is not None else None
+
+		return (self.frame(index, chunk, compress, cipher) for index, chunk in chunks)
+
+	def encode(self, source, target, chunk_size=CODEC_CHUNK_SIZE, cpu_pool=None):
+		''' Returns number of bytes written to target '''
+		written = 0
+
+		for frame in self.frames(source, chunk_size, cpu_pool):
+			target.write(frame)
+			written += len(frame)
+
+		return written
+
+	def decode(self, source, target):
+		''' Returns number of bytes written to target, caller checks it against original size '''
+		decompress = self._decompressor()
+		cipher = AESGCM(self.key) if self.key is not None else None
+		written = 0
+		index = 0
+
+		while True:
+			header = read_exactly(source, 4)
+
+			if not header:
+				return written
+
+			if len(header) < 4:
+				raise CodecError('Frame %d is truncated' % index)
+
+			length = struct.unpack('>I', header)[0]
+			payload = read_exactly(source, length)
+
+			if len(payload) < length:
+				raise CodecError('Frame %d is truncated' % index)
+
+			if cipher is not None:
+				try:
+					payload = cipher.decrypt(payload[:self.NONCE_SIZE], payload[self.NONCE_SIZE:], struct.pack('>Q', index))
+				except InvalidTag:
+					raise CodecError('Frame %d fails authentication (wrong key or corrupted data)' % index)
+
+			flag, data = payload[:1], payload[1:]
+
+			if flag == self.COMPRESSED and decompress is not None:
+				data = decompress(data)
+			elif flag != self.STORED:
+				raise CodecError('Frame %d has unknown type' % index)
+
+			target.write(data)
+
+			written += len(data)
+			index += 1
+
+class EncodedReader(object):
+	'''
+	Local file as ChunkCodec encodes it, read a frame at a time, so encoded archive can go
+	to vault part by part without being written anywhere first. position counts bytes read.
+	'''
+	def __init__(self, path, codec, cpu_pool=None):
+		super(EncodedReader, self).__init__()
+		self.position = 0
+
+		self._source = open(path, 'rb')
+		self._frames = codec.frames(self._source, cpu_pool=cpu_pool)
+		self._rest = ''
+
+	@property
+	def closed(self):
+		return self._source.closed
+
+	@property
+	def source_size(self):
+		return self._source.tell()
+
+	def read(self, size):
+		data = [self._rest]
+		length = len(self._rest)
+
+		while length < size:
+			frame = next(self._frames, None)
+
+			if frame is None:
+				break
+
+			data.append(frame)
+			length += len(frame)
+
+		data = ''.join(data)
+		self._rest = data[size:]
+		self.position += min(size, len(data))
+
+		return data[:size]
+
+	def at_end(self):
+		if not self._rest:
+			self._rest = next(self._frames, '')
+
+		return not self._rest
+
+	def close(self):
+		self._source.close()
+
+class TokenBucket(object):
+	'''
+	Lets rate units per second through on average, in bursts of up to one second worth; rate 0 means
+	no limit. Callers take tokens right away and wait off the debt, so big amounts don't starve.
+	'''
+	def __init__(self, rate=0, clock=time.time, sleep=time.sleep):
+		super(TokenBucket, self).__init__()
+		self.rate = rate
+		self.clock = clock
+		self.sleep = sleep
+
+		self._tokens = rate
+		self._updated = clock()
+		self._lock = threading.Lock()
+
+	def _refill(self):
+		now = self.clock()
+		self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+		self._updated = now
+
+	def set_rate(self, rate):
+		with self._lock:
+			if rate != self.rate:
+				self._refill()
+				self.rate = rate
+				self._tokens = min(self._tokens, rate)
+
+	def consume(self, amount):
+		''' Returns seconds spent waiting '''
+		with self._lock:
+			if not self.rate:
+				return 0
+
+			self._refill()
+			self._tokens -= amount
+
+			wait = -self._tokens / float(self.rate) if self._tokens < 0 else 0
+
+		if wait:
+			self.sleep(wait)
+
+		return wait
+
+class Throttle(object):
+	'''
+	Limits bytes and requests per second sent to/received from vault (0 means no limit). Schedule
+	overrides limits in time-of-day windows, as list of dicts like
+	{"from": "08:00", "to": "18:00", "bytes_per_second": 524288, "requests_per_second": 5};
+	windows may wrap midnight, first matching one wins. Counts traffic it has let through.
+	'''
+	THROUGHPUT_WINDOW = 10 # seconds
+
+	def __init__(self, bytes_per_second=0, requests_per_second=0, schedule=(), clock=time.time, sleep=time.sleep):
+		super(Throttle, self).__init__()
+		self.bytes_per_second = bytes_per_second
+		self.requests_per_second = requests_per_second
+		self.schedule = [(self._minutes(window['from']), self._minutes(window['to']), window.get('bytes_per_second', 0), window.get('requests_per_second', 0)) for window in schedule]
+		self.clock = clock
+
+		self.bytes_transferred = 0
+		self.requests = 0
+
+		self._bytes = TokenBucket(bytes_per_second, clock, sleep)
+		self._requests = TokenBucket(requests_per_second, clock, sleep)
+		self._recent = deque()
+		self._recent_bytes = 0
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _minutes(time_of_day):
+		hours, minutes = map(int, time_of_day.split(':'))
+
+		return hours * 60 + minutes
+
+	def limits(self):
+		''' (bytes_per_second, requests_per_second) in effect now '''
+		now = time.localtime(self.clock())
+		minute = now.tm_hour * 60 + now.tm_min
+
+		for start, end, bytes_per_second, requests_per_second in self.schedule:
+			if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+				return bytes_per_second, requests_per_second
+
+		return self.bytes_per_second, self.requests_per_second
+
+	def _update_limits(self):
+		if self.schedule:
+			bytes_per_second, requests_per_second = self.limits()
+
+			self._bytes.set_rate(bytes_per_second)
+			self._requests.set_rate(requests_per_second)
+
+	def request(self):
+		self._update_limits()
+		self._requests.consume(1)
+
+		with self._lock:
+			self.requests += 1
+
+	def transfer(self, size):
+		self._update_limits()
+		self._bytes.consume(size)
+
+		now = self.clock()
+
+		with self._lock:
+			self.bytes_transferred += size
+
+			self._recent.append((now, size))
+			self._recent_bytes += size
+			self._forget_before(now - self.THROUGHPUT_WINDOW)
+
+	def _forget_before(self, moment):
+		while self._recent and self._recent[0][0] < moment:
+			self._recent_bytes -= self._recent.popleft()[1]
+
+	@property
+	def throughput(self):
+		''' Bytes per second over last THROUGHPUT_WINDOW seconds '''
+		with self._lock:
+			self._forget_before(self.clock() - self.THROUGHPUT_WINDOW)
+
+			return self._recent_bytes / float(self.THROUGHPUT_WINDOW)
+
+class Metrics(object):
+	'''
+	Counters, phase timings and vault call latency histograms of one run, safe to update from
+	worker threads. report() gives them as dict (written as JSON), prometheus() in Prometheus
+	text format, e.g. for node_exporter's textfile collector.
+	'''
+	LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+	PREFIX = 'glacsync_'
+
+	def __init__(self, clock=time.time):
+		super(Metrics, self).__init__()
+		self.clock = clock
+
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.started = self.clock()
+			self.counters = {}
+			self.phases = {} # name -> [times entered, seconds]
+			self.latencies = {} # call -> [count per bucket (last one is +Inf), seconds]
+
+	def count(self, name, amount=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + amount
+
+	@contextmanager
+	def timed(self, phase):
+		start = self.clock()
+
+		try:
+			yield
+		finally:
+			elapsed = self.clock() - start
+
+			with self._lock:
+				timing = self.phases.setdefault(phase, [0, 0.0])
+				timing[0] += 1
+				timing[1] += elapsed
+
+	def observe_latency(self, call, seconds):
+		bucket = bisect.bisect_left(self.LATENCY_BUCKETS, seconds)
+
+		with self._lock:
+			histogram = self.latencies.setdefault(call, [[0] * (len(self.LATENCY_BUCKETS) + 1), 0.0])
+			histogram[0][bucket] += 1
+			histogram[1] += seconds
+
+	def report(self):
+		with self._lock:
+			return {
+				'started_at': self.started,
+				'seconds': self.clock() - self.started,
+				'counters': dict(self.counters),
+				'phases': dict((phase, {'count': count, 'seconds': seconds}) for phase, (count, seconds) in self.phases.iteritems()),
+				'api_latency': dict((call, {'buckets': zip(self.LATENCY_BUCKETS + ('+Inf', ), buckets), 'count': sum(buckets), 'seconds': seconds})
+					for call, (buckets, seconds) in self.latencies.iteritems()),
+			}
+
+	def prometheus(self):
+		report = self.report()
+		prefix = self.PREFIX
+		lines = []
+
+		lines.append('# TYPE %srun_seconds gauge' % prefix)
+		lines.append('%srun_seconds %f' % (prefix, report['seconds']))
+
+		for name, value in sorted(report['counters'].iteritems()):
+			lines.append('# TYPE %s%s_total counter' % (prefix, name))
+			lines.append('%s%s_total %d' % (prefix, name, value))
+
+		lines.append('# TYPE %sphase_seconds_total counter' % prefix)
+		for phase, timing in sorted(report['phases'].iteritems()):
+			lines.append('%sphase_seconds_total{phase="%s"} %f' % (prefix, phase, timing['seconds']))
+
+		lines.append('# TYPE %sapi_latency_seconds histogram' % prefix)
+		for call, histogram in sorted(report['api_latency'].iteritems()):
+			cumulative = 0
+
+			for bound, count in histogram['buckets']:
+				cumulative += count
+				lines.append('%sapi_latency_seconds_bucket{call="%s",le="%s"} %d' % (prefix, call, bound, cumulative))
+
+			lines.append('%sapi_latency_seconds_sum{call="%s"} %f' % (prefix, call, histogram['seconds']))
+			lines.append('%sapi_latency_seconds_count{call="%s"} %d' % (prefix, call, histogram['count']))
+
+		return '\n'.join(lines) + '\n'
+
+	@staticmethod
+	def _write_atomically(filename, data):
+		''' Readers (scrapers) never see half written file '''
+		temp_filename = filename + '.tmp'
+
+		with open(temp_filename, 'w') as output:
+			output.write(data)
+
+		os.rename(temp_filename, filename)
+
+	def write_json(self, filename):
+		self._write_atomically(filename, json.dumps(self.report(), indent=1, sort_keys=True))
+
+	def write_prometheus(self, filename):
+		self._write_atomically(filename, self.prometheus())
+
+# process wide, so hot paths (hashing, catalogue writes) don't need it passed around
+METRICS = Metrics()
+
 class File(object):
+	__slots__ = ()
+
 	def __init__(self):
 		super(File, self).__init__()
 
-	@property
-	def last_modified(self):
-		raise NotImpleNotImplementedError()
+	@property
+	def last_modified(self):
+		raise NotImpleNotImplementedError()
+
+	@property
+	def last_modified_epoch(self):
+		''' Wall clock time of last modification as seconds since epoch, the way catalogue stores it '''
+		return timegm(self.last_modified.timetuple()) + self.last_modified.microsecond / 1e6
+
+	def __gt__(self, other):
+		return self.last_modified_epoch > other.last_modified_epoch
+
+	def __hash__(self):
+		return hash(self.path)
+
+	def __eq__(self, other):
+		return self.path == other.path
+
+	def __repr__(self):
+		return 'local://%s' % self.path if isinstance(self, LocalFile) else 'cloud://%s' % self.uuid
+
+	__str__ = __repr__
+
+class Filesystem(object):
+	def __init__(self):
+		super(Filesystem, self).__init__()
+
+	@property
+	def files(self):
+		raise NotImpleNotImplementedError()
+
+class SimpleDiffer(object):
+	def __init__(self, local_files, remote_files):
+		super(SimpleDiffer, self).__init__()
+		self.local_files = local_files
+		self.remote_files = remote_files
+
+	def stream(self):
+		''' Yields (bucket, item) pairs, joining both sides on file path in linear time '''
+		remote_by_path = dict((remote_file, remote_file) for remote_file in self.remote_files)
+
+		for curr_file in self.local_files:
+			remote_file = remote_by_path.pop(curr_file, None)
+
+			if remote_file is None:
+				yield 'new_files', curr_file
+			else:
+				yield 'maybe_modified_files', (curr_file, remote_file)
+
+		# whatever was not matched by any local file is gone locally
+		for remote_file in remote_by_path:
+			yield 'deleted_files', remote_file
+
+	@property
+	def differences(self):
+		differences = {'new_files': set([]), 'deleted_files': set([]), 'maybe_modified_files': set([])}
+
+		for bucket, item in self.stream():
+			differences[bucket].add(item)
+
+		return differences
+
+class LastModifiedDiffer(object):
+	'''
+	Local file is modified when its size differs from catalogue or it was modified more than
+	tolerance seconds after catalogued version. Compares nanoseconds since epoch, so time zone
+	and DST of the host don't matter. Entries catalogued before mtime_ns was kept fall back to
+	whole seconds of wall clock time, which is all they have.
+	'''
+	def __init__(self, local_file, remote_file, tolerance=0):
+		super(LastModifiedDiffer, self).__init__()
+		self.local_file = local_file
+		self.remote_file = remote_file
+		self.tolerance = tolerance
+
+	@property
+	def local_is_modified(self):
+		remote_size = self.remote_file.size
+
+		if remote_size is not None and remote_size != self.local_file.size:
+			return True
+
+		if self.remote_file.mtime_ns is not None:
+			return self.local_file.mtime_ns - self.remote_file.mtime_ns > self.tolerance * NANOSECONDS
+
+		return int(self.local_file.last_modified_epoch) - self.remote_file.last_modified_epoch > self.tolerance
+
+class ContentHashDiffer(LastModifiedDiffer):
+	'''
+	LastModifiedDiffer which double-checks with tree hash from catalogue, so touched but
+	identical file is not uploaded again. File is hashed only when size or mtime changed.
+	'''
+	@property
+	def needs_tree_hash(self):
+		''' True when only local file's tree hash can decide (DifferRunner may hash those in parallel) '''
+		if self.local_file.cached_tree_hash is not None or self.remote_file.tree_hash is None:
+			return False
+
+		remote_size = self.remote_file.size
+
+		return (remote_size is None or remote_size == self.local_file.size) and super(ContentHashDiffer, self).local_is_modified
+
+	@property
+	def local_is_modified(self):
+		if not super(ContentHashDiffer, self).local_is_modified:
+			return False
+
+		remote_size = self.remote_file.size
+
+		if remote_size is not None and remote_size != self.local_file.size:
+			return True
+
+		if self.remote_file.tree_hash is None: # uploaded before we kept hashes, can't tell
+			return True
+
+		return self.local_file.tree_hash != self.remote_file.tree_hash
+
+class VersionDiffer(LastModifiedDiffer):
+	''' Local file is another version than catalogued one when size or mtime differ, either way '''
+	# os.utime takes float seconds, so mtime of restored file may be a few hundred nanoseconds off
+	SLACK_NS = 10000
+
+	@property
+	def local_is_modified(self):
+		remote_size = self.remote_file.size
+
+		if remote_size is not None and remote_size != self.local_file.size:
+			return True
+
+		if self.remote_file.mtime_ns is not None:
+			return abs(self.local_file.mtime_ns - self.remote_file.mtime_ns) > self.tolerance * NANOSECONDS + self.SLACK_NS
+
+		return abs(int(self.local_file.last_modified_epoch) - self.remote_file.last_modified_epoch) > self.tolerance
+
+class DifferRunner(object):
+	def __init__(self, local_filesystem, remote_filesystem, differs, scan_cache=None, cpu_pool=None):
+		super(DifferRunner, self).__init__()
+		with METRICS.timed('scan'):
+			self.local_files = set(local_filesystem.files)
+
+		with METRICS.timed('catalogue_read'):
+			self.remote_files = set(remote_filesystem.files)
+
+		METRICS.count('files_scanned', len(self.local_files))
+		METRICS.count('catalogue_files', len(self.remote_files))
+
+		self.differs = differs
+		self.scan_cache = scan_cache
+		self.cpu_pool = cpu_pool
+
+	@property
+	def differences(self):
+		with METRICS.timed('diff'):
+			return self._differences()
+
+	def _differences(self):
+		simplediffer = SimpleDiffer(self.local_files, self.remote_files)
+
+		differences = {'new_files': set([]), 'deleted_files': set([]), 'modified_files': set([])}
+		to_hash = []
+
+		def decide(item):
+			for current_differ in self.differs:
+				differ = current_differ(*item)
+
+				if differ.local_is_modified:
+					differences['modified_files'].add(item)
+					break
+
+		for bucket, item in simplediffer.stream():
+			# we will only run differs on maybe_modified_files
+			if bucket != 'maybe_modified_files':
+				differences[bucket].add(item)
+				continue
+
+			# local file looks exactly like after last successful sync, nothing to decide
+			if self.scan_cache is not None and self.scan_cache.unchanged(item[0]):
+				continue
+
+			if self.cpu_pool is not None and any(getattr(current_differ(*item), 'needs_tree_hash', False) for current_differ in self.differs):
+				to_hash.append(item)
+				continue
+
+			decide(item)
+
+		# hashed on all cores at once, then decided like the rest
+		tree_hashes = self.cpu_pool.imap(tree_hash_file, (local_file.path for local_file, remote_file in to_hash)) if to_hash else ()
+
+		for item, local_tree_hash in izip(to_hash, tree_hashes):
+			item[0].cached_tree_hash = local_tree_hash
+			METRICS.count('bytes_hashed', item[0].size)
+
+			decide(item)
+
+		return differences
+
+class LocalFile(File):
+	__slots__ = ('path', 'size', 'mtime', 'inode', 'cached_tree_hash', '_last_modified_epoch')
+
+	def __init__(self, path, size=None, mtime=None, inode=None):
+		super(LocalFile, self).__init__()
+
+		self.path = path
+
+		if mtime is None:
+			file_stat = os.stat(path)
+			size, mtime, inode = file_stat.st_size, file_stat.st_mtime, file_stat.st_ino
+
+		self.size = size
+		self.mtime = mtime
+		self.inode = inode
+
+		self.cached_tree_hash = None
+		self._last_modified_epoch = None
+
+	@property
+	def last_modified(self):
+		return datetime.fromtimestamp(self.mtime)
+
+	@property
+	def mtime_ns(self):
+		# float mtime is only about microsecond precise, rounding to that keeps value stable between runs
+		return int(round(self.mtime * 10 ** 6)) * 1000
+
+	@property
+	def last_modified_epoch(self):
+		if self._last_modified_epoch is None:
+			self._last_modified_epoch = timegm(time.localtime(self.mtime)) + self.mtime % 1
+
+		return self._last_modified_epoch
+
+	@property
+	def tree_hash(self):
+		if self.cached_tree_hash is None:
+			self.cached_tree_hash = tree_hash_file(self.path)
+
+		return self.cached_tree_hash
+
+class LocalFilesystem(Filesystem):
+	'''
+	Walks dirs recursively, stat'ing every entry once.
+
+	include/exclude are glob patterns matched against path relative to synced dir and
+	against file name; excluded directories are not entered at all. With scan_threads > 1
+	directories are listed in parallel, which pays off on network filesystems.
+	'''
+	def __init__(self, *dirs, **options):
+		super(LocalFilesystem, self).__init__()
+		self.dirs = dirs
+
+		self.include = options.get('include') or []
+		self.exclude = options.get('exclude') or []
+		self.scan_threads = options.get('scan_threads', 1)
+		self.scan_cache = options.get('scan_cache')
+		self.trust_directory_mtime = options.get('trust_directory_mtime', False)
+
+	@staticmethod
+	def _matches(patterns, relative_path):
+		name = os.path.basename(relative_path)
+
+		return any(fnmatch(relative_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+	def _included(self, root, path, is_dir):
+		if not is_dir and path.endswith(PART_SUFFIX): # restore in progress
+			return False
+
+		relative_path = os.path.relpath(path, root)
+
+		if self._matches(self.exclude, relative_path):
+			return False
+
+		return is_dir or not self.include or self._matches(self.include, relative_path)
+
+	def _entries(self, directory):
+		''' Yields (path, is_dir, stat) of directory entries, stat is None for anything but regular files '''
+		if scandir is not None:
+			for entry in scandir(directory):
+				try:
+					if entry.is_dir(follow_symlinks=False):
+						yield entry.path, True, None
+					elif entry.is_file():
+						yield entry.path, False, entry.stat()
+				except OSError as e:
+					if e.errno != errno.ENOENT: # removed since directory was read, like temporary files do
+						raise
+			return
+
+		for name in os.listdir(directory):
+			path = os.path.join(directory, name)
+
+			try:
+				entry_stat = os.lstat(path)
+			except OSError as e:
+				if e.errno != errno.ENOENT: # removed since directory was read, like temporary files do
+					raise
+				continue
+
+			if stat.S_ISLNK(entry_stat.st_mode): # links to files are synced as files
+				try:
+					entry_stat = os.stat(path)
+				except OSError: # dangling link
+					continue
+
+				if stat.S_ISREG(entry_stat.st_mode):
+					yield path, False, entry_stat
+			elif stat.S_ISDIR(entry_stat.st_mode):
+				yield path, True, None
+			elif stat.S_ISREG(entry_stat.st_mode):
+				yield path, False, entry_stat
+
+	def _scan_directory(self, root, directory):
+		if self.scan_cache is None:
+			return self._list_directory(root, directory)
+
+		# stat'ed before listing, so change made while we list is caught on next run
+		directory_mtime = os.stat(directory).st_mtime
+		cached = self.scan_cache.previous_directory(directory, directory_mtime)
+
+		if cached is None:
+			subdirs, files = self._list_directory(root, directory)
+		else:
+			subdirs, files = self._cached_directory(root, directory, *cached)
+
+		self.scan_cache.record_directory(directory, directory_mtime, subdirs, files)
+
+		return subdirs, files
+
+	def _list_directory(self, root, directory):
+		subdirs = []
+		files = []
+
+		for path, is_dir, entry_stat in self._entries(directory):
+			if not self._included(root, path, is_dir):
+				continue
+
+			if is_dir:
+				subdirs.append((root, path))
+			else:
+				files.append(LocalFile(path, entry_stat.st_size, entry_stat.st_mtime, entry_stat.st_ino))
+
+		return subdirs, files
+
+	def _cached_directory(self, root, directory, subdir_names, file_names):
+		''' Directory entries didn't change since last scan, only file contents could '''
+		subdirs = [(root, os.path.join(directory, name)) for name in subdir_names]
+		files = []
+
+		for name in file_names:
+			path = os.path.join(directory, name)
+
+			if self.trust_directory_mtime:
+				files.append(LocalFile(path, *self.scan_cache.previous_file(path)))
+				continue
+
+			try:
+				files.append(LocalFile(path))
+			except OSError: # removed right now, next run will notice directory change
+				pass
+
+		return subdirs, files
+
+	def _walk(self):
+		directories = [(curr_dir, curr_dir) for curr_dir in reversed(self.dirs)]
+
+		while directories:
+			subdirs, files = self._scan_directory(*directories.pop())
+
+			directories.extend(reversed(subdirs))
+
+			for curr_file in files:
+				yield curr_file
+
+	def _walk_threaded(self):
+		directories = Queue()
+		results = Queue()
+
+		def worker():
+			for directory in iter(directories.get, None):
+				try:
+					results.put(self._scan_directory(*directory))
+				except Exception as e:
+					results.put(e)
+
+		workers = [threading.Thread(target=worker) for i in range(self.scan_threads)]
+		for curr_worker in workers:
+			curr_worker.daemon = True
+			curr_worker.start()
+
+		try:
+			for curr_dir in self.dirs:
+				directories.put((curr_dir, curr_dir))
+			pending = len(self.dirs)
+
+			while pending:
+				result = results.get()
+				pending -= 1
+
+				# unreadable directory must stop the sync, otherwise its files would look deleted
+				if isinstance(result, Exception):
+					raise result
+
+				subdirs, files = result
+
+				for subdir in subdirs:
+					directories.put(subdir)
+				pending += len(subdirs)
+
+				for curr_file in files:
+					yield curr_file
+		finally:
+			for curr_worker in workers:
+				directories.put(None)
+
+	@property
+	def files(self):
+		if self.scan_threads > 1:
+			return self._walk_threaded()
+
+		return self._walk()
+
+class ScanCache(object):
+	'''
+	Results of previous LocalFilesystem scan, kept in JSON file between runs.
+
+	Holds per-directory mtime with entry names and per-file (size, mtime, inode). Directory
+	with unchanged mtime is not listed again; with trust_directory_mtime its files are not
+	even stat'ed, so in-place modifications there go unnoticed. New state is recorded while
+	scanning and written by save(); signature (e.g. include/exclude patterns) invalidates
+	cache when scan settings change.
+	'''
+	def __init__(self, filename, signature=None):
+		super(ScanCache, self).__init__()
+		self.filename = filename
+		self.signature = signature
+
+		try:
+			with file(self.filename, 'r') as cache_file:
+				previous = json.load(cache_file)
+		except IOError: # first run
+			previous = None
+
+		if previous is None or previous.get('signature') != signature:
+			previous = {'dirs': {}, 'files': {}}
+
+		self._previous = previous
+		self._current = {'signature': signature, 'dirs': {}, 'files': {}}
+
+	def previous_directory(self, directory, mtime):
+		''' Returns (subdir names, file names) if directory didn't change since last scan '''
+		cached = self._previous['dirs'].get(directory)
+
+		if cached is None or cached[0] != mtime:
+			return None
+
+		return cached[1], cached[2]
+
+	def previous_file(self, path):
+		return self._previous['files'][path]
+
+	def record_directory(self, directory, mtime, subdirs, files):
+		self._current['dirs'][directory] = [mtime, [os.path.basename(subdir) for root, subdir in subdirs], [os.path.basename(curr_file.path) for curr_file in files]]
+
+		for curr_file in files:
+			self._current['files'][curr_file.path] = [curr_file.size, curr_file.mtime, curr_file.inode]
+
+	def unchanged(self, local_file):
+		return self._previous['files'].get(local_file.path) == [local_file.size, local_file.mtime, local_file.inode]
+
+	def forget(self, path):
+		''' Makes next run look at the file again, e.g. because its upload failed '''
+		self._current['files'].pop(path, None)
+		self._current['dirs'].pop(os.path.dirname(path), None)
+
+	def save(self):
+		''' Writes state recorded since last save, which next scan (of long-lived GlacierSync too) then compares against '''
+		temp_filename = self.filename + '.tmp'
+
+		with file(temp_filename, 'w') as cache_file:
+			json.dump(self._current, cache_file)
+
+		os.rename(temp_filename, self.filename)
+
+		self._previous = self._current
+		self._current = {'signature': self.signature, 'dirs': {}, 'files': {}}
+
+# TODO: make this class nicer!
+class RemoteFile(File):
+	'''
+	Catalogue entry. Fields of entry dict are unpacked into slots (timestamps stay integers), as
+	there may be millions of these in memory at once; file_json_data puts the dict back together.
+	'''
+	__slots__ = ('path', 'uuid', 'last_modified_epoch', 'mtime_ns', 'uploaded_at_epoch', 'size', 'tree_hash', 'offset', 'length', '_archive_size', 'codec', 'chunks', 'generation', 'retired', '_extra')
+
+	OPTIONAL_FIELDS = ('mtime_ns', 'uploaded_at', 'size', 'tree_hash', 'offset', 'length', 'archive_size', 'codec', 'chunks', 'generation', 'retired')
+	FIELDS = frozenset(('path', 'uuid', 'last_modified') + OPTIONAL_FIELDS)
+
+	def __init__(self, file_json_data):
+		super(RemoteFile, self).__init__()		
+
+		self.path = file_json_data['path']
+		self.uuid = file_json_data['uuid']
+		self.last_modified_epoch = file_json_data['last_modified']
+		self.mtime_ns = file_json_data.get('mtime_ns')
+		self.uploaded_at_epoch = file_json_data.get('uploaded_at')
+
+		self.size = file_json_data.get('size')
+		self.tree_hash = file_json_data.get('tree_hash')
+		self.offset = file_json_data.get('offset') # where file data starts in packed archive, None if file has archive for itself
+		self.length = file_json_data.get('length')
+		self._archive_size = file_json_data.get('archive_size')
+		self.codec = file_json_data.get('codec') # ChunkCodec name when archive is compressed/encrypted, size is original size then
+		self.chunks = file_json_data.get('chunks') # sha256 of each content defined chunk of deduplicated file, uuid is its own then
+		self.generation = file_json_data.get('generation') # catalogue generation entry was added in, None when before first snapshot
+		self.retired = file_json_data.get('retired') # generation old version was replaced or deleted in, None for current one
+
+		# fields we don't know about, kept so they survive migration
+		self._extra = None
+		if not self.FIELDS.issuperset(file_json_data):
+			self._extra = dict((key, value) for key, value in file_json_data.iteritems() if key not in self.FIELDS)
+
+	@property
+	def file_json_data(self):
+		file_json_data = {
+			'path': self.path,
+			'last_modified': self.last_modified_epoch,
+			'uuid': self.uuid,
+		}
+
+		for field, value in zip(self.OPTIONAL_FIELDS, (self.mtime_ns, self.uploaded_at_epoch, self.size, self.tree_hash, self.offset, self.length, self._archive_size, self.codec, self.chunks, self.generation, self.retired)):
+			if value is not None:
+				file_json_data[field] = value
+
+		if self._extra:
+			file_json_data.update(self._extra)
+
+		return file_json_data
+
+	@property
+	def last_modified(self):
+		return datetime.utcfromtimestamp(self.last_modified_epoch)
+
+	@property
+	def uploaded_at(self):
+		if self.uploaded_at_epoch is not None:
+			return datetime.utcfromtimestamp(self.uploaded_at_epoch)
+
+	@property
+	def archive_size(self):
+		return self.size if self._archive_size is None else self._archive_size
+
+class Layer2Engine(object):
+	'''
+	Vault calls RemoteFilesystem makes, done the way boto's Layer2 does them: every archive goes
+	through ConcurrentUploader, which starts its own 10 threads and a multipart upload even for
+	tiny files. Methods may be called from many threads at once.
+	'''
+	def __init__(self, vault):
+		super(Layer2Engine, self).__init__()
+		self.vault = vault
+		self.layer1 = vault.layer1
+		self.vault_name = vault.name
+
+	def create_archive(self, path, description):
+		return self.vault.concurrent_create_archive_from_file(path, description=description)
+
+	@staticmethod
+	def create_archive_requests(size):
+		''' How many requests create_archive makes for archive of that size '''
+		return 2 + max(1, -(-size // max(DEFAULT_PART_SIZE, minimum_part_size(size))))
+
+	def delete_archive(self, archive_id):
+		self.vault.delete_archive(archive_id)
+
+	def initiate_job(self, job_data):
+		return self.layer1.initiate_job(self.vault_name, job_data)
+
+	def list_jobs(self, marker=None):
+		return self.layer1.list_jobs(self.vault_name, marker=marker)
+
+	def get_job_output(self, job_id, byte_range):
+		return self.layer1.get_job_output(self.vault_name, job_id, byte_range)
+
+	def describe_job(self, job_id):
+		return self.layer1.describe_job(self.vault_name, job_id)
+
+	def open_job_output(self, job_id):
+		''' Raw output to read() from, for inventories get_job_output would parse whole '''
+		return open_job_output(self.vault, job_id)
+
+	def initiate_multipart_upload(self, part_size, description):
+		return self.layer1.initiate_multipart_upload(self.vault_name, part_size, description)
+
+	def upload_part(self, upload_id, linear_hash, part_tree_hash, byte_range, data):
+		return self.layer1.upload_part(self.vault_name, upload_id, linear_hash, part_tree_hash, byte_range, data)
+
+	def complete_multipart_upload(self, upload_id, archive_tree_hash, archive_size):
+		return self.layer1.complete_multipart_upload(self.vault_name, upload_id, archive_tree_hash, archive_size)
+
+	def abort_multipart_upload(self, upload_id):
+		return self.layer1.abort_multipart_upload(self.vault_name, upload_id)
+
+class PooledEngine(Layer2Engine):
+	'''
+	Every call is a single request on connection pool boto keeps per Layer1, archives included, so
+	TransferScheduler workers are the only threads and each of them holds at most one connection.
+	'''
+	def create_archive(self, path, description):
+		with open(path, 'rb') as archive_file:
+			if os.fstat(archive_file.fileno()).st_size > SINGLE_UPLOAD_MAX_SIZE: # too big for one request
+				return super(PooledEngine, self).create_archive(path, description)
+
+			linear_hash, archive_tree_hash = compute_hashes_from_fileobj(archive_file)
+			archive_file.seek(0)
+
+			return self.layer1.upload_archive(self.vault_name, archive_file, linear_hash, archive_tree_hash, description)['ArchiveId']
+
+	@staticmethod
+	def create_archive_requests(size):
+		if size > SINGLE_UPLOAD_MAX_SIZE:
+			return Layer2Engine.create_archive_requests(size)
+
+		return 1
+
+TRANSFER_ENGINES = {
+	'layer2': Layer2Engine,
+	'pooled': PooledEngine,
+}
+
+class MeteredEngine(object):
+	''' Transfer engine wrapper recording latency (and failures) of every vault call in METRICS '''
+	CALLS = frozenset(('create_archive', 'delete_archive', 'initiate_job', 'list_jobs', 'get_job_output', 'describe_job', 'open_job_output',
+		'initiate_multipart_upload', 'upload_part', 'complete_multipart_upload', 'abort_multipart_upload'))
+
+	def __init__(self, engine):
+		super(MeteredEngine, self).__init__()
+		self.engine = engine
+
+	def __getattr__(self, name):
+		attribute = getattr(self.engine, name)
+
+		if name not in self.CALLS:
+			return attribute
+
+		def call(*args, **kwargs):
+			start = METRICS.clock()
+
+			try:
+				return attribute(*args, **kwargs)
+			except Exception:
+				METRICS.count('api_errors')
+				raise
+			finally:
+				METRICS.observe_latency(name, METRICS.clock() - start)
+
+		return call
+
+class RemoteFilesystem(Filesystem):
+	def __init__(self, glacier_local_database, engine, store_tree_hash=False, min_part_size=MULTIPART_MIN_PART_SIZE, throttle=None, compression=None, encryption_key=None, cpu_pool=None, dedup_chunk_size=DEDUP_CHUNK_SIZE):
+		super(RemoteFilesystem, self).__init__()
+		self.glacier_local_database = glacier_local_database
+		self.engine = engine
+		self.store_tree_hash = store_tree_hash
+		self.min_part_size = min_part_size
+		self.throttle = throttle or Throttle()
+		self.compression = compression
+		self.encryption_key = encryption_key
+		self.cpu_pool = cpu_pool
+		self.dedup_chunk_size = dedup_chunk_size
+
+		ChunkCodec(compression, encryption_key) # fail early when needed module is missing
+
+	@property
+	def files(self):
+		return self.glacier_local_database.files
+
+	def upload_file(self, local_file):
+		self.record_upload(local_file, self.upload_archive(local_file))
+
+	@staticmethod
+	def _archive_description(local_file, codec=None):
+		file_data = {
+			'path': local_file.path,
+			'last_modified': timegm(local_file.last_modified.timetuple()),
+			'mtime_ns': local_file.mtime_ns,
+			'uploaded_at': timegm(datetime.now().timetuple()),		
+		}
+
+		if codec is not None: # archive size says nothing about file then
+			file_data['codec'] = codec
+			file_data['size'] = local_file.size
+
+		return json.dumps(file_data)
+
+	def codec_for(self, local_file):
+		''' ChunkCodec file is sent through, None when it goes as it is '''
+		compression = self.compression
+
+		if os.path.splitext(local_file.path)[1].lower() in COMPRESSED_EXTENSIONS:
+			compression = None
+
+		if compression is None and self.encryption_key is None:
+			return None
+
+		return ChunkCodec(compression, self.encryption_key)
+
+	def upload_encoded(self, local_file, codec):
+		'''
+		Sends file below multipart_threshold through codec, encoded to temporary file chunk by chunk. Safe
+		to call from worker threads, returns (uuid, catalogue fields of encoded archive) for record_upload.
+		'''
+		if self.store_tree_hash: # of original data, restored file is checked against it
+			self._hash(local_file)
+
+		with tempfile.NamedTemporaryFile(prefix='glacsync-encoded-') as encoded_file:
+			with open(local_file.path, 'rb') as source:
+				archive_size = codec.encode(source, encoded_file, cpu_pool=self.cpu_pool)
+			encoded_file.flush()
+
+			METRICS.count('bytes_encoded', local_file.size)
+
+			return self._create_archive(encoded_file.name, archive_size, self._archive_description(local_file, codec.name)), {'codec': codec.name, 'archive_size': archive_size}
+
+	def _hash(self, local_file):
+		''' Tree hash for catalogue, computed by cpu_pool when there is one '''
+		if self.cpu_pool is not None and local_file.cached_tree_hash is None:
+			local_file.cached_tree_hash = self.cpu_pool.call(tree_hash_file, local_file.path)
+			METRICS.count('bytes_hashed', local_file.size)
+
+		return local_file.tree_hash
+
+	def upload_archive(self, local_file):
+		''' Sends file to vault without touching database, safe to call from worker threads '''
+		if self.store_tree_hash: # hashed here, on worker thread; record_upload puts it in catalogue
+			self._hash(local_file)
+
+		return self._create_archive(local_file.path, local_file.size, self._archive_description(local_file))
+
+	def throttled_part_size(self, size):
+		''' Part size archive of size bytes is sent in by _create_archive, None when it goes whole '''
+		bytes_per_second = self.throttle.limits()[0]
+		part_size = MEGABYTE
+
+		while part_size < bytes_per_second:
+			part_size *= 2
+
+		part_size = multipart_part_size(size, part_size)
+
+		if bytes_per_second and size > part_size:
+			return part_size
+
+	def _create_archive(self, path, size, description):
+		'''
+		Sends archive file, returns its uuid. Engine reads the file itself, so archive is paid for
+		up front; with byte limit in effect bigger archives go part by part instead, each part paid
+		for right before it is sent at link speed. Parts are the smallest power of two MiB holding
+		one second worth of bytes, so bursts last about a second.
+		'''
+		part_size = self.throttled_part_size(size)
+
+		if part_size is None:
+			self.throttle.request()
+			self.throttle.transfer(size)
+
+			return self.engine.create_archive(path, description)
+
+		self.throttle.request()
+		upload_id = self.engine.initiate_multipart_upload(part_size, description)['UploadId']
+		part_hashes = []
+
+		try:
+			with open(path, 'rb') as archive_file:
+				for start in xrange(0, size, part_size):
+					data = read_exactly(archive_file, min(part_size, size - start))
+					if len(data) != min(part_size, size - start):
+						raise IOError('%s has changed during upload' % path)
+
+					part_hashes.append(tree_hash(chunk_hashes(data)))
+
+					self.throttle.request()
+					self.throttle.transfer(len(data))
+					self.engine.upload_part(upload_id, hashlib.sha256(data).hexdigest(), bytes_to_hex(part_hashes[-1]), (start, start + len(data) - 1), data)
+
+			# parts are power of two MiB long, so tree of part hashes is tree of the whole archive
+			self.throttle.request()
+			return self.engine.complete_multipart_upload(upload_id, bytes_to_hex(tree_hash(part_hashes)), size)['ArchiveId']
+		except Exception:
+			error = sys.exc_info()
+
+			try:
+				self.throttle.request()
+				self.engine.abort_multipart_upload(upload_id)
+			except Exception: # Glacier drops it after a day anyway
+				pass
+
+			raise error[0], error[1], error[2]
+
+	def initiate_multipart_upload(self, local_file, codec=None):
+		'''
+		Starts multipart upload with part size fit for file size (or most it can take encoded by codec),
+		returns MultipartUploadJob to remember it
+		'''
+		part_size = multipart_part_size(local_file.size if codec is None else codec.max_encoded_size(local_file.size), self.min_part_size)
+
+		self.throttle.request()
+		response = self.engine.initiate_multipart_upload(part_size, self._archive_description(local_file, codec.name if codec is not None else None))
+
+		job = MultipartUploadJob({
+			'uuid': response['UploadId'],
+			'path': local_file.path,
+			'size': local_file.size,
+			'last_modified': timegm(local_file.last_modified.timetuple()),
+			'mtime_ns': local_file.mtime_ns,
+			'part_size': part_size,
+			'parts': {},
+		})
+
+		if codec is not None:
+			job.codec = codec.name
+
+		return job
+
+	def upload_part(self, job, index):
+		''' Sends one part of MultipartUploadJob, returns its tree hash '''
+		start = index * job.part_size
+		expected_size = min(job.part_size, job.size - start)
+
+		with open(job.path, 'rb') as part_file:
+			part_file.seek(start)
+			data = part_file.read(expected_size)
+
+		if len(data) != expected_size:
+			raise IOError('%s has changed during upload' % job.path)
+
+		part_tree_hash = bytes_to_hex(tree_hash(chunk_hashes(data)))
+		METRICS.count('bytes_hashed', expected_size)
+
+		self.throttle.request()
+		self.throttle.transfer(expected_size)
+		self.engine.upload_part(job.uuid, hashlib.sha256(data).hexdigest(), part_tree_hash, (start, start + expected_size - 1), data)
+
+		return part_tree_hash
+
+	def upload_encoded_part(self, job, reader=None):
+		'''
+		Sends next part of MultipartUploadJob with codec, encoding file as it goes. Returns (reader to
+		pass to next call, part index, its tree hash); reader is closed once file is encoded to the end,
+		index is None when no part was left. Returns None when parts sent by earlier run aren't
+		encoded the same way any more (always so for encrypted ones, nonces are random),
+		then upload has to start over.
+		'''
+		if reader is None: # parts sent earlier are encoded again, to get to where they end
+			codec = ChunkCodec.from_name(job.codec, self.encryption_key)
+
+			if job.parts and codec.key is not None:
+				return None
+
+			reader = EncodedReader(job.path, codec, self.cpu_pool)
+
+			for index in xrange(len(job.parts)):
+				if bytes_to_hex(tree_hash(chunk_hashes(reader.read(job.part_size)))) != job.parts[str(index)]:
+					reader.close()
+					return None
+
+		try:
+			index = len(job.parts)
+			data = reader.read(job.part_size)
+
+			if reader.at_end():
+				if reader.source_size != job.size:
+					raise IOError('%s has changed during upload' % job.path)
+
+				reader.close()
+
+			if not data: # interrupted right before completing
+				return reader, None, None
+
+			part_tree_hash = bytes_to_hex(tree_hash(chunk_hashes(data)))
+			METRICS.count('bytes_hashed', len(data))
+
+			start = index * job.part_size
+			self.throttle.request()
+			self.throttle.transfer(len(data))
+			self.engine.upload_part(job.uuid, hashlib.sha256(data).hexdigest(), part_tree_hash, (start, start + len(data) - 1), data)
+
+			return reader, index, part_tree_hash
+		except Exception:
+			reader.close()
+			raise
+
+	def complete_multipart_upload(self, job):
+		''' Returns (archive id, tree hash of whole archive) '''
+		# parts are power of two MiB long, so tree of part hashes is tree of the whole file
+		part_hashes = [binascii.unhexlify(job.parts[str(index)]) for index in xrange(job.part_count)]
+		archive_tree_hash = bytes_to_hex(tree_hash(part_hashes))
+
+		self.throttle.request()
+		response = self.engine.complete_multipart_upload(job.uuid, archive_tree_hash, job.archive_size)
+
+		return response['ArchiveId'], archive_tree_hash
+
+	def complete_encoded_upload(self, job, local_file):
+		''' Completes upload of MultipartUploadJob with codec, returns (uuid, catalogue fields of encoded archive) like upload_encoded '''
+		if self.store_tree_hash: # of original data, restored file is checked against it
+			self._hash(local_file)
+
+		uuid = self.complete_multipart_upload(job)[0]
+		METRICS.count('bytes_encoded', job.size)
+
+		return uuid, {'codec': job.codec, 'archive_size': job.archive_size}
+
+	def abort_multipart_upload(self, job):
+		self.throttle.request()
+		self.engine.abort_multipart_upload(job.uuid)
+
+	def upload_pack(self, local_files):
+		'''
+		Sends small files as one tar archive, safe to call from worker threads.
+		Returns (uuid, [member dict with offset and length of each file's data, and archive_size]).
+		'''
+		file_data = json.dumps({
+			'pack': True,
+			'files': len(local_files),
+			'uploaded_at': timegm(datetime.now().timetuple()),
+		})
+
+		members = []
+
+		with tempfile.NamedTemporaryFile(prefix='glacsync-pack-') as pack_file:
+			pack = tarfile.open(fileobj=pack_file, mode='w', format=tarfile.GNU_FORMAT)
+
+			for local_file in local_files:
+				tarinfo = tarfile.TarInfo(local_file.path.lstrip('/'))
+				tarinfo.size = local_file.size
+				tarinfo.mtime = local_file.mtime
+
+				with open(local_file.path, 'rb') as member_file:
+					pack.addfile(tarinfo, member_file)
+
+				# data ends padded to a full block right where tar stands now
+				blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+				members.append((pack.offset - (blocks + bool(remainder)) * tarfile.BLOCKSIZE, tarinfo.size))
+
+				if self.store_tree_hash:
+					self._hash(local_file)
+
+			pack.close()
+			pack_file.flush()
+
+			archive_size = os.fstat(pack_file.fileno()).st_size
+			members = [{'offset': offset, 'length': length, 'archive_size': archive_size} for offset, length in members]
+
+			return self._create_archive(pack_file.name, archive_size, file_data), members
+
+	def cut_chunks(self, local_file):
+		''' Content defined chunks of file (see chunk_file), cut by cpu_pool when there is one '''
+		if self.store_tree_hash:
+			self._hash(local_file)
+
+		if self.cpu_pool is None:
+			return chunk_file(local_file.path, self.dedup_chunk_size)
+
+		chunks = self.cpu_pool.call(chunk_file, local_file.path, self.dedup_chunk_size)
+		METRICS.count('bytes_hashed', local_file.size)
+
+		return chunks
+
+	def upload_chunks(self, local_file, chunks, codec=None):
+		'''
+		Sends chunks of file (some of what cut_chunks returned) as one archive, each encoded on its
+		own when codec is given. Safe to call from worker threads, returns (uuid, [[sha256, offset,
+		length] of every chunk inside archive]) for record_chunks.
+		'''
+		stored = []
+
+		with tempfile.NamedTemporaryFile(prefix='glacsync-chunks-') as chunks_file:
+			with open(local_file.path, 'rb') as source:
+				for chunk_hash, offset, length in chunks:
+					source.seek(offset)
+					data = read_exactly(source, length)
+
+					if hashlib.sha256(data).hexdigest() != chunk_hash:
+						raise IOError('%s has changed during upload' % local_file.path)
+
+					start = chunks_file.tell()
+
+					if codec is None:
+						chunks_file.write(data)
+					else:
+						codec.encode(StringIO(data), chunks_file)
+
+					stored.append([chunk_hash, start, chunks_file.tell() - start])
+
+			chunks_file.flush()
+			archive_size = chunks_file.tell()
+
+			if codec is not None:
+				METRICS.count('bytes_encoded', sum(length for chunk_hash, offset, length in chunks))
+
+			file_data = json.dumps({
+				'chunks': len(chunks),
+				'uploaded_at': timegm(datetime.now().timetuple()),
+			})
+
+			return self._create_archive(chunks_file.name, archive_size, file_data), stored
+
+	def record_chunks(self, uuid, stored, codec=None):
+		''' Puts chunks upload_chunks has sent into chunk index, so files can refer to them '''
+		self.glacier_local_database.add_chunks(uuid, stored, codec.name if codec is not None else None)
+
+	def record_chunked_upload(self, local_file, hashes):
+		''' Catalogue entry of deduplicated file is list of its chunks, which must all be in chunk index already '''
+		self.glacier_local_database.add_file(local_file, 'chunked-%s' % binascii.hexlify(os.urandom(16)), {'chunks': hashes})
+		self.glacier_local_database.retain_chunks(hashes)
+
+	def release_chunks(self, remote_file):
+		'''
+		Forgets deduplicated file, returns RemoteFiles of chunk archives no file refers to any more.
+		Their real upload time isn't known, file's is used, as archive can't be younger than that.
+		'''
+		self.record_delete(remote_file)
+
+		return [RemoteFile({'path': remote_file.path, 'uuid': uuid, 'last_modified': remote_file.last_modified_epoch, 'uploaded_at': remote_file.uploaded_at_epoch})
+			for uuid in self.glacier_local_database.release_chunks(remote_file.chunks)]
+
+	def record_upload(self, local_file, uuid, member=None):
+		self.glacier_local_database.add_file(local_file, uuid, member)
+
+	def delete_file(self, remote_file):
+		if remote_file.offset is None:
+			self.delete_archive(remote_file)
+			self.record_delete(remote_file)
+		elif self.release_member(remote_file):
+			self.delete_archive(remote_file)
+			self.record_delete(remote_file)
+
+	def request_retrieval(self, remote_file):
+		''' Starts archive-retrieval job (of byte range, for packed files), returns RetreiveArchiveJob to remember it '''
+		job_data = {'Type': 'archive-retrieval', 'ArchiveId': remote_file.uuid}
+		range_start = 0
+
+		if remote_file.offset is not None:
+			range_start, range_end = megabyte_aligned_range(remote_file.offset, remote_file.length, remote_file.archive_size)
+			job_data['RetrievalByteRange'] = '%d-%d' % (range_start, range_end)
+
+		self.throttle.request()
+		response = self.engine.initiate_job(job_data)
+
+		return RetreiveArchiveJob({
+			'uuid': response['JobId'],
+			'archive_id': remote_file.uuid,
+			'path': remote_file.path,
+			'range_start': range_start,
+			'offset': remote_file.offset,
+			'length': remote_file.length,
+			'tree_hash': remote_file.tree_hash,
+			'last_modified': remote_file.last_modified_epoch,
+			'mtime_ns': remote_file.mtime_ns,
+			'codec': remote_file.codec,
+			'size': remote_file.size,
+		})
+
+	def request_inventory(self):
+		''' Starts inventory-retrieval job, returns RetreiveInvetoryJob to remember it '''
+		self.throttle.request()
+
+		return RetreiveInvetoryJob(self.engine.initiate_job({'Type': 'inventory-retrieval'})['JobId'])
+
+	def job_completed(self, job):
+		self.throttle.request()
+
+		return self.engine.describe_job(job.uuid)['Completed']
+
+	def open_inventory(self, job):
+		''' Output of completed RetreiveInvetoryJob to read() from, paid for as it is read '''
+		self.throttle.request()
+
+		return ThrottledReader(self.engine.open_job_output(job.uuid), self.throttle)
+
+	def jobs(self):
+		''' {job id: job description} of all jobs vault still knows about, in a few paged requests '''
+		jobs = {}
+		marker = None
+
+		while True:
+			self.throttle.request()
+			response = self.engine.list_jobs(marker)
+
+			for job in response['JobList']:
+				jobs[job['JobId']] = job
+
+			marker = response.get('Marker')
+			if not marker:
+				return jobs
+
+	def download_job(self, job, job_description, chunk_size=8 * MEGABYTE):
+		'''
+		Writes output of completed RetreiveArchiveJob to job.path, chunk_size (multiple of MiB) at
+		a time, checking every chunk against tree hash Glacier sends. Data goes to job.path +
+		PART_SUFFIX first, download interrupted earlier continues from last complete chunk.
+		'''
+		if job_description.get('RetrievalByteRange'):
+			range_first, range_last = map(int, job_description['RetrievalByteRange'].split('-'))
+			output_size = range_last - range_first + 1
+		else:
+			output_size = job_description['ArchiveSizeInBytes']
+
+		self._make_parent_directory(job.path)
+
+		part_path = job.path + PART_SUFFIX
+
+		with open(part_path, 'r+b' if os.path.exists(part_path) else 'w+b') as part_file:
+			part_file.seek(0, os.SEEK_END)
+			start = part_file.tell() // chunk_size * chunk_size
+
+			part_file.truncate(start)
+			part_file.seek(start)
+
+			for chunk_start in xrange(start, output_size, chunk_size):
+				chunk_end = min(chunk_start + chunk_size, output_size) - 1
+				self.throttle.request()
+				response = self.engine.get_job_output(job.uuid, (chunk_start, chunk_end))
+
+				hashes = []
+				for piece_start in xrange(chunk_start, chunk_end + 1, MEGABYTE):
+					piece = read_exactly(response, min(MEGABYTE, chunk_end + 1 - piece_start))
+					self.throttle.transfer(len(piece))
+					METRICS.count('bytes_downloaded', len(piece))
+
+					hashes.append(hashlib.sha256(piece).digest())
+					part_file.write(piece)
+
+				if response['TreeHash'] is not None and bytes_to_hex(tree_hash(hashes)) != response['TreeHash']:
+					part_file.truncate(chunk_start)
+					raise TreeHashMismatchError('Corrupted data in %s at %d-%d' % (job.path, chunk_start, chunk_end))
+
+		restored_path = part_path
+
+		if job.offset is not None: # we've got megabyte aligned range around packed file
+			restored_path = job.path + '.member' + PART_SUFFIX
+			self._extract_member(part_path, restored_path, job.offset - job.range_start, job.length)
+		elif getattr(job, 'codec', None) is not None:
+			restored_path = job.path + '.decoded' + PART_SUFFIX
+			self._decode(part_path, restored_path, ChunkCodec.from_name(job.codec, self.encryption_key), job.size)
+
+		if job.tree_hash is not None and tree_hash_file(restored_path) != job.tree_hash:
+			for path in set([part_path, restored_path]):
+				os.unlink(path)
+
+			raise TreeHashMismatchError('Restored %s differs from uploaded file' % job.path)
+
+		os.rename(restored_path, job.path)
+
+		if restored_path != part_path:
+			os.unlink(part_path)
+
+		self._set_mtime(job.path, getattr(job, 'mtime_ns', None), job.last_modified)
+
+	def assemble_chunks(self, remote_file, locations, archive_paths):
+		'''
+		Puts deduplicated file back together from chunk archives downloaded to archive_paths (uuid:
+		path), locations are what chunk_locations returned for its chunks. Every chunk is checked
+		against its SHA-256. Safe to call from worker threads.
+		'''
+		self._make_parent_directory(remote_file.path)
+		part_path = remote_file.path + PART_SUFFIX
+
+		try:
+			with open(part_path, 'wb') as part_file:
+				for chunk_hash in remote_file.chunks:
+					if chunk_hash not in locations:
+						raise IOError('Chunk %s of %s is not in catalogue' % (chunk_hash, remote_file.path))
+
+					uuid, offset, length, codec = locations[chunk_hash]
+
+					with open(archive_paths[uuid], 'rb') as archive_file:
+						archive_file.seek(offset)
+						data = read_exactly(archive_file, length)
+
+					if codec is not None:
+						decoded = StringIO()
+						ChunkCodec.from_name(codec, self.encryption_key).decode(StringIO(data), decoded)
+						data = decoded.getvalue()
+
+					if hashlib.sha256(data).hexdigest() != chunk_hash:
+						raise TreeHashMismatchError('Chunk %s of %s is corrupted' % (chunk_hash, remote_file.path))
+
+					part_file.write(data)
+		except Exception:
+			os.unlink(part_path)
+			raise
+
+		os.rename(part_path, remote_file.path)
+		self._set_mtime(remote_file.path, remote_file.mtime_ns, remote_file.last_modified_epoch)
+
+	@staticmethod
+	def _make_parent_directory(path):
+		directory = os.path.dirname(path)
+
+		if directory and not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError: # other download has just made it
+				pass
+
+	@staticmethod
+	def _set_mtime(path, mtime_ns, last_modified):
+		if mtime_ns is not None:
+			mtime = mtime_ns / float(NANOSECONDS)
+		else: # job requested by older version, only wall clock time known
+			mtime = time.mktime(datetime.utcfromtimestamp(last_modified).timetuple())
+
+		os.utime(path, (mtime, mtime))
+
+	@staticmethod
+	def _decode(part_path, decoded_path, codec, size):
+		try:
+			with open(part_path, 'rb') as part_file, open(decoded_path, 'wb') as decoded_file:
+				decoded_size = codec.decode(part_file, decoded_file)
+
+			if size is not None and decoded_size != size:
+				raise CodecError('Decoded %s has %d bytes instead of %d' % (decoded_path, decoded_size, size))
+		except CodecError:
+			os.unlink(decoded_path)
+			raise
+
+	@staticmethod
+	def _extract_member(part_path, member_path, member_start, length):
+		with open(part_path, 'rb') as part_file:
+			part_file.seek(member_start)
+
+			with open(member_path, 'wb') as member_file:
+				member_file.write(read_exactly(part_file, length))
+
+	def release_member(self, remote_file):
+		'''
+		Forgets file from packed archive, unless it is the last one. Then True is returned and
+		entry stays until archive is deleted (record_delete) or queued (queue_delete).
+		'''
+		if self.glacier_local_database.count_archive_members(remote_file.uuid) <= 1:
+			return True
+
+		self.record_delete(remote_file)
+		return False
+
+	def delete_archive(self, remote_file):
+		''' Removes archive from vault without touching database, safe to call from worker threads '''
+		self.throttle.request()
+		self.engine.delete_archive(remote_file.uuid)
+
+	def record_delete(self, remote_file):
+		self.glacier_local_database.delete_file(remote_file)
+
+	def queue_delete(self, remote_file):
+		''' Forgets file, its archive is deleted by a later sync once it is old enough (see due_deletes) '''
+		self.record_delete(remote_file)
+		self.glacier_local_database.queue_delete(remote_file)
+
+class CatalogueSnapshot(Filesystem):
+	''' Catalogue as it was when snapshot was taken, for DifferRunner '''
+	def __init__(self, glacier_local_database, snapshot):
+		super(CatalogueSnapshot, self).__init__()
+		self.glacier_local_database = glacier_local_database
+		self.snapshot = snapshot
+
+	@property
+	def files(self):
+		return self.glacier_local_database.snapshot_files(self.snapshot)
+
+class PackBuilder(object):
+	''' Collects small files until there is enough of them for one packed archive '''
+	def __init__(self, pack_size):
+		super(PackBuilder, self).__init__()
+		self.pack_size = pack_size
+
+		self.members = []
+		self.size = 0
+
+	def add(self, member, size):
+		''' Returns True when pack is full and should be taken '''
+		self.members.append(member)
+		self.size += size
+
+		return self.size >= self.pack_size
+
+	def take(self):
+		members = self.members
+
+		self.members = []
+		self.size = 0
+
+		return members
+
+class TransferTask(object):
+	def __init__(self, description, function, args, on_success=None):
+		super(TransferTask, self).__init__()
+		self.description = description
+		self.function = function
+		self.args = args
+		self.on_success = on_success
+
+		self.result = None
+		self.error = None
+
+	@property
+	def succeeded(self):
+		return self.error is None
+
+	def run(self):
+		try:
+			self.result = self.function(*self.args)
+		except Exception as e:
+			self.error = e
+
+class TransferScheduler(object):
+	'''
+	Runs vault calls on a bounded pool of worker threads.
+
+	on_success callbacks and report run in the thread calling join(), so that thread stays
+	the only one writing to local database. Callbacks may submit follow-up tasks.
+	'''
+	def __init__(self, concurrency=1, report=None):
+		super(TransferScheduler, self).__init__()
+		self.concurrency = max(1, concurrency)
+		self.report = report
+
+		self._tasks = Queue(self.concurrency * 4)
+		self._finished = Queue()
+		self._pending = 0
+		self._failed = []
+		self._workers = []
+
+	def _worker(self):
+		while True:
+			task = self._tasks.get()
+
+			if task is None:
+				return
+
+			task.run()
+			self._finished.put(task)
+
+	def _start_workers(self):
+		while len(self._workers) < self.concurrency:
+			worker = threading.Thread(target=self._worker)
+			worker.daemon = True
+			worker.start()
+
+			self._workers.append(worker)
+
+	def _finish(self, task):
+		self._pending -= 1
+
+		if task.succeeded and task.on_success is not None:
+			try:
+				task.on_success(task.result)
+			except Exception as e:
+				task.error = e
+
+		if not task.succeeded:
+			self._failed.append(task)
+
+		if self.report is not None:
+			self.report(task)
+
+	def submit(self, description, function, *args, **kwargs):
+		self._start_workers()
+
+		# don't let task queue block us while finished tasks wait for their callbacks
+		while self._tasks.full() and not self._finished.empty():
+			self._finish(self._finished.get())
+
+		self._pending += 1
+		self._tasks.put(TransferTask(description, function, args, kwargs.get('on_success')))
+
+	def join(self):
+		''' Waits for all submitted (and follow-up) tasks, returns those which failed '''
+		while self._pending:
+			self._finish(self._finished.get())
+
+		failed, self._failed = self._failed, []
+
+		return failed
+
+	def close(self):
+		for worker in self._workers:
+			self._tasks.put(None)
+
+		for worker in self._workers:
+			worker.join()
+
+		self._workers = []
+
+class InvalidJobTypeException(Exception):
+	pass
+
+class GlacierLocalDatabase(object):
+	''' Common part of catalogue backends, subclasses decide how entries are stored '''
+	def __init__(self):
+		super(GlacierLocalDatabase, self).__init__()
+
+	@staticmethod
+	def _file_entry(local_file, uuid, member=None, generation=None):
+		file_entry = {
+			'path': local_file.path,
+			'last_modified': timegm(local_file.last_modified.timetuple()),
+			'uploaded_at': timegm(datetime.now().timetuple()),
+			'uuid': uuid
+		}
+
+		for optional_field, value in (('mtime_ns', getattr(local_file, 'mtime_ns', None)), ('size', getattr(local_file, 'size', None)), ('tree_hash', getattr(local_file, 'cached_tree_hash', None))):
+			if value is not None:
+				file_entry[optional_field] = value
+
+		if member is not None: # offset, length and archive_size of file inside packed archive, or codec and archive_size of encoded one
+			file_entry.update(member)
+
+		if generation is not None:
+			file_entry['generation'] = generation
+
+		return file_entry
+
+	@staticmethod
+	def _in_snapshot(entry, snapshot):
+		''' True when catalogue entry (current or retired one) was there when snapshot was taken '''
+		return entry.get('generation', 0) <= snapshot and entry.get('retired', snapshot + 1) > snapshot
+
+	@property
+	def generation(self):
+		''' Generation entries are added and retired in now, snapshot taken next gets its number '''
+		snapshots = self.snapshots
+
+		return snapshots[-1][0] + 1 if snapshots else 1
+
+	def _current_generation(self):
+		''' Generation to stamp new entry with, entries added before first snapshot are left without it '''
+		return self.generation if self.snapshots else None
+
+	@staticmethod
+	def _archive_entry(archive):
+		''' Returns None for packed and chunk archives, their member list is only inside the archive or in chunk index '''
+		file_data = json.loads(archive['ArchiveDescription'])
+
+		if file_data.get('pack') or file_data.get('chunks'):
+			return None
+
+		file_entry = {
+			'path': file_data['path'],
+			'last_modified': file_data['last_modified'],
+			'uploaded_at': file_data['uploaded_at'],
+			'uuid': archive['ArchiveId']
+		}
+
+		if 'mtime_ns' in file_data:
+			file_entry['mtime_ns'] = file_data['mtime_ns']
+
+		if 'codec' in file_data: # inventory knows encoded archive, not the file
+			file_entry['codec'] = file_data['codec']
+			file_entry['size'] = file_data['size']
+
+			if 'Size' in archive:
+				file_entry['archive_size'] = archive['Size']
+
+			return file_entry
+
+		for optional_field, inventory_field in (('size', 'Size'), ('tree_hash', 'SHA256TreeHash')):
+			if inventory_field in archive:
+				file_entry[optional_field] = archive[inventory_field]
+
+		return file_entry
+
+	@classmethod
+	def _archive_entries(cls, amazon_data, progress, batch_size):
+		''' Yields catalogue entries of amazon_data (may be a stream) in batches, reporting archives done so far '''
+		done = 0
+
+		for batch in batches(amazon_data, batch_size):
+			yield [file_entry for file_entry in (cls._archive_entry(archive) for archive in batch) if file_entry is not None]
+
+			done += len(batch)
+			if progress is not None:
+				progress(done)
+
+	@staticmethod
+	def _fixed_entry(entry, archive):
+		''' Entry with size and tree hash Glacier inventory knows of its archive '''
+		fixed = dict(entry)
+
+		if entry.get('offset') is not None or entry.get('codec') is not None: # archive isn't the file itself
+			if 'Size' in archive:
+				fixed['archive_size'] = archive['Size']
+
+			return fixed
+
+		for optional_field, inventory_field in (('size', 'Size'), ('tree_hash', 'SHA256TreeHash')):
+			if inventory_field in archive:
+				fixed[optional_field] = archive[inventory_field]
+
+		return fixed
+
+	def merge_from_amazon(self, amazon_data, header=None, progress=None, batch_size=10000, run_size=100000, report=None):
+		'''
+		Reconciles catalogue with Glacier inventory instead of rebuilding it: archives catalogue
+		doesn't know are added (or reported as orphaned, when they hold packed files or chunks),
+		entries whose archive isn't in inventory are dropped as phantoms, and sizes and tree hashes
+		are fixed. Entries uploaded after InventoryDate of header (as iter_inventory_archives
+		fills it) are kept, inventory can't know them. The other way round, archive is added only
+		when it is the newest one of its path, older ones (deleted by syncs since the inventory was
+		made) are reported as orphaned. When added archive is newer than entries of its path, those
+		are 'superseded': dropped, their archives are only reported, like orphaned ones are. Both sides are put in archive id order,
+		and then in path order, by external_sort, so memory use is bounded by run_size, and changes are written
+		batch_size at a time. report(kind, item) is told about every 'orphaned' archive and
+		'phantom', 'fixed' and 'superseded' entry. Returns counts of them all.
+		'''
+		counts = dict.fromkeys(('archives', 'added', 'orphaned', 'phantom', 'fixed', 'kept', 'superseded'), 0)
+		changes = {'inserts': [], 'deletes': [], 'updates': []}
+
+		def read(archives):
+			for archive in archives:
+				yield archive
+
+				counts['archives'] += 1
+				if progress is not None and not counts['archives'] % batch_size:
+					progress(counts['archives'])
+
+		def change(kind, item):
+			changes[kind].append(item)
+
+			if sum(len(items) for items in changes.values()) >= batch_size:
+				flush()
+
+		def flush():
+			self._merge_changes(changes['inserts'], changes['deletes'], changes['updates'])
+
+			for items in changes.values():
+				del items[:]
+
+		def reported(kind, item):
+			counts[kind] += 1
+
+			if report is not None:
+				report(kind, item)
+
+		# [path, uploaded_at, entry, archive] of archives catalogue doesn't know and [path, uploaded_at, entry, None] of entries that stay
+		by_path = tempfile.TemporaryFile(prefix='glacsync-merge-')
+
+		def path_item(entry, archive=None):
+			by_path.write(json.dumps([entry['path'], entry.get('uploaded_at', 0), entry, archive]) + '\n')
+
+		# catalogue is read whole before anything is written; [uuid, None] marks archives catalogue knows otherwise
+		archives = external_sort(read(amazon_data), lambda archive: archive['ArchiveId'], run_size)
+		entries = external_sort(self._merge_entries(), lambda item: item[0], run_size)
+
+		inventory_date = None
+		if header and header.get('InventoryDate'):
+			inventory_date = timegm(parse_ts(header['InventoryDate']).timetuple())
+
+		try:
+			for uuid, uuid_archives, uuid_entries in merge_join(archives, entries, lambda archive: archive['ArchiveId'], lambda item: item[0]):
+				file_entries = [entry for entry_uuid, entry in uuid_entries if entry is not None]
+
+				if uuid_archives and not uuid_entries:
+					file_entry = self._archive_entry(uuid_archives[0])
+
+					if file_entry is None: # packed files or chunks nobody refers to
+						reported('orphaned', uuid_archives[0])
+					else:
+						path_item(file_entry, uuid_archives[0])
+				elif uuid_archives:
+					for entry in file_entries:
+						fixed = self._fixed_entry(entry, uuid_archives[0])
+						path_item(entry)
+
+						if fixed != entry:
+							reported('fixed', fixed)
+							change('updates', fixed)
+				else:
+					for entry in file_entries:
+						if entry.get('chunks') is not None: # not an archive, its chunks are
+							path_item(entry)
+							continue
+
+						# uploaded_at is local wall clock time, inventory date UTC, a day covers the difference
+						if inventory_date is not None and entry.get('uploaded_at', 0) + 24 * 3600 > inventory_date:
+							counts['kept'] += 1
+							path_item(entry)
+						else:
+							reported('phantom', entry)
+							change('deletes', entry)
+
+			by_path.seek(0)
+
+			# inventory is up to a day old, it still lists archives syncs replaced or deleted since
+			for path, items in groupby(external_sort((json.loads(line) for line in by_path), lambda item: item[0], run_size), lambda item: item[0]):
+				items = list(items)
+				staying = [(uploaded_at, entry) for item_path, uploaded_at, entry, archive in items if archive is None]
+				candidates = sorted((item for item in items if item[3] is not None), key=lambda item: item[1], reverse=True)
+
+				for index, (item_path, uploaded_at, entry, archive) in enumerate(candidates):
+					# packed members and chunked files share what they are stored in, they stay
+					if index or any(entry_uploaded_at >= uploaded_at or staying_entry.get('offset') is not None or staying_entry.get('chunks') is not None
+						for entry_uploaded_at, staying_entry in staying):
+						reported('orphaned', archive)
+						continue
+
+					counts['added'] += 1
+					change('inserts', entry)
+
+					# catalogue missed the upload which replaced them, deleting their archives is left to the user
+					for entry_uploaded_at, staying_entry in staying:
+						reported('superseded', staying_entry)
+						change('deletes', staying_entry)
+		finally:
+			by_path.close()
+
+		flush()
+		self.sync()
+
+		if progress is not None:
+			progress(counts['archives'])
+
+		return counts
+
+	@staticmethod
+	def _job_entry(job):
+		job_entry = {
+			'__job_type': job.__class__.__name__
+		}
+		job_entry.update(job.__dict__)
+
+		return job_entry
+
+	@staticmethod
+	def _job_from_entry(entry):
+		if entry['__job_type'] in (RetreiveInvetoryJob.__name__, PendingJob.__name__, RetreiveArchiveJob.__name__, MultipartUploadJob.__name__):
+			return globals()[entry['__job_type']](entry)
+
+		raise InvalidJobTypeException('Invalid class name in __job_type')
+
+	def close(self):
+		pass
+
+class GlacierLocalDatabaseFile(GlacierLocalDatabase):
+	'''
+	Catalogue stored as a JSON snapshot plus an append-only journal (filename + '.journal').
+
+	Every mutation appends one record to the journal, the journal is fsync'ed every fsync_every
+	records and folded into a new snapshot every compact_every records (or on write()).
+	Snapshot is replaced atomically, so interrupted run never leaves us without a catalogue.
+	'''
+	JOURNAL_SUFFIX = '.journal'
+
+	def __init__(self, filename, fsync_every=64, compact_every=10000):
+		super(GlacierLocalDatabaseFile, self).__init__()
+		self.filename = filename
+		self.journal_filename = filename + self.JOURNAL_SUFFIX
+		self.fsync_every = fsync_every
+		self.compact_every = compact_every
+
+		self._journal = None
+		self._unsynced_records = 0
+		self._journal_records = 0
+
+		try:
+			with file(self.filename, 'r') as db_file:
+				self._filedata = json.load(db_file)
+		except IOError: # we do not have database file yet
+			self._filedata = {'files': [], 'pending_jobs': []}
+
+		if self._filedata.get('pending_jobs') == None:
+			self._filedata['pending_jobs'] = []
+
+		# [uploaded_at, uuid, path] lists kept sorted, so due deletes are always at the front
+		if self._filedata.get('delete_queue') == None:
+			self._filedata['delete_queue'] = []
+
+		# chunk index, sha256: [archive uuid, offset, length, codec, files referring to it], and chunk count of each archive
+		if self._filedata.get('chunks') == None:
+			self._filedata['chunks'] = {}
+			self._filedata['chunk_archives'] = {}
+
+		# [id, taken_at] of snapshots, oldest first, and entries of old versions they still need
+		if self._filedata.get('snapshots') == None:
+			self._filedata['snapshots'] = []
+			self._filedata['versions'] = []
+
+		self._replay_journal()
+
+	def _replay_journal(self):
+		try:
+			journal = file(self.journal_filename, 'r+')
+		except IOError: # no journal, snapshot is all we have
+			return
+
+		with journal:
+			good_offset = 0
+
+			for line in iter(journal.readline, ''):
+				try:
+					record = json.loads(line)
+				except ValueError: # torn write at the end of journal, drop it
+					break
+
+				if not line.endswith('\n'):
+					break
+
+				good_offset += len(line)
+
+				# records already folded into snapshot (crash between snapshot and journal truncate)
+				if record['seq'] <= self._filedata.get('sequence', 0):
+					continue
+
+				self._apply(record)
+				self._journal_records += 1
+
+			journal.truncate(good_offset)
+
+	def _apply(self, record):
+		operation = record['op']
+
+		if operation == 'add_file':
+			self._filedata['files'].append(record['entry'])
+		elif operation == 'delete_file':
+			path = record.get('path') # set for members of packed archives only
+
+			for store in ('files', 'versions'):
+				self._filedata[store] = [entry for entry in self._filedata[store] if entry['uuid'] != record['uuid'] or (path is not None and entry['path'] != path)]
+		elif operation == 'retire_file':
+			path = record.get('path')
+			files = []
+
+			for entry in self._filedata['files']:
+				if entry['uuid'] == record['uuid'] and (path is None or entry['path'] == path):
+					entry['retired'] = record['retired']
+					self._filedata['versions'].append(entry)
+				else:
+					files.append(entry)
+
+			self._filedata['files'] = files
+		elif operation == 'merge_files':
+			deleted = set((uuid, path) for uuid, path in record['deletes'])
+			updated = dict(((entry['uuid'], entry['path']), entry) for entry in record['updates'])
+
+			if deleted or updated:
+				self._filedata['files'] = [updated.get((entry['uuid'], entry['path']), entry) for entry in self._filedata['files'] if (entry['uuid'], entry['path']) not in deleted]
+
+			self._filedata['files'].extend(record['inserts'])
+		elif operation == 'add_snapshot':
+			self._filedata['snapshots'].append([record['id'], record['taken_at']])
+		elif operation == 'drop_snapshot':
+			self._filedata['snapshots'] = [snapshot for snapshot in self._filedata['snapshots'] if snapshot[0] != record['id']]
+		elif operation == 'add_pending_job':
+			self._filedata['pending_jobs'].append(record['entry'])
+		elif operation == 'delete_pending_job':
+			self._filedata['pending_jobs'] = [entry for entry in self._filedata['pending_jobs'] if entry['uuid'] != record['uuid']]
+		elif operation == 'add_job_part':
+			for entry in self._filedata['pending_jobs']:
+				if entry['uuid'] == record['uuid']:
+					entry['parts'][str(record['index'])] = record['tree_hash']
+		elif operation == 'queue_delete':
+			bisect.insort(self._filedata['delete_queue'], record['entry'])
+		elif operation == 'dequeue_delete':
+			queue = self._filedata['delete_queue']
+			index = bisect.bisect_left(queue, record['key'])
+
+			if index < len(queue) and queue[index][:2] == record['key']:
+				del queue[index]
+		elif operation == 'add_chunks':
+			chunks, chunk_archives = self._filedata['chunks'], self._filedata['chunk_archives']
+
+			for chunk_hash, offset, length in record['chunks']:
+				if chunk_hash not in chunks:
+					chunks[chunk_hash] = [record['uuid'], offset, length, record['codec'], 0]
+					chunk_archives[record['uuid']] = chunk_archives.get(record['uuid'], 0) + 1
+		elif operation == 'retain_chunks':
+			for chunk_hash in record['hashes']:
+				self._filedata['chunks'][chunk_hash][4] += 1
+		elif operation == 'release_chunks':
+			chunks, chunk_archives = self._filedata['chunks'], self._filedata['chunk_archives']
+
+			for chunk_hash in record['hashes']:
+				chunk = chunks.get(chunk_hash)
+
+				if chunk is None:
+					continue
+
+				chunk[4] -= 1
+
+				if chunk[4] <= 0: # no file needs it
+					del chunks[chunk_hash]
+					chunk_archives[chunk[0]] -= 1
+
+					if not chunk_archives[chunk[0]]:
+						del chunk_archives[chunk[0]]
+
+		self._filedata['sequence'] = record['seq']
+
+	def _log(self, operation, **record):
+		record['op'] = operation
+		record['seq'] = self._filedata.get('sequence', 0) + 1
+
+		self._apply(record)
+
+		if self._journal is None:
+			self._journal = file(self.journal_filename, 'a')
+
+		self._journal.write(json.dumps(record) + '\n')
+		self._journal.flush()
+		METRICS.count('db_records')
+
+		self._unsynced_records += 1
+		self._journal_records += 1
+
+		if self._journal_records >= self.compact_every:
+			self.write()
+		elif self._unsynced_records >= self.fsync_every:
+			self.sync()
+
+	@property
+	def files(self):
+		for curr_file in self._filedata['files']:
+			yield RemoteFile(curr_file)
+
+	@property
+	def pending_jobs(self):
+		for entry in self._filedata['pending_jobs']:
+			yield self._job_from_entry(entry)
+
+	def sync(self):
+		''' Makes sure every journal record written so far is on disk '''
+		if self._journal is not None and self._unsynced_records:
+			with METRICS.timed('db_fsync'):
+				self._journal.flush()
+				os.fsync(self._journal.fileno())
+
+		self._unsynced_records = 0
+
+	def write(self):
+		''' Compacts journal into a new snapshot '''
+		temp_filename = self.filename + '.tmp'
+
+		with METRICS.timed('db_write'), file(temp_filename, 'w') as db_file:
+			json.dump(self._filedata, db_file)
+			db_file.flush()
+			os.fsync(db_file.fileno())
+
+		os.rename(temp_filename, self.filename)
+
+		# snapshot has everything, journal records are now redundant
+		if self._journal is not None:
+			self._journal.close()
+			self._journal = None
+
+		if os.path.exists(self.journal_filename):
+			os.unlink(self.journal_filename)
+
+		self._unsynced_records = 0
+		self._journal_records = 0
+
+	def close(self):
+		self.sync()
+
+		if self._journal is not None:
+			self._journal.close()
+			self._journal = None
+
+	def add_file(self, local_file, uuid, member=None):
+		self._log('add_file', entry=self._file_entry(local_file, uuid, member, self._current_generation()))
+
+	def restore_from_amazon(self, amazon_data, progress=None, batch_size=10000):
+		self._filedata['files'] = []
+		# old versions kept for snapshots are in inventory too, but they aren't current
+		queued_uuids = set(uuid for uploaded_at, uuid, path in self._filedata['delete_queue'])
+		queued_uuids.update(entry['uuid'] for entry in self._filedata['versions'])
+
+		for batch in self._archive_entries(amazon_data, progress, batch_size):
+			# archives waiting for deletion are still in inventory, but their files are gone
+			self._filedata['files'].extend(entry for entry in batch if entry['uuid'] not in queued_uuids)
+
+		# chunks stay known, so next sync sends only what isn't in vault, but no file refers to them now
+		for chunk in self._filedata['chunks'].itervalues():
+			chunk[4] = 0
+
+		self.write()
+
+	def delete_file(self, remote_file):
+		if getattr(remote_file, 'offset', None) is None:
+			self._log('delete_file', uuid=remote_file.uuid)
+		else: # other files live in the same archive
+			self._log('delete_file', uuid=remote_file.uuid, path=remote_file.path)
+
+	def _merge_entries(self):
+		for entry in self._filedata['files']:
+			yield [entry['uuid'], entry]
+
+		known = set(uuid for uploaded_at, uuid, path in self._filedata['delete_queue'])
+		known.update(entry['uuid'] for entry in self._filedata['versions'])
+		known.update(self._filedata['chunk_archives'])
+
+		for uuid in known:
+			yield [uuid, None]
+
+	def _merge_changes(self, inserts, deletes, updates):
+		if inserts or deletes or updates:
+			self._log('merge_files', inserts=inserts, deletes=[[entry['uuid'], entry['path']] for entry in deletes], updates=updates)
+
+	def retire_file(self, remote_file):
+		''' Moves current entry to old versions, where snapshots taken so far still see it '''
+		if remote_file.offset is None:
+			self._log('retire_file', uuid=remote_file.uuid, retired=self.generation)
+		else:
+			self._log('retire_file', uuid=remote_file.uuid, path=remote_file.path, retired=self.generation)
+
+	@property
+	def versions(self):
+		for entry in self._filedata['versions']:
+			yield RemoteFile(entry)
+
+	def snapshot_files(self, snapshot):
+		for store in ('files', 'versions'):
+			for entry in self._filedata[store]:
+				if self._in_snapshot(entry, snapshot):
+					yield RemoteFile(entry)
+
+	@property
+	def snapshots(self):
+		''' (id, taken_at) of every snapshot, oldest first '''
+		return [tuple(snapshot) for snapshot in self._filedata['snapshots']]
+
+	def add_snapshot(self, taken_at):
+		''' Snapshot of catalogue as it is now, costs nothing but one record. Returns its id '''
+		snapshot = self.generation
+		self._log('add_snapshot', id=snapshot, taken_at=taken_at)
+
+		return snapshot
+
+	def drop_snapshot(self, snapshot):
+		self._log('drop_snapshot', id=snapshot)
+
+	def count_archive_members(self, uuid):
+		return sum(1 for store in ('files', 'versions') for entry in self._filedata[store] if entry['uuid'] == uuid)
+
+	def add_pending_job(self, job):
+		self._log('add_pending_job', entry=self._job_entry(job))
+
+	def delete_pending_job(self, job):
+		self._log('delete_pending_job', uuid=job.uuid)
+
+	def add_job_part(self, job, index, part_tree_hash):
+		self._log('add_job_part', uuid=job.uuid, index=index, tree_hash=part_tree_hash)
+
+	def queue_delete(self, remote_file):
+		self._log('queue_delete', entry=[remote_file.uploaded_at_epoch or 0, remote_file.uuid, remote_file.path])
+
+	def due_deletes(self, uploaded_before=None):
+		''' Queued deletes of archives uploaded at or before uploaded_before (all when None), oldest first '''
+		queue = self._filedata['delete_queue']
+		end = len(queue) if uploaded_before is None else bisect.bisect_left(queue, [uploaded_before + 1])
+
+		# copy, so entries can be dequeued while caller goes through them
+		for uploaded_at, uuid, path in queue[:end]:
+			yield QueuedDelete({'uuid': uuid, 'path': path, 'uploaded_at': uploaded_at})
+
+	def dequeue_delete(self, queued_delete):
+		self._log('dequeue_delete', key=[queued_delete.uploaded_at, queued_delete.uuid])
+
+	def count_queued_deletes(self):
+		return len(self._filedata['delete_queue'])
+
+	@property
+	def chunks(self):
+		''' [sha256, uuid, offset, length, codec, refs] of every chunk in index '''
+		for chunk_hash, chunk in self._filedata['chunks'].iteritems():
+			yield [chunk_hash] + chunk
+
+	def chunk_locations(self, hashes):
+		''' {sha256: (uuid, offset, length, codec)} of those chunks which are in index '''
+		chunks = self._filedata['chunks']
+
+		return dict((chunk_hash, tuple(chunks[chunk_hash][:4])) for chunk_hash in hashes if chunk_hash in chunks)
+
+	def add_chunks(self, uuid, chunks, codec=None):
+		''' Indexes [sha256, offset, length] chunks of archive uuid, chunks already in index keep their place '''
+		self._log('add_chunks', uuid=uuid, chunks=chunks, codec=codec)
+
+	def retain_chunks(self, hashes):
+		''' One more file refers to each of chunks (once per occurrence) '''
+		self._log('retain_chunks', hashes=hashes)
+
+	def release_chunks(self, hashes):
+		''' Drops references retain_chunks made, returns uuids of archives none of whose chunks is referred to any more '''
+		chunks = self._filedata['chunks']
+		uuids = set(chunks[chunk_hash][0] for chunk_hash in hashes if chunk_hash in chunks)
+
+		self._log('release_chunks', hashes=hashes)
+
+		return sorted(uuid for uuid in uuids if uuid not in self._filedata['chunk_archives'])
+
+class GlacierLocalDatabaseSqlite(GlacierLocalDatabase):
+	'''
+	Catalogue stored in SQLite, indexed by path and archive uuid.
+
+	Catalogue entries are kept as JSON next to the indexed columns, so they carry the same
+	fields as in GlacierLocalDatabaseFile. Mutations are committed every commit_every changes
+	and on write()/close().
+	'''
+	SCHEMA = (
+		'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT NOT NULL, uuid TEXT NOT NULL, entry TEXT NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS files_path ON files (path)',
+		'CREATE INDEX IF NOT EXISTS files_uuid ON files (uuid)',
+		'CREATE TABLE IF NOT EXISTS pending_jobs (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL, entry TEXT NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS pending_jobs_uuid ON pending_jobs (uuid)',
+		'CREATE TABLE IF NOT EXISTS job_parts (job_uuid TEXT NOT NULL, part INTEGER NOT NULL, tree_hash TEXT NOT NULL, PRIMARY KEY (job_uuid, part))',
+		'CREATE TABLE IF NOT EXISTS delete_queue (uuid TEXT PRIMARY KEY, path TEXT NOT NULL, uploaded_at INTEGER NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS delete_queue_uploaded_at ON delete_queue (uploaded_at, uuid)',
+		'CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, uuid TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, codec TEXT, refs INTEGER NOT NULL DEFAULT 0)',
+		'CREATE INDEX IF NOT EXISTS chunks_uuid ON chunks (uuid)',
+		'CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, path TEXT NOT NULL, uuid TEXT NOT NULL, entry TEXT NOT NULL)',
+		'CREATE INDEX IF NOT EXISTS versions_uuid ON versions (uuid)',
+		'CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, taken_at INTEGER NOT NULL)',
+	)
+	# SQLite allows 999 parameters per statement
+	HASHES_PER_QUERY = 500
+
+	def __init__(self, filename, commit_every=1000):
+		super(GlacierLocalDatabaseSqlite, self).__init__()
+		self.filename = filename
+		self.commit_every = commit_every
+
+		self._uncommitted = 0
+		self._connection = sqlite3.connect(self.filename)
+
+		for statement in self.SCHEMA:
+			self._connection.execute(statement)
+		self._connection.commit()
+
+		self._snapshots = self._connection.execute('SELECT id, taken_at FROM snapshots ORDER BY id').fetchall()
+
+	def _changed(self, count=1):
+		self._uncommitted += count
+		METRICS.count('db_records', count)
+
+		if self._uncommitted >= self.commit_every:
+			self.write()
+
+	@property
+	def files(self):
+		for (entry, ) in self._connection.execute('SELECT entry FROM files ORDER BY id'):
+			yield RemoteFile(json.loads(entry))
+
+	@property
+	def pending_jobs(self):
+		for (entry, ) in self._connection.execute('SELECT entry FROM pending_jobs ORDER BY id').fetchall():
+			entry = json.loads(entry)
+
+			# parts live in their own table, rewriting whole entry for every part would be quadratic
+			for part, part_tree_hash in self._connection.execute('SELECT part, tree_hash FROM job_parts WHERE job_uuid = ?', (entry['uuid'], )):
+				entry['parts'][str(part)] = part_tree_hash
+
+			yield self._job_from_entry(entry)
+
+	def write(self):
+		with METRICS.timed('db_write'):
+			self._connection.commit()
+
+		self._uncommitted = 0
+
+	def close(self):
+		self.write()
+
+	def _insert_files(self, entries, table='files'):
+		self._connection.executemany('INSERT INTO %s (path, uuid, entry) VALUES (?, ?, ?)' % table,
+			((entry['path'], entry['uuid'], json.dumps(entry)) for entry in entries))
+
+	def add_file(self, local_file, uuid, member=None):
+		self._insert_files([self._file_entry(local_file, uuid, member, self._current_generation())])
+
+		self._changed()
+
+	def restore_from_amazon(self, amazon_data, progress=None, batch_size=10000):
+		self._connection.execute('DELETE FROM files')
+
+		for batch in self._archive_entries(amazon_data, progress, batch_size):
+			self._insert_files(batch)
+
+		# archives waiting for deletion are still in inventory, but their files are gone
+		self._connection.execute('DELETE FROM files WHERE uuid IN (SELECT uuid FROM delete_queue)')
+		# so are old versions kept for snapshots, which aren't current
+		self._connection.execute('DELETE FROM files WHERE uuid IN (SELECT uuid FROM versions)')
+
+		# chunks stay known, so next sync sends only what isn't in vault, but no file refers to them now
+		self._connection.execute('UPDATE chunks SET refs = 0')
+
+		self.write()
+
+	def delete_file(self, remote_file):
+		for table in ('files', 'versions'):
+			if getattr(remote_file, 'offset', None) is None:
+				self._connection.execute('DELETE FROM %s WHERE uuid = ?' % table, (remote_file.uuid, ))
+			else: # other files live in the same archive
+				self._connection.execute('DELETE FROM %s WHERE uuid = ? AND path = ?' % table, (remote_file.uuid, remote_file.path))
+
+		self._changed()
+
+	def _merge_entries(self):
+		for uuid, entry in self._connection.execute('SELECT uuid, entry FROM files'):
+			yield [uuid, json.loads(entry)]
+
+		for (uuid, ) in self._connection.execute('SELECT uuid FROM delete_queue UNION SELECT uuid FROM versions UNION SELECT DISTINCT uuid FROM chunks'):
+			yield [uuid, None]
+
+	def _merge_changes(self, inserts, deletes, updates):
+		self._insert_files(inserts)
+		self._connection.executemany('DELETE FROM files WHERE uuid = ? AND path = ?', ((entry['uuid'], entry['path']) for entry in deletes))
+		self._connection.executemany('UPDATE files SET entry = ? WHERE uuid = ? AND path = ?', ((json.dumps(entry), entry['uuid'], entry['path']) for entry in updates))
+
+		self._changed(len(inserts) + len(deletes) + len(updates))
+
+	def retire_file(self, remote_file):
+		''' Moves current entry to old versions, where snapshots taken so far still see it '''
+		condition, parameters = 'uuid = ?', (remote_file.uuid, )
+		if remote_file.offset is not None:
+			condition, parameters = 'uuid = ? AND path = ?', (remote_file.uuid, remote_file.path)
+
+		entries = [json.loads(entry) for (entry, ) in self._connection.execute('SELECT entry FROM files WHERE %s' % condition, parameters)]
+
+		for entry in entries:
+			entry['retired'] = self.generation
+
+		self._insert_files(entries, 'versions')
+		self._connection.execute('DELETE FROM files WHERE %s' % condition, parameters)
+
+		self._changed()
+
+	@property
+	def versions(self):
+		for (entry, ) in self._connection.execute('SELECT entry FROM versions ORDER BY id'):
+			yield RemoteFile(json.loads(entry))
+
+	def snapshot_files(self, snapshot):
+		for table in ('files', 'versions'):
+			for (entry, ) in self._connection.execute('SELECT entry FROM %s ORDER BY id' % table):
+				entry = json.loads(entry)
+
+				if self._in_snapshot(entry, snapshot):
+					yield RemoteFile(entry)
+
+	@property
+	def snapshots(self):
+		''' (id, taken_at) of every snapshot, oldest first '''
+		return list(self._snapshots)
+
+	def add_snapshot(self, taken_at):
+		''' Snapshot of catalogue as it is now, costs nothing but one row. Returns its id '''
+		snapshot = self.generation
+		self._connection.execute('INSERT INTO snapshots (id, taken_at) VALUES (?, ?)', (snapshot, taken_at))
+		self._snapshots.append((snapshot, taken_at))
+
+		self._changed()
+
+		return snapshot
+
+	def drop_snapshot(self, snapshot):
+		self._connection.execute('DELETE FROM snapshots WHERE id = ?', (snapshot, ))
+		self._snapshots = [(snapshot_id, taken_at) for snapshot_id, taken_at in self._snapshots if snapshot_id != snapshot]
+
+		self._changed()
+
+	def count_archive_members(self, uuid):
+		return sum(self._connection.execute('SELECT COUNT(*) FROM %s WHERE uuid = ?' % table, (uuid, )).fetchone()[0] for table in ('files', 'versions'))
+
+	def add_pending_job(self, job):
+		self._connection.execute('INSERT INTO pending_jobs (uuid, entry) VALUES (?, ?)', (job.uuid, json.dumps(self._job_entry(job))))
+
+		self._changed()
+
+	def delete_pending_job(self, job):
+		self._connection.execute('DELETE FROM pending_jobs WHERE uuid = ?', (job.uuid, ))
+		self._connection.execute('DELETE FROM job_parts WHERE job_uuid = ?', (job.uuid, ))
+
+		self._changed()
+
+	def add_job_part(self, job, index, part_tree_hash):
+		self._connection.execute('INSERT OR REPLACE INTO job_parts (job_uuid, part, tree_hash) VALUES (?, ?, ?)', (job.uuid, index, part_tree_hash))
+
+		self._changed()
+
+	def queue_delete(self, remote_file):
+		self._connection.execute('INSERT OR REPLACE INTO delete_queue (uuid, path, uploaded_at) VALUES (?, ?, ?)', (remote_file.uuid, remote_file.path, remote_file.uploaded_at_epoch or 0))
+
+		self._changed()
+
+	def due_deletes(self, uploaded_before=None, page_size=1000):
+		''' Queued deletes of archives uploaded at or before uploaded_before (all when None), oldest first '''
+		if uploaded_before is None:
+			uploaded_before = sys.maxint
+
+		# read page by page from where previous one ended, entries may be dequeued in between
+		last = (-sys.maxint - 1, '')
+
+		while True:
+			page = self._connection.execute('SELECT uploaded_at, uuid, path FROM delete_queue WHERE uploaded_at <= ? AND (uploaded_at > ? OR (uploaded_at = ? AND uuid > ?)) ORDER BY uploaded_at, uuid LIMIT ?',
+				(uploaded_before, last[0], last[0], last[1], page_size)).fetchall()
+
+			for uploaded_at, uuid, path in page:
+				yield QueuedDelete({'uuid': uuid, 'path': path, 'uploaded_at': uploaded_at})
+
+			if len(page) < page_size:
+				return
+
+			last = page[-1][:2]
+
+	def dequeue_delete(self, queued_delete):
+		self._connection.execute('DELETE FROM delete_queue WHERE uuid = ?', (queued_delete.uuid, ))
+
+		self._changed()
+
+	def count_queued_deletes(self):
+		return self._connection.execute('SELECT COUNT(*) FROM delete_queue').fetchone()[0]
+
+	@property
+	def chunks(self):
+		''' [sha256, uuid, offset, length, codec, refs] of every chunk in index '''
+		for row in self._connection.execute('SELECT hash, uuid, offset, length, codec, refs FROM chunks'):
+			yield list(row)
+
+	def _select_chunks(self, columns, hashes, condition=''):
+		for batch in batches(set(hashes), self.HASHES_PER_QUERY):
+			for row in self._connection.execute('SELECT %s FROM chunks WHERE hash IN (%s)%s' % (columns, ', '.join('?' * len(batch)), condition), batch).fetchall():
+				yield row
+
+	def chunk_locations(self, hashes):
+		''' {sha256: (uuid, offset, length, codec)} of those chunks which are in index '''
+		return dict((row[0], row[1:]) for row in self._select_chunks('hash, uuid, offset, length, codec', hashes))
+
+	def add_chunks(self, uuid, chunks, codec=None):
+		''' Indexes [sha256, offset, length] chunks of archive uuid, chunks already in index keep their place '''
+		self._connection.executemany('INSERT OR IGNORE INTO chunks (hash, uuid, offset, length, codec) VALUES (?, ?, ?, ?, ?)',
+			((chunk_hash, uuid, offset, length, codec) for chunk_hash, offset, length in chunks))
+
+		self._changed(len(chunks))
+
+	def retain_chunks(self, hashes):
+		''' One more file refers to each of chunks (once per occurrence) '''
+		self._connection.executemany('UPDATE chunks SET refs = refs + 1 WHERE hash = ?', ((chunk_hash, ) for chunk_hash in hashes))
+
+		self._changed(len(hashes))
+
+	def release_chunks(self, hashes):
+		''' Drops references retain_chunks made, returns uuids of archives none of whose chunks is referred to any more '''
+		self._connection.executemany('UPDATE chunks SET refs = refs - 1 WHERE hash = ?', ((chunk_hash, ) for chunk_hash in hashes))
+
+		unreferenced = list(self._select_chunks('hash, uuid', hashes, ' AND refs <= 0'))
+		self._connection.executemany('DELETE FROM chunks WHERE hash = ?', ((chunk_hash, ) for chunk_hash, uuid in unreferenced))
+
+		self._changed(len(hashes))
+
+		return sorted(uuid for uuid in set(uuid for chunk_hash, uuid in unreferenced)
+			if not self._connection.execute('SELECT COUNT(*) FROM chunks WHERE uuid = ?', (uuid, )).fetchone()[0])
+
+	def sync(self):
+		''' Same as write(), there is no journal '''
+		self.write()
+
+	def migrate_from(self, other_database):
+		'''
+		One-shot import of files, pending jobs, queued deletes, chunk index and snapshots from another
+		catalogue (e.g. legacy JSON one). Raises ValueError when this one isn't empty, importing twice
+		would duplicate everything.
+		'''
+		for table in ('files', 'pending_jobs', 'delete_queue', 'chunks', 'versions', 'snapshots'):
+			if self._connection.execute('SELECT 1 FROM %s LIMIT 1' % table).fetchone() is not None:
+				raise ValueError('Catalogue %s is not empty (%s), migrate into a new one' % (self.filename, table))
+
+		self._insert_files(remote_file.file_json_data for remote_file in other_database.files)
+
+		for job in other_database.pending_jobs:
+			self._connection.execute('INSERT INTO pending_jobs (uuid, entry) VALUES (?, ?)', (job.uuid, json.dumps(self._job_entry(job))))
+
+		self._connection.executemany('INSERT OR REPLACE INTO delete_queue (uuid, path, uploaded_at) VALUES (?, ?, ?)',
+			((queued_delete.uuid, queued_delete.path, queued_delete.uploaded_at) for queued_delete in other_database.due_deletes()))
+
+		self._connection.executemany('INSERT OR REPLACE INTO chunks (hash, uuid, offset, length, codec, refs) VALUES (?, ?, ?, ?, ?, ?)', other_database.chunks)
+
+		self._insert_files((remote_file.file_json_data for remote_file in other_database.versions), 'versions')
+		self._connection.executemany('INSERT OR REPLACE INTO snapshots (id, taken_at) VALUES (?, ?)', other_database.snapshots)
+		self._snapshots = self._connection.execute('SELECT id, taken_at FROM snapshots ORDER BY id').fetchall()
+
+		self.write()
+
+SQLITE_DATABASE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+
+def open_local_database(filename):
+	''' Picks catalogue backend from database file name '''
+	if filename.endswith(SQLITE_DATABASE_EXTENSIONS):
+		return GlacierLocalDatabaseSqlite(filename)
+
+	return GlacierLocalDatabaseFile(filename)
+
+class PendingJob(object):
+	def __init__(self, uuid_or_jsondata):
+		super(PendingJob, self).__init__()
+
+		if isinstance(uuid_or_jsondata, dict):
+			self.__dict__.update(uuid_or_jsondata)
+		else:
+			self.uuid = uuid_or_jsondata
+
+	def to_JSON(self):
+		return json.dumps(self, default=lambda o: o.__dict__)
+
+	def __hash__(self):
+		return hash(self.uuid)
+
+	def __eq__(self, other):
+		return self.uuid == other.uuid
+
+class RetreiveInvetoryJob(PendingJob):
+	pass
+
+class RetreiveArchiveJob(PendingJob):
+	pass
+
+class MultipartUploadJob(PendingJob):
+	'''
+	Upload in progress; parts maps part index (string, as JSON keys are) to its tree hash. Parts of
+	file sent through codec (its name) go one after another, their count is known once it is encoded.
+	'''
+	codec = None
+	encoded_size = None
+
+	@property
+	def archive_size(self):
+		return self.size if self.codec is None else self.encoded_size
+
+	@property
+	def part_count(self):
+		return max(1, -(-self.archive_size // self.part_size))
+
+	@property
+	def missing_parts(self):
+		return [index for index in xrange(self.part_count) if str(index) not in self.parts]
+
+	def matches(self, local_file):
+		''' False when file has changed since upload started '''
+		if getattr(self, 'mtime_ns', None) is None: # started by version which didn't store it
+			return self.size == local_file.size and self.last_modified == timegm(local_file.last_modified.timetuple())
+
+		return self.size == local_file.size and self.mtime_ns == local_file.mtime_ns
+
+class QueuedDelete(PendingJob):
+	''' Archive (uuid, path of its last file, uploaded_at) waiting for minimum storage duration to pass before it is deleted '''
+	pass
+
+class GlacierSync(object):
+	def __init__(self, aws, database, delayed_delete, dirs_to_sync, print_status=False, transfer_concurrency=1, include=None, exclude=None, scan_threads=1, scan_cache=None, trust_directory_mtime=False, content_hash=False, pack_files_below=0, pack_size=64 * MEGABYTE, restore_batch_size=1000, mtime_tolerance=0, multipart_threshold=100 * MEGABYTE, bytes_per_second=0, requests_per_second=0, throttle_schedule=(), transfer_engine='layer2', min_storage_days=90, delete_batch_size=1000, metrics_file=None, prometheus_file=None, compression=None, encryption_key=None, cpu_processes=0, cpu_pool=None, dedup=False, dedup_min_size=16 * MEGABYTE, dedup_chunk_size=DEDUP_CHUNK_SIZE, keep_versions_days=0, connection=None, vault=None):
+		super(GlacierSync, self).__init__()
+
+		if transfer_engine not in TRANSFER_ENGINES:
+			raise ValueError('Unknown transfer_engine %s, use one of: %s' % (transfer_engine, ', '.join(sorted(TRANSFER_ENGINES))))
+
+		self.aws = aws
+		self.delayed_delete = delayed_delete
+
+		self._database = open_local_database(database)
+		self._chunk_cache = database + '.chunks' # chunk archives restore downloads
+
+		if vault is None:
+			# connection (and its HTTP connection pool) may be shared with other GlacierSyncs of the same account
+			self._aws_connection = connection or Layer2(aws_access_key_id=self.aws['access_key'], aws_secret_access_key=self.aws['secret_key'], region_name=self.aws['region'])
+			vault = self._aws_connection.get_vault(self.aws['vault_name'])
+		self._vault = vault
+
+		self._scan_cache = None
+		if scan_cache is not None:
+			self._scan_cache = ScanCache(scan_cache, signature={'dirs': dirs_to_sync, 'include': include, 'exclude': exclude})
+
+		self._local_filesystem = LocalFilesystem(*dirs_to_sync, include=include, exclude=exclude, scan_threads=scan_threads,
+			scan_cache=self._scan_cache, trust_directory_mtime=trust_directory_mtime)
+		# forked here, before any of our threads run; pool may be shared with other GlacierSyncs too
+		self._owns_cpu_pool = cpu_pool is None and cpu_processes > 0
+		self._cpu_pool = CpuPool(cpu_processes) if self._owns_cpu_pool else cpu_pool
+
+		self._throttle = Throttle(bytes_per_second, requests_per_second, throttle_schedule)
+		self._remote_filesystem = RemoteFilesystem(self._database, MeteredEngine(TRANSFER_ENGINES[transfer_engine](self._vault)), store_tree_hash=content_hash, throttle=self._throttle,
+			compression=compression, encryption_key=encryption_key, cpu_pool=self._cpu_pool, dedup_chunk_size=dedup_chunk_size)
+		self._differs = [partial(ContentHashDiffer if content_hash else LastModifiedDiffer, tolerance=mtime_tolerance)]
+
+		self.print_status = print_status
+		self.transfer_concurrency = transfer_concurrency
+		self.pack_files_below = pack_files_below
+		self.pack_size = pack_size
+		self.restore_batch_size = restore_batch_size
+		self.multipart_threshold = multipart_threshold
+		self.min_storage_seconds = min_storage_days * 24 * 3600
+		self.delete_batch_size = delete_batch_size
+		self.metrics_file = metrics_file
+		self.prometheus_file = prometheus_file
+		self.dedup = dedup
+		self.dedup_min_size = dedup_min_size
+		self.keep_versions_seconds = keep_versions_days * 24 * 3600
+
+	def close(self):
+		self._database.close()
+
+		if self._owns_cpu_pool:
+			self._cpu_pool.close()
+
+	def _filesystem_differences(self, differs=None):
+		differ_runner = DifferRunner(self._local_filesystem, self._remote_filesystem, self._differs if differs is None else differs, self._scan_cache, self._cpu_pool)
+		
+		differences = differ_runner.differences
+
+		return differences
+
+	def _report_transfer(self, task):
+		if not self.print_status:
+			return
+
+		if task.succeeded:
+			print 'Done: %s [%.1f KiB/s]' % (task.description, self._throttle.throughput / 1024)
+		else:
+			print >> sys.stderr, 'Failed: %s (%s)' % (task.description, task.error)
+
+	def _planned_differences(self, plan):
+		'''
+		Differences plan (lines written by plan()) was made of, checked against catalogue and files
+		as they are now: planned files are stat'ed again, and entries whose file is gone, whose
+		catalogue entry is gone (plan already executed?) or whose path got uploaded since are skipped.
+		'''
+		differences = {'new_files': set([]), 'deleted_files': set([]), 'modified_files': set([])}
+
+		with METRICS.timed('catalogue_read'):
+			catalogue = set((remote_file.uuid, remote_file.path) for remote_file in self._database.files)
+			catalogued_paths = set(path for uuid, path in catalogue)
+
+		def skip(record, reason):
+			METRICS.count('plan_entries_skipped')
+
+			if self.print_status:
+				print 'Skipping planned %s of %s, %s' % (record['action'], record['path'], reason)
+
+		for line in plan:
+			record = json.loads(line)
+			action = record['action']
+
+			if action not in ('upload', 'update', 'delete'):
+				continue
+
+			entry = record['entry'] if action == 'delete' else record.get('replaces')
+
+			if entry is not None and (entry['uuid'], entry['path']) not in catalogue:
+				skip(record, 'its catalogue entry is gone')
+				continue
+
+			if action == 'delete':
+				differences['deleted_files'].add(RemoteFile(entry))
+				continue
+
+			if action == 'upload' and record['path'] in catalogued_paths:
+				skip(record, 'it is in catalogue already')
+				continue
+
+			try:
+				local_file = LocalFile(record['path']) # size may have changed since
+			except OSError:
+				skip(record, 'file is gone')
+				continue
+
+			if action == 'upload':
+				differences['new_files'].add(local_file)
+			else:
+				differences['modified_files'].add((local_file, RemoteFile(entry)))
+
+		return differences
+
+	def _upload_requests(self, size):
+		if size < self.pack_files_below: # pack is shared, plan() counts it once
+			return 0
+
+		if self.multipart_threshold and size >= self.multipart_threshold:
+			return 2 + -(-size // multipart_part_size(size, self._remote_filesystem.min_part_size))
+
+		part_size = self._remote_filesystem.throttled_part_size(size)
+		if part_size is not None:
+			return 2 + -(-size // part_size)
+
+		return self._remote_filesystem.engine.create_archive_requests(size)
+
+	def _estimated_seconds(self, size, requests):
+		bytes_per_second = self._throttle.bytes_per_second or PLAN_BYTES_PER_SECOND
+		requests_per_second = self._throttle.requests_per_second or PLAN_REQUESTS_PER_SECOND
+
+		return round(size / float(bytes_per_second) + requests / float(requests_per_second), 3)
+
+	def plan(self, output):
+		'''
+		Writes what sync would do to output as JSON lines, one per file with its action (upload,
+		update or delete), size, and estimated request count and transfer time. Last line sums it
+		all up (packs and emptied packed archives only show there) and is returned as a dict.
+		Nothing is transferred; sync(plan) executes the plan later without scanning again.
+		'''
+		differences = self._filesystem_differences()
+
+		summary = {'action': 'summary', 'uploads': 0, 'updates': 0, 'deletes': 0, 'bytes': 0, 'requests': 0}
+		packed_bytes = 0
+		released = {} # packed archive uuid: members going away
+
+		def release(remote_file):
+			if remote_file.offset is None:
+				return 1
+
+			released[remote_file.uuid] = released.get(remote_file.uuid, 0) + 1
+			return 0
+
+		def write(record, size, transferred, requests):
+			record.update({'size': size, 'requests': requests, 'seconds': self._estimated_seconds(transferred, requests)})
+			output.write(json.dumps(record) + '\n')
+
+			summary['bytes'] += transferred
+			summary['requests'] += requests
+
+		for local_file in differences['new_files']:
+			summary['uploads'] += 1
+			write({'action': 'upload', 'path': local_file.path, 'mtime': local_file.mtime, 'inode': local_file.inode},
+				local_file.size, local_file.size, self._upload_requests(local_file.size))
+
+		for local_file, remote_file in differences['modified_files']:
+			summary['updates'] += 1
+			write({'action': 'update', 'path': local_file.path, 'mtime': local_file.mtime, 'inode': local_file.inode, 'replaces': remote_file.file_json_data},
+				local_file.size, local_file.size, self._upload_requests(local_file.size) + release(remote_file))
+
+		for remote_file in differences['deleted_files']:
+			summary['deletes'] += 1
+			write({'action': 'delete', 'path': remote_file.path, 'entry': remote_file.file_json_data}, remote_file.size, 0, release(remote_file))
+
+		for local_file in differences['new_files'] | set(local_file for local_file, remote_file in differences['modified_files']):
+			if local_file.size < self.pack_files_below:
+				packed_bytes += local_file.size
+
+		packs = -(-packed_bytes // self.pack_size)
+		summary['requests'] += packs * self._remote_filesystem.engine.create_archive_requests(self.pack_size)
+		summary['requests'] += sum(1 for uuid, count in released.items() if count >= self._database.count_archive_members(uuid))
+		summary['seconds'] = self._estimated_seconds(summary['bytes'], summary['requests'])
 
-	def __gt__(self, other):
-		return self.last_modified > other.last_modified
+		output.write(json.dumps(summary) + '\n')
 
-	def __hash__(self):
-		return hash(self.path)
+		return summary
 
-	def __eq__(self, other):
-		return self.path == other.path
+	def _scheduler(self, shared=None):
+		''' New TransferScheduler, or shared one (of SyncDaemon) reporting to us for this run '''
+		if shared is None:
+			return TransferScheduler(self.transfer_concurrency, report=self._report_transfer)
 
-	def __repr__(self):
-		return 'local://%s' % self.path if isinstance(self, LocalFile) else 'cloud://%s' % self.uuid
+		shared.report = self._report_transfer
 
-	__str__ = __repr__
+		return shared
 
-class Filesystem(object):
-	def __init__(self):
-		super(Filesystem, self).__init__()
+	@staticmethod
+	def _release_scheduler(scheduler, shared=None):
+		if shared is None:
+			scheduler.close()
+		else: # run may have ended early, its tasks must not spill into next one
+			scheduler.join()
 
-	@property
-	def files(self):
-		raise NotImpleNotImplementedError()
+	def _write_metrics(self):
+		if self.metrics_file:
+			METRICS.write_json(self.metrics_file)
 
-class SimpleDiffer(object):
-	def __init__(self, local_files, remote_files):
-		super(SimpleDiffer, self).__init__()
-		self.local_files = local_files
-		self.remote_files = remote_files
-		
-	@property
-	def differences(self):
-		new_files = self.local_files - self.remote_files
-		deleted_files = self.remote_files - self.local_files
+		if self.prometheus_file:
+			METRICS.write_prometheus(self.prometheus_file)
 
-		maybe_modified_files = set([])
+	def sync(self, plan=None, scheduler=None):
+		'''
+		Returns list of failed TransferTasks, empty when everything went fine. With plan (lines
+		written by plan()) it does what was planned instead of scanning directories. Transfers
+		run on scheduler when given, so many syncs can share one pool of workers.
+		'''
+		METRICS.reset()
 
-		for curr_file in self.local_files:
-			for remote_file in self.remote_files:
-				if curr_file == remote_file:
-					maybe_modified_files.add((curr_file, remote_file))
+		try:
+			with METRICS.timed('sync'):
+				failed = self._sync(plan, scheduler)
 
-		return {'new_files': new_files, 'deleted_files': deleted_files, 'maybe_modified_files': maybe_modified_files}
+			METRICS.count('failed_transfers', len(failed))
+		finally:
+			self._database.sync() # GlacierSync may stay open for many syncs (daemon)
+			self._write_metrics()
 
-class LastModifiedDiffer(object):
-	def __init__(self, local_file, remote_file):
-		super(LastModifiedDiffer, self).__init__()
-		self.local_file = local_file
-		self.remote_file = remote_file
+		return failed
 
-	@property
-	def local_is_modified(self):
-		return self.local_file > self.remote_file
+	def _sync(self, plan, shared_scheduler):
+		differences = self._filesystem_differences() if plan is None else self._planned_differences(plan)
 
-class DifferRunner(object):
-	def __init__(self, local_filesystem, remote_filesystem, differs):
-		super(DifferRunner, self).__init__()
-		self.local_files = set(local_filesystem.files)
-		self.remote_files = set(remote_filesystem.files)
-		
-		self.differs = differs
+		remote_filesystem = self._remote_filesystem
+		database = self._database
+		scheduler = self._scheduler(shared_scheduler)
+		pack = PackBuilder(self.pack_size)
 
-	@property
-	def differences(self):
-		simplediffer = SimpleDiffer(self.local_files, self.remote_files)
-		simpleresult = simplediffer.differences
-		
-		files_differs_decided_to_reupload = set([])
+		# multipart uploads interrupted in earlier runs
+		uploads = dict((job.path, job) for job in database.pending_jobs if isinstance(job, MultipartUploadJob))
 
-		# we will only process maybe_modified_files
-		for currpair in simpleresult['maybe_modified_files']:
-			for current_differ in self.differs:
-				differ = current_differ(*currpair)
+		now = timegm(datetime.now().timetuple()) # same clock uploaded_at is stamped with
 
-				if differ.local_is_modified:
-					files_differs_decided_to_reupload.add(currpair)
+		# archive deleted before minimum storage duration is billed for the rest of it anyway
+		def too_young(remote_file):
+			return self.delayed_delete and (remote_file.uploaded_at_epoch or 0) + self.min_storage_seconds > now
 
-		return {'new_files': simpleresult['new_files'], 'deleted_files': simpleresult['deleted_files'], 'modified_files': files_differs_decided_to_reupload}
+		def deleted(remote_file):
+			def callback(result):
+				METRICS.count('archives_deleted')
+				remote_filesystem.record_delete(remote_file)
 
-class LocalFile(File):
-	def __init__(self, path):
-		super(LocalFile, self).__init__()
+			return callback
 
-		self.path = path
+		def remove(remote_file, description):
+			if self.keep_versions_seconds: # snapshots may need it, goes once none of those kept does
+				database.retire_file(remote_file)
+			else:
+				discard(remote_file, description)
 
-	@property
-	def last_modified(self):
-		return datetime.fromtimestamp(os.path.getmtime(self.path))
+		# chunks of removed deduplicated files, released once uploads are done (files chunked meanwhile may need them)
+		released = []
+
+		def discard(remote_file, description):
+			if remote_file.chunks is not None: # chunk archives go when no file needs any of their chunks
+				released.append(remote_file)
+			elif remote_file.offset is None:
+				if too_young(remote_file):
+					METRICS.count('deletes_queued')
+					remote_filesystem.queue_delete(remote_file)
+				else:
+					scheduler.submit(description % remote_file, remote_filesystem.delete_archive, remote_file, on_success=deleted(remote_file))
+			elif remote_filesystem.release_member(remote_file): # last file of packed archive is gone
+				if too_young(remote_file):
+					METRICS.count('deletes_queued')
+					remote_filesystem.queue_delete(remote_file)
+				else:
+					scheduler.submit(description % remote_file, remote_filesystem.delete_archive, remote_file, on_success=deleted(remote_file))
+
+		def release_chunks():
+			while released:
+				for chunk_archive in remote_filesystem.release_chunks(released.pop()):
+					discard(chunk_archive, 'remove chunks of %s')
 
-class LocalFilesystem(Filesystem):
-	def __init__(self, *dirs):
-		super(LocalFilesystem, self).__init__()
-		self.dirs = dirs
-		
-	@property
-	def files(self):
-		for curr_dir in self.dirs:
-			filelist = os.listdir(curr_dir)
+			return scheduler.join()
 
-			for curr_file in filelist:
-				full_file_path = os.path.join(curr_dir, curr_file)
+		def dequeue(queued_delete):
+			def callback(result):
+				METRICS.count('archives_deleted')
+				database.dequeue_delete(queued_delete)
 
-				if not os.path.isfile(full_file_path):
-					continue # skip non-normal files
+			return callback
 
-				yield LocalFile(full_file_path)
+		# old version (remote_file) is removed only when new one is safe in vault
+		def uploaded(local_file, remote_file, fields=None):
+			def callback(uuid):
+				METRICS.count('files_uploaded')
+				METRICS.count('bytes_uploaded', (fields or {}).get('archive_size', local_file.size))
+				remote_filesystem.record_upload(local_file, uuid, fields)
 
-# TODO: make this class nicer!
-class RemoteFile(File):
-	def __init__(self, file_json_data):
-		super(RemoteFile, self).__init__()		
+				if remote_file is not None:
+					remove(remote_file, 'remove old version %s')
 
-		self.file_json_data = file_json_data
-	@property
-	def last_modified(self):
-		return datetime.utcfromtimestamp(self.file_json_data['last_modified'])
+			return callback
 
-	@property
-	def uuid(self):
-		return self.file_json_data['uuid']
+		def packed(members):
+			def callback(result):
+				uuid, member_entries = result
 
-	@property
-	def path(self):
-		return self.file_json_data['path']
+				METRICS.count('packs_uploaded')
+				METRICS.count('bytes_uploaded', member_entries[0]['archive_size'])
 
-	@property
-	def uploaded_at(self):
-		return datetime.utcfromtimestamp(self.file_json_data['uploaded_at'])
-		
-class RemoteFilesystem(Filesystem):
-	def __init__(self, glacier_local_database, vault):
-		super(RemoteFilesystem, self).__init__()
-		self.glacier_local_database = glacier_local_database
-		self.vault = vault
-		
-	@property
-	def files(self):
-		return self.glacier_local_database.files
+				for (local_file, remote_file), member in zip(members, member_entries):
+					METRICS.count('files_uploaded')
+					remote_filesystem.record_upload(local_file, uuid, member)
 
-	def upload_file(self, local_file):
-		file_data = {
-			'path': local_file.path,
-			'last_modified': timegm(local_file.last_modified.timetuple()),
-			'uploaded_at': timegm(datetime.now().timetuple()),		
-		}
-		file_data = json.dumps(file_data)
+					if remote_file is not None:
+						remove(remote_file, 'remove old version %s')
 
-		uuid = self.vault.concurrent_create_archive_from_file(local_file.path, description=file_data)
+			return callback
 
-		self.glacier_local_database.add_file(local_file, uuid)
+		# sha256: callbacks of files waiting for chunk which is being sent by upload of another file
+		chunk_uploads = {}
 
-	def delete_file(self, remote_file):
-		self.vault.delete_archive(remote_file.uuid)
+		def chunks_uploaded(codec):
+			def callback(result):
+				uuid, stored = result
 
-		self.glacier_local_database.delete_file(remote_file)
+				METRICS.count('bytes_uploaded', sum(length for chunk_hash, offset, length in stored))
+				remote_filesystem.record_chunks(uuid, stored, codec)
 
-class InvalidJobTypeException(Exception):
-	pass
+				for chunk_hash, offset, length in stored:
+					for waiting in chunk_uploads.pop(chunk_hash):
+						waiting(chunk_hash)
 
-class GlacierLocalDatabaseFile(object):
-	def __init__(self, filename):
-		super(GlacierLocalDatabaseFile, self).__init__()
-		self.filename = filename
+			return callback
 
-		try:
-			with file(self.filename, 'r') as db_file:
-				self._filedata = json.load(db_file)
-				if self._filedata.get('pending_jobs') == None:
-					self._filedata['pending_jobs'] = []
+		# path: chunked file not recorded yet; those waiting for chunk of failed upload never are, next sync tries them again
+		waiting_files = {}
 
-					self.write()
-		except IOError: # we do not have database file yet
-			self._filedata = {'files': [], 'pending_jobs': []}
+		def stranded_files(failed):
+			''' Failed tasks standing for files which waited for chunks of failed upload of another file '''
+			failed_paths = set(task.args[0].path for task in failed if task.function == remote_filesystem.upload_chunks)
+			tasks = []
 
-	@property
-	def files(self):
-		for curr_file in self._filedata['files']:
-			yield RemoteFile(curr_file)
+			for local_file in waiting_files.values():
+				if local_file.path in failed_paths: # its own upload failed
+					continue
 
-	@property
-	def pending_jobs(self):
-		for entry in self._filedata['pending_jobs']:
-			if entry['__job_type'] in (RetreiveInvetoryJob.__name__, PendingJob.__name__, RetreiveArchiveJob.__name__):
-				yield globals()[entry['__job_type']](entry)
-			else:
-				raise InvalidJobTypeException('Invalid class name in __job_type')
+				task = TransferTask('upload %s' % local_file, remote_filesystem.upload_chunks, (local_file, [], None))
+				task.error = IOError('upload of chunks it shares with another file failed')
+				self._report_transfer(task)
+				tasks.append(task)
 
-	def write(self):
-		with file(self.filename, 'w') as db_file:
-			json.dump(self._filedata, db_file)
+			waiting_files.clear()
+			return tasks
 
-	def add_file(self, local_file, uuid):
-		file_entry = {
-			'path': local_file.path,
-			'last_modified': timegm(local_file.last_modified.timetuple()),
-			'uploaded_at': timegm(datetime.now().timetuple()),
-			'uuid': uuid
-		}
+		def chunked(local_file, remote_file):
+			def callback(chunks):
+				waiting_files[local_file.path] = local_file
+				hashes = [chunk_hash for chunk_hash, offset, length in chunks]
+				known = database.chunk_locations(hashes)
+				missing = set()
+				new_chunks = []
 
-		self._filedata['files'].append(file_entry)
+				def record():
+					if len(database.chunk_locations(hashes)) < len(set(hashes)): # some went meanwhile, send them again
+						callback(chunks)
+						return
 
-		self.write()
-	def restore_from_amazon(self, amazon_data):
-		self._filedata['files'] = []
-		for archive in amazon_data:
-			file_data = json.loads(archive['ArchiveDescription'])
-			file_entry = {
-				'path': file_data['path'],
-				'last_modified': file_data['last_modified'],
-				'uploaded_at': file_data['uploaded_at'],
-				'uuid': archive['ArchiveId']
-			}
-			self._filedata['files'].append(file_entry)
+					METRICS.count('files_uploaded')
+					remote_filesystem.record_chunked_upload(local_file, hashes)
+					del waiting_files[local_file.path]
 
-		self.write()
+					if remote_file is not None:
+						remove(remote_file, 'remove old version %s')
 
-	def delete_file(self, remote_file):
-		self._filedata['files'] = [entry for entry in self._filedata['files'] if entry['uuid'] != remote_file.uuid]
+				def chunk_ready(chunk_hash):
+					missing.discard(chunk_hash)
 
-		self.write()
+					if not missing:
+						record()
 
-	def add_pending_job(self, job):
-		job_entry = {
-			'__job_type': job.__class__.__name__
-		}
-		job_entry.update(job.__dict__)
-		self._filedata['pending_jobs'].append(job_entry)
+				for chunk in chunks:
+					chunk_hash = chunk[0]
 
-		self.write()
-	def delete_pending_job(self, job):
-		self._filedata['pending_jobs'] = [entry for entry in self._filedata['pending_jobs'] if entry['uuid'] != job.uuid]
+					if chunk_hash in known or chunk_hash in missing:
+						continue
 
-		self.write()
+					missing.add(chunk_hash)
 
-class PendingJob(object):
-	def __init__(self, uuid_or_jsondata):
-		super(PendingJob, self).__init__()
+					if chunk_hash not in chunk_uploads: # nobody sends it yet, we will
+						chunk_uploads[chunk_hash] = []
+						new_chunks.append(chunk)
 
-		if isinstance(uuid_or_jsondata, dict):
-			self.__dict__.update(uuid_or_jsondata)
-		else:
-			self.uuid = uuid_or_jsondata
+					chunk_uploads[chunk_hash].append(chunk_ready)
 
-	def to_JSON(self):
-		return json.dumps(self, default=lambda o: o.__dict__)
+				METRICS.count('bytes_deduplicated', local_file.size - sum(length for chunk_hash, offset, length in new_chunks))
 
-	def __hash__(self):
-		return hash(self.uuid)
+				if not missing:
+					record()
+				elif new_chunks:
+					codec = remote_filesystem.codec_for(local_file)
+					scheduler.submit('upload %d new chunks of %s' % (len(new_chunks), local_file), remote_filesystem.upload_chunks, local_file, new_chunks, codec, on_success=chunks_uploaded(codec))
 
-	def __eq__(self, other):
-		return self.uuid == other.uuid
+			return callback
 
-class RetreiveInvetoryJob(PendingJob):
-	pass
+		def flush_pack():
+			members = pack.take()
 
-class RetreiveArchiveJob(PendingJob):
-	pass
+			if members:
+				scheduler.submit('upload pack of %d files' % len(members), remote_filesystem.upload_pack, [local_file for local_file, remote_file in members], on_success=packed(members))
 
-class GlacierSync(object):
-	def __init__(self, aws, database, delayed_delete, dirs_to_sync, print_status=False):
-		super(GlacierSync, self).__init__()
-		self.aws = aws
-		self.delayed_delete = delayed_delete
+		def abort_upload(job):
+			database.delete_pending_job(job)
+			scheduler.submit('abort upload of %s' % job.path, remote_filesystem.abort_multipart_upload, job)
 
-		self._database = GlacierLocalDatabaseFile(database)
-		self._aws_connection = Layer2(aws_access_key_id=self.aws['access_key'], aws_secret_access_key=self.aws['secret_key'], region_name=self.aws['region'])
-		self._vault = self._aws_connection.get_vault(self.aws['vault_name'])
+		def complete_upload(job, local_file, remote_file):
+			def callback(result):
+				uuid, local_file.cached_tree_hash = result
 
-		self._local_filesystem = LocalFilesystem(*dirs_to_sync)
-		self._remote_filesystem = RemoteFilesystem(self._database, self._vault)
+				database.delete_pending_job(job)
+				uploaded(local_file, remote_file)(uuid)
 
-		self.print_status = print_status
+			scheduler.submit('upload %s' % local_file, remote_filesystem.complete_multipart_upload, job, on_success=callback)
 
-	def _filesystem_differences(self):
-		differ_runner = DifferRunner(self._local_filesystem, self._remote_filesystem, [LastModifiedDiffer])
-		
-		differences = differ_runner.differences
+		def upload_parts(job, local_file, remote_file):
+			def part_uploaded(index):
+				def callback(part_tree_hash):
+					job.parts[str(index)] = part_tree_hash
+					database.add_job_part(job, index, part_tree_hash)
 
-		return differences
+					if len(job.parts) == job.part_count:
+						complete_upload(job, local_file, remote_file)
 
-	def sync(self):
-		differences = self._filesystem_differences()
+				return callback
 
-		for curr_file in differences['new_files']:
-			if self.print_status:
-				print 'New file uploading: %s' % curr_file
-			self._remote_filesystem.upload_file(curr_file)
+			missing_parts = job.missing_parts
 
-		for curr_file in differences['deleted_files']:
-			if self.print_status:
-				print 'Removing file: %s' % curr_file
-			self._remote_filesystem.delete_file(curr_file)
+			if not missing_parts: # interrupted right before completing
+				complete_upload(job, local_file, remote_file)
 
-		for curr_file in differences['modified_files']:
-			if self.print_status:
-				print 'File has changed: %s' % curr_file[0]
-			self._remote_filesystem.upload_file(curr_file[0]) # upload local
-			self._remote_filesystem.delete_file(curr_file[1]) # remove remote
+			for index in missing_parts:
+				scheduler.submit('upload part %d/%d of %s' % (index + 1, job.part_count, local_file), remote_filesystem.upload_part, job, index, on_success=part_uploaded(index))
+
+		def upload_encoded_parts(job, local_file, remote_file, reader=None):
+			def completed(result):
+				database.delete_pending_job(job)
+				encoded(local_file, remote_file)(result)
+
+			def callback(result):
+				if result is None: # parts sent before are encoded differently now
+					abort_upload(job)
+					upload_multipart(local_file, remote_file, remote_filesystem.codec_for(local_file))
+					return
+
+				reader, index, part_tree_hash = result
+
+				if index is not None:
+					job.parts[str(index)] = part_tree_hash
+					database.add_job_part(job, index, part_tree_hash)
+
+				if reader.closed: # encoded to the end
+					job.encoded_size = reader.position
+					scheduler.submit('upload %s' % local_file, remote_filesystem.complete_encoded_upload, job, local_file, on_success=completed)
+				else:
+					upload_encoded_parts(job, local_file, remote_file, reader)
+
+			scheduler.submit('upload part %d of %s' % (len(job.parts) + 1, local_file), remote_filesystem.upload_encoded_part, job, reader, on_success=callback)
+
+		def upload_multipart(local_file, remote_file, codec=None):
+			job = uploads.pop(local_file.path, None)
+
+			if job is not None and (not job.matches(local_file) or job.codec != (codec.name if codec is not None else None)):
+				abort_upload(job)
+				job = None
+
+			def started(job):
+				if job.codec is None:
+					upload_parts(job, local_file, remote_file)
+				else: # encoded as parts go, one after another
+					upload_encoded_parts(job, local_file, remote_file)
+
+			if job is not None:
+				started(job)
+				return
+
+			def initiated(job):
+				database.add_pending_job(job)
+				started(job)
+
+			scheduler.submit('start upload of %s' % local_file, remote_filesystem.initiate_multipart_upload, local_file, codec, on_success=initiated)
+
+		def encoded(local_file, remote_file):
+			def callback(result):
+				uuid, fields = result
+				uploaded(local_file, remote_file, fields)(uuid)
+
+			return callback
+
+		def upload(local_file, remote_file=None):
+			codec = remote_filesystem.codec_for(local_file)
+
+			if self.dedup and local_file.size >= self.dedup_min_size: # only chunks vault doesn't have yet are sent
+				scheduler.submit('chunk %s' % local_file, remote_filesystem.cut_chunks, local_file, on_success=chunked(local_file, remote_file))
+			# packs go as they are, so files which are to be encrypted can't be packed
+			elif local_file.size < self.pack_files_below and remote_filesystem.encryption_key is None:
+				if pack.add((local_file, remote_file), local_file.size):
+					flush_pack()
+			elif self.multipart_threshold and local_file.size >= self.multipart_threshold:
+				upload_multipart(local_file, remote_file, codec)
+			elif codec is not None: # encoded into temporary file, engine decides how to send it
+				scheduler.submit('upload %s' % local_file, remote_filesystem.upload_encoded, local_file, codec, on_success=encoded(local_file, remote_file))
+			else:
+				scheduler.submit('upload %s' % local_file, remote_filesystem.upload_archive, local_file, on_success=uploaded(local_file, remote_file))
+
+		try:
+			with METRICS.timed('transfer'): # submitting vault work until last task and its callback are done
+				for curr_file in differences['new_files']:
+					if self.print_status:
+						print 'New file uploading: %s' % curr_file
+					upload(curr_file)
+
+				for curr_file in differences['deleted_files']:
+					if self.print_status:
+						print 'Removing file: %s' % curr_file
+					remove(curr_file, 'remove %s')
+
+				for curr_file in differences['modified_files']:
+					if self.print_status:
+						print 'File has changed: %s' % curr_file[0]
+					upload(*curr_file)
+
+				flush_pack()
+
+				# files these were for are gone or don't need uploading any more
+				for job in uploads.values():
+					abort_upload(job)
+
+				failed = scheduler.join()
+				failed.extend(stranded_files(failed))
+				failed.extend(release_chunks())
+
+				if self.keep_versions_seconds:
+					self._snapshot(now, discard)
+					failed.extend(scheduler.join())
+					failed.extend(release_chunks())
+
+				# queued deletes are ordered by uploaded_at, so only the due ones are read
+				for batch in batches(database.due_deletes(now - self.min_storage_seconds), self.delete_batch_size):
+					for queued_delete in batch:
+						scheduler.submit('remove archive of %s' % queued_delete.path, remote_filesystem.delete_archive, queued_delete, on_success=dequeue(queued_delete))
+
+					failed.extend(scheduler.join())
+		finally:
+			self._release_scheduler(scheduler, shared_scheduler)
+
+		for task in failed:
+			# Glacier forgot the upload (aborted or expired), next run starts it over
+			if isinstance(task.args[0], MultipartUploadJob) and getattr(task.error, 'status', None) == 404:
+				database.delete_pending_job(task.args[0])
+
+			# archive is gone already (deleted by hand?), nothing left to wait for
+			if isinstance(task.args[0], QueuedDelete) and getattr(task.error, 'status', None) == 404:
+				database.dequeue_delete(task.args[0])
+
+		if self.print_status and self.delayed_delete:
+			print 'Archives waiting for minimum storage duration before delete: %d' % database.count_queued_deletes()
+
+		if self._scan_cache is not None and plan is None:
+			for task in failed:
+				subjects = task.args[0] if isinstance(task.args[0], list) else [task.args[0]]
+
+				for subject in subjects:
+					self._scan_cache.forget(subject.path)
+
+			self._scan_cache.save()
+
+		return failed
+
+	def _snapshot(self, now, discard):
+		''' Snapshots catalogue after sync, drops snapshots older than keep_versions_days and old versions none of the rest needs '''
+		database = self._database
+		snapshot = database.add_snapshot(now)
+
+		# latest one always stays, it numbers generations
+		for snapshot_id, taken_at in database.snapshots[:-1]:
+			if taken_at + self.keep_versions_seconds < now:
+				database.drop_snapshot(snapshot_id)
+
+		kept = [snapshot_id for snapshot_id, taken_at in database.snapshots]
+		versions = 0
+
+		for remote_file in list(database.versions):
+			# first kept snapshot taken after version was added must be from before it was retired
+			index = bisect.bisect_left(kept, remote_file.generation or 0)
+
+			if index < len(kept) and kept[index] < remote_file.retired:
+				versions += 1
+			else:
+				discard(remote_file, 'remove old version %s')
+
+		if self.print_status:
+			print 'Snapshot %d taken, %d kept, old versions they need: %d' % (snapshot, len(kept), versions)
+
+	@property
+	def snapshots(self):
+		''' (id, taken_at) of kept snapshots, oldest first '''
+		return self._database.snapshots
+
+	def snapshot_at(self, moment):
+		''' Id of last snapshot taken at or before moment (seconds, same clock uploaded_at is stamped with), None if there is none '''
+		snapshots = [snapshot_id for snapshot_id, taken_at in self._database.snapshots if taken_at <= moment]
+
+		return snapshots[-1] if snapshots else None
+
+	def _report_restoredb_progress(self, done):
+		if self.print_status:
+			print 'Archives read from inventory: %d' % done
+
+	def _report_discrepancy(self, kind, item):
+		if not self.print_status:
+			return
+
+		if kind == 'orphaned':
+			print 'Orphaned archive, catalogue knows nothing about it: %s %s' % (item['ArchiveId'], item.get('ArchiveDescription'))
+		elif kind == 'phantom':
+			print 'Phantom entry, its archive is not in vault: %s (%s)' % (item['path'], item['uuid'])
+		elif kind == 'superseded':
+			print 'Entry replaced by newer archive of the same file, its archive is left in vault: %s %s' % (item['uuid'], item['path'])
+		else:
+			print 'Fixed size or tree hash of: %s' % item['path']
 
 	def restoredb(self):
 		# check if we are running some job for it
 		for job in self._database.pending_jobs:
 			if isinstance(job, RetreiveInvetoryJob): # yes, we are...
-				aws_job = self._vault.get_job(job.uuid)
-				
-				if not aws_job.completed:
+				if not self._remote_filesystem.job_completed(job):
 					if self.print_status:
 						print 'AWS hasn\'t completed job yet. Run this command again after some time.'
 					return False
 
-				aws_job_data = json.loads(aws_job.get_output().read())
+				inventory = self._remote_filesystem.open_inventory(job)
+				header = {}
 
-				self._database.restore_from_amazon(aws_job_data['ArchiveList'])
+				counts = self._database.merge_from_amazon(iter_inventory_archives(inventory, header=header), header,
+					progress=self._report_restoredb_progress, report=self._report_discrepancy)
 
 				if self.print_status:
-					print 'Local AWS File database is now synced to file list on glacier.'
+					print 'Local AWS File database is now synced to file list on glacier: %(added)d added, %(phantom)d phantoms dropped, %(fixed)d fixed, %(orphaned)d orphaned archives, %(kept)d newer than inventory kept, %(superseded)d superseded.' % counts
 
 				# lets remove this job from list
 				self._database.delete_pending_job(job)
@@ -354,28 +3862,203 @@ class GlacierSync(object):
 				return True
 
 		# no running job, let's run one :)
-		retreive_job = RetreiveInvetoryJob(self._vault.retrieve_inventory())
-		self._database.add_pending_job(retreive_job)
+		self._database.add_pending_job(self._remote_filesystem.request_inventory())
 
 		if self.print_status:
 			print 'File list retreival job requested. Run this command again after some time.'
 		return False
 
-	def restore(self):
-		# filter pending jobs for RetreiveArchiveJob
-		restore_jobs = [job for job in self._database.pending_jobs if isinstance(job, RetreiveArchiveJob)]
+	def poll_jobs(self, scheduler=None):
+		''' Carries on restoredb and restore which wait for Glacier jobs, never starts new ones '''
+		pending_jobs = list(self._database.pending_jobs)
 
-		# if there any restore jobs that means that we are running restore now...
-		if len(restore_jobs):
-			pass
-		else:
-			# we need to place file retreival jobs
-			differences = self._filesystem_differences()
+		try:
+			if any(isinstance(job, RetreiveInvetoryJob) for job in pending_jobs):
+				self.restoredb()
 
-			# deleted files are now just "missing" ones... let's place job to download them!
-			for curr_file in differences['deleted_files']:
-				if self.print_status:
-					print 'Scheduling file get: %s' % curr_file
+			if any(isinstance(job, RetreiveArchiveJob) for job in pending_jobs):
+				self.restore(scheduler)
+		finally:
+			self._database.sync()
+
+	def restoring(self):
+		''' True while restore waits for archive jobs; until they are done, files they bring back look deleted '''
+		return any(isinstance(job, RetreiveArchiveJob) for job in self._database.pending_jobs)
+
+	def _missing_files(self, snapshot=None):
+		''' Catalogue entries whose file is missing locally; of snapshot, also those whose local file is another version '''
+		if snapshot is None:
+			return self._filesystem_differences(differs=[])['deleted_files']
+
+		if snapshot not in set(snapshot_id for snapshot_id, taken_at in self._database.snapshots):
+			raise ValueError('There is no snapshot %s' % snapshot)
+
+		differences = DifferRunner(self._local_filesystem, CatalogueSnapshot(self._database, snapshot), [VersionDiffer]).differences
+
+		return differences['deleted_files'] | set(remote_file for local_file, remote_file in differences['modified_files'])
+
+	def restore(self, shared_scheduler=None, snapshot=None):
+		'''
+		Brings back files which are in catalogue but missing locally. Every run downloads outputs
+		of completed retrieval jobs, then requests retrieval of more missing files, keeping at most
+		restore_batch_size jobs pending. Returns True when there is nothing left to restore.
+		With snapshot, files are brought back as they were then, replacing other local versions.
+		'''
+		remote_filesystem = self._remote_filesystem
+		scheduler = self._scheduler(shared_scheduler)
+		database = self._database
+
+		def restore_jobs():
+			return [job for job in database.pending_jobs if isinstance(job, RetreiveArchiveJob)]
+
+		try:
+			with METRICS.timed('transfer'): # submitting vault work until last task and its callback are done
+				failed = []
+
+				if restore_jobs():
+					jobs = remote_filesystem.jobs()
+
+					for job in restore_jobs():
+						job_description = jobs.get(job.uuid)
+
+						if job_description is None or job_description['StatusCode'] == 'Failed': # expired or failed, request it again
+							database.delete_pending_job(job)
+						elif job_description['Completed']:
+							scheduler.submit('download %s' % job.path, remote_filesystem.download_job, job, job_description, on_success=lambda result, job=job: database.delete_pending_job(job))
+
+					failed.extend(scheduler.join())
+
+				# restored files are in place now, so they are not missing any more
+				waiting = set((job.archive_id, job.path) for job in restore_jobs())
+				missing = []
+				chunked = []
+
+				for remote_file in self._missing_files(snapshot):
+					if remote_file.chunks is not None:
+						chunked.append(remote_file)
+					elif (remote_file.uuid, remote_file.path) not in waiting:
+						missing.append(remote_file)
+
+				# deduplicated files are put together once all their chunk archives are downloaded
+				requested = set()
+
+				for remote_file in chunked:
+					locations = database.chunk_locations(remote_file.chunks)
+					archive_paths = dict((uuid, self._chunk_archive_path(uuid)) for uuid, offset, length, codec in locations.values())
+					downloaded = True
+
+					for uuid, path in archive_paths.items():
+						if os.path.exists(path):
+							continue
+
+						downloaded = False
+
+						if (uuid, path) not in waiting and uuid not in requested: # archive shared by many files is requested once
+							requested.add(uuid)
+							missing.append(RemoteFile({'path': path, 'uuid': uuid, 'last_modified': 0}))
+
+					if downloaded:
+						scheduler.submit('assemble %s' % remote_file, remote_filesystem.assemble_chunks, remote_file, locations, archive_paths)
+
+				requested_now = missing[:max(0, self.restore_batch_size - len(waiting))]
+
+				for curr_file in requested_now:
+					if self.print_status:
+						print 'Scheduling file get: %s' % curr_file
+
+					scheduler.submit('request %s' % curr_file, remote_filesystem.request_retrieval, curr_file, on_success=database.add_pending_job)
+
+				failed.extend(scheduler.join())
+		finally:
+			self._release_scheduler(scheduler, shared_scheduler)
+
+		waiting = len(restore_jobs())
+
+		if self.print_status:
+			print 'Files waiting for Glacier: %d, not requested yet: %d, failed: %d. Run this command again after some time.' % (waiting, len(missing) - len(requested_now), len(failed))
+
+		done = not waiting and not missing and not failed
+
+		if done and os.path.isdir(self._chunk_cache):
+			shutil.rmtree(self._chunk_cache)
+
+		return done
+
+	def _chunk_archive_path(self, uuid):
+		return os.path.join(self._chunk_cache, hashlib.sha1(uuid).hexdigest())
+
+class ScheduledSync(object):
+	def __init__(self, name, glacier_sync, sync_interval, poll_interval, now):
+		super(ScheduledSync, self).__init__()
+		self.name = name
+		self.glacier_sync = glacier_sync
+		self.sync_interval = sync_interval
+		self.poll_interval = poll_interval
+
+		self.next_sync = now
+		self.next_poll = now
+
+class SyncDaemon(object):
+	'''
+	Keeps GlacierSyncs of many configs open, so their catalogues stay loaded, and runs their syncs
+	and job polls every sync_interval/poll_interval seconds (0 disables). Runs go one at a time,
+	all on one shared pool of transfer_concurrency workers; failure of one doesn't stop others.
+	Syncs of a config are skipped while its restore waits for archives.
+	'''
+	def __init__(self, transfer_concurrency=1, clock=time.time):
+		super(SyncDaemon, self).__init__()
+		self.clock = clock
+		self.scheduler = TransferScheduler(transfer_concurrency)
+
+		self._scheduled = []
+		self._stopped = threading.Event()
+
+	def add(self, name, glacier_sync, sync_interval, poll_interval=0):
+		self._scheduled.append(ScheduledSync(name, glacier_sync, sync_interval, poll_interval, self.clock()))
+
+	def _run(self, name, action, function):
+		try:
+			function()
+		except Exception as e:
+			print >> sys.stderr, '%s of %s failed: %s' % (action, name, e)
+
+	def run_due(self):
+		''' Runs syncs and polls which are due, returns seconds until next one is (None when there is nothing to run) '''
+		for scheduled in self._scheduled:
+			if scheduled.sync_interval and self.clock() >= scheduled.next_sync:
+				if scheduled.glacier_sync.restoring(): # sync would delete archives of files being restored
+					print >> sys.stderr, 'sync of %s skipped: restore is waiting for archives' % scheduled.name
+				else:
+					self._run(scheduled.name, 'sync', lambda: scheduled.glacier_sync.sync(scheduler=self.scheduler))
+
+				scheduled.next_sync = self.clock() + scheduled.sync_interval
+
+			if scheduled.poll_interval and self.clock() >= scheduled.next_poll:
+				self._run(scheduled.name, 'job poll', lambda: scheduled.glacier_sync.poll_jobs(self.scheduler))
+				scheduled.next_poll = self.clock() + scheduled.poll_interval
+
+		due = [scheduled.next_sync for scheduled in self._scheduled if scheduled.sync_interval]
+		due.extend(scheduled.next_poll for scheduled in self._scheduled if scheduled.poll_interval)
+
+		if due:
+			return max(0, min(due) - self.clock())
+
+	def run(self):
+		''' Runs until stop() is called (e.g. from signal handler) '''
+		try:
+			while not self._stopped.is_set():
+				wait = self.run_due()
+
+				if wait is None:
+					return
+
+				self._stopped.wait(wait)
+		finally:
+			self.scheduler.close()
+
+	def stop(self):
+		self._stopped.set()
 
-				# restore_job = RetreiveArchiveJob(self._vault.retrieve_archive(curr_file.uuid))
-				# self._database.add_pending_job(restore_job.id)
+	def close(self):
+		for scheduled in self._scheduled:
+			scheduled.glacier_sync.close()
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+#
+# Application that sync folders to Amazon Glacier.
+# https://github.com/Teeed/glacsync
+#
+# Copyright (C) 2014 Tadeusz Magura-Witkowski
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Run with: python -m glacsync.test.benchmark <benchmark> [sizes...]
+#
+# sync and restoredb benchmarks return timings, which --output saves (with git commit they were
+# measured on) and --compare checks against such saved file, failing on regressions.
+
+import argparse
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from ..glacsync import *
+from .fakes import FakeGlacierServer, FakeVault
+
+class BenchmarkFile(File):
+	def __init__(self, path):
+		super(BenchmarkFile, self).__init__()
+
+		self.path = path
+
+class NestedLoopDiffer(SimpleDiffer):
+	''' SimpleDiffer as it was before the hash join, kept for comparison '''
+	@property
+	def differences(self):
+		new_files = self.local_files - self.remote_files
+		deleted_files = self.remote_files - self.local_files
+
+		maybe_modified_files = set([])
+
+		for curr_file in self.local_files:
+			for remote_file in self.remote_files:
+				if curr_file == remote_file:
+					maybe_modified_files.add((curr_file, remote_file))
+
+		return {'new_files': new_files, 'deleted_files': deleted_files, 'maybe_modified_files': maybe_modified_files}
+
+class DictRemoteFile(File):
+	''' RemoteFile as it was before slots, kept for comparison '''
+	def __init__(self, file_json_data):
+		super(DictRemoteFile, self).__init__()
+
+		self.file_json_data = file_json_data
+
+	@property
+	def last_modified(self):
+		return datetime.utcfromtimestamp(self.file_json_data['last_modified'])
+
+	@property
+	def path(self):
+		return self.file_json_data['path']
+
+	def __gt__(self, other):
+		return self.last_modified > other.last_modified
+
+class DictLocalFile(File):
+	''' LocalFile as it was before slots, kept for comparison '''
+	def __init__(self, path, size, mtime, inode):
+		super(DictLocalFile, self).__init__()
+
+		self.path = path
+		self.size = size
+		self.mtime = mtime
+		self.inode = inode
+		self.cached_tree_hash = None
+
+	@property
+	def last_modified(self):
+		return datetime.fromtimestamp(self.mtime)
+
+	def __gt__(self, other):
+		return self.last_modified > other.last_modified
+
+def synthetic_trees(size):
+	''' Two file sets which overlap in 80% of paths, like a share after a day of work '''
+	shared = size * 8 // 10
+	local_files = set(BenchmarkFile('share/%08d' % i) for i in xrange(size))
+	remote_files = set(BenchmarkFile('share/%08d' % i) for i in xrange(size - shared, 2 * size - shared))
+
+	return local_files, remote_files
+
+def timed(function):
+	start = time.time()
+	function()
+	return time.time() - start
+
+def benchmark_differ(sizes, args):
+	for size in sizes:
+		local_files, remote_files = synthetic_trees(size)
+
+		hash_join = timed(lambda: SimpleDiffer(local_files, remote_files).differences)
+
+		if size <= args.max_nested:
+			nested = '%.3fs' % timed(lambda: NestedLoopDiffer(local_files, remote_files).differences)
+		else:
+			nested = 'skipped'
+
+		print '%10d entries: hash join %.3fs, nested loop %s' % (size, hash_join, nested)
+
+def synthetic_catalogue_entries(size):
+	for i in xrange(size):
+		yield {'path': 'share/%08d' % i, 'last_modified': 1403644047, 'uploaded_at': 1403644047, 'uuid': 'archive-%040d' % i}
+
+def _database_startup(database_filename, results):
+	''' Runs in a fresh process, so ru_maxrss is memory of this backend alone '''
+	start = time.time()
+	database = open_local_database(database_filename)
+	opened = time.time() - start
+
+	count = sum(1 for remote_file in database.files)
+	iterated = time.time() - start
+	iterated_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	set(database.files) # what DifferRunner does on sync start-up
+	loaded = time.time() - start
+
+	results.put((count, opened, iterated, iterated_rss, loaded, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def benchmark_database(sizes, args):
+	for size in sizes:
+		tempdir = tempfile.mkdtemp()
+
+		try:
+			json_filename = os.path.join(tempdir, 'catalogue.files')
+			with open(json_filename, 'w') as json_file:
+				json.dump({'files': list(synthetic_catalogue_entries(size)), 'pending_jobs': []}, json_file)
+
+			sqlite_filename = os.path.join(tempdir, 'catalogue.sqlite')
+			sqlite_database = GlacierLocalDatabaseSqlite(sqlite_filename)
+			sqlite_database._insert_files(synthetic_catalogue_entries(size))
+			sqlite_database.close()
+
+			for database_filename in (json_filename, sqlite_filename):
+				results = multiprocessing.Queue()
+				process = multiprocessing.Process(target=_database_startup, args=(database_filename, results))
+				process.start()
+				count, opened, iterated, iterated_rss, loaded, max_rss = results.get()
+				process.join()
+
+				print '%10d entries, %-8s open %.3fs, iterate %.3fs (max RSS %d MiB), load set %.3fs (max RSS %d MiB)' % (count,
+					os.path.splitext(database_filename)[1], opened, iterated, iterated_rss // 1024, loaded, max_rss // 1024)
+		finally:
+			shutil.rmtree(tempdir)
+
+class DatetimeDiffer(LastModifiedDiffer):
+	''' LastModifiedDiffer as it was before integer mtimes, kept for comparison '''
+	@property
+	def local_is_modified(self):
+		return self.local_file > self.remote_file
+
+FILE_CLASSES = {
+	'slots': (LocalFile, RemoteFile, LastModifiedDiffer),
+	'dict': (DictLocalFile, DictRemoteFile, DatetimeDiffer),
+}
+
+def _files_differ(implementation, size, results):
+	''' Runs in a fresh process, so ru_maxrss is memory of this implementation alone '''
+	local_class, remote_class, differ_class = FILE_CLASSES[implementation]
+
+	start = time.time()
+	# every 10th file was touched since upload
+	local_files = set(local_class('share/%08d' % i, 1024, 1403644047 + (i % 10 == 0) * 100, i) for i in xrange(size))
+	remote_files = set(remote_class(entry) for entry in synthetic_catalogue_entries(size))
+	loaded = time.time() - start
+
+	start = time.time()
+	modified = sum(1 for bucket, (local_file, remote_file) in SimpleDiffer(local_files, remote_files).stream() if differ_class(local_file, remote_file).local_is_modified)
+	compared = time.time() - start
+
+	results.put((modified, loaded, compared, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def benchmark_files(sizes, args):
+	for size in sizes:
+		for implementation in sorted(FILE_CLASSES):
+			results = multiprocessing.Queue()
+			process = multiprocessing.Process(target=_files_differ, args=(implementation, size, results))
+			process.start()
+			modified, loaded, compared, max_rss = results.get()
+			process.join()
+
+			print '%10d files, %-5s build %.3fs, compare %.3fs (%d modified), max RSS %d MiB' % (size, implementation, loaded, compared, modified, max_rss // 1024)
+
+def benchmark_engine(sizes, args):
+	''' Uploads that many files to local fake Glacier HTTP server, with every engine and concurrency '''
+	server = FakeGlacierServer(args.latency)
+	server.start()
+
+	tempdir = tempfile.mkdtemp()
+
+	try:
+		for size in sizes:
+			local_files = []
+
+			for i in xrange(size):
+				path = os.path.join(tempdir, '%08d' % i)
+				with open(path, 'wb') as local_file:
+					local_file.write(os.urandom(args.file_size))
+
+				local_files.append(LocalFile(path))
+
+			for engine in args.engines:
+				for concurrency in args.concurrency:
+					remote_filesystem = RemoteFilesystem(None, TRANSFER_ENGINES[engine](server.vault()))
+					scheduler = TransferScheduler(concurrency)
+					requests = server.requests
+
+					def upload_all():
+						for local_file in local_files:
+							scheduler.submit('upload %s' % local_file, remote_filesystem.upload_archive, local_file)
+
+						assert not scheduler.join()
+
+					elapsed = timed(upload_all)
+					scheduler.close()
+
+					print '%8d files, %-6s engine, concurrency %3d: %.3fs, %7.1f files/s, %7.2f MiB/s, %d requests' % (size, engine, concurrency,
+						elapsed, size / elapsed, size * args.file_size / elapsed / MEGABYTE, server.requests - requests)
+
+			for local_file in local_files:
+				os.unlink(local_file.path)
+	finally:
+		shutil.rmtree(tempdir)
+		server.shutdown()
+
+def synthetic_tree(root, size, file_size, files_per_directory=100):
+	''' Creates size files of file_size random bytes under root, returns their paths '''
+	paths = []
+
+	for i in xrange(size):
+		directory = os.path.join(root, '%06d' % (i // files_per_directory))
+		if not i % files_per_directory:
+			os.makedirs(directory)
+
+		paths.append(os.path.join(directory, '%08d' % i))
+		with open(paths[-1], 'wb') as local_file:
+			local_file.write(os.urandom(file_size))
+
+	return paths
+
+def synthetic_inventory(inventory_file, size):
+	''' Writes Glacier inventory of size archives uploaded by glacsync, archive by archive '''
+	inventory_file.write('{"VaultARN": "arn:aws:glacier:us-west-2:0:vaults/benchmark", "InventoryDate": "2014-06-25T00:00:00Z", "ArchiveList": [')
+
+	for i in xrange(size):
+		description = json.dumps({'path': 'share/%06d/%08d' % (i // 100, i), 'last_modified': 1403644047, 'uploaded_at': 1403644047})
+		inventory_file.write('%s{"ArchiveId": "archive-%040d", "ArchiveDescription": %s, "CreationDate": "2014-06-25T00:00:00Z", "Size": 1024, "SHA256TreeHash": "%064d"}' % (
+			',' if i else '', i, json.dumps(description), i))
+
+	inventory_file.write(']}')
+
+# phases of METRICS recorded per run, transfer includes the db_write of its callbacks
+SYNC_PHASES = ('scan', 'catalogue_read', 'diff', 'db_write', 'db_fsync', 'transfer')
+
+def benchmark_sync(sizes, args):
+	''' Syncs synthetic tree to fake vault three times: everything new, after a day of changes, unchanged '''
+	results = {}
+
+	for size in sizes:
+		for engine in args.engines:
+			tempdir = tempfile.mkdtemp()
+
+			try:
+				sharedir = os.path.join(tempdir, 'share')
+				paths = synthetic_tree(sharedir, size, args.file_size)
+
+				vault = FakeVault(latency=args.latency, bandwidth=args.bandwidth)
+				glacier_sync = GlacierSync(None, os.path.join(tempdir, 'catalogue.' + args.db), False, [sharedir],
+					transfer_concurrency=args.transfer_concurrency, transfer_engine=engine, vault=vault)
+
+				def day_of_changes():
+					# 10% rewritten, 5% removed, 5% new
+					for path in paths[::10]:
+						with open(path, 'wb') as local_file:
+							local_file.write(os.urandom(args.file_size))
+						os.utime(path, (time.time() + 10, time.time() + 10))
+
+					for path in paths[5::20]:
+						os.unlink(path)
+
+					synthetic_tree(os.path.join(sharedir, 'new'), size // 20, args.file_size)
+
+				for run, prepare in (('initial', None), ('changed', day_of_changes), ('unchanged', None)):
+					if prepare is not None:
+						prepare()
+
+					elapsed = timed(lambda: glacier_sync.sync())
+					phases = METRICS.report()['phases']
+					key = 'sync/%s/%s/%d/%s' % (engine, args.db, size, run)
+
+					results[key] = elapsed
+					for phase in SYNC_PHASES:
+						results['%s/%s' % (key, phase)] = phases.get(phase, {}).get('seconds', 0)
+
+					print '%8d files, %-6s engine, %-6s catalogue, %-9s sync %.3fs: %s' % (size, engine, args.db, run, elapsed,
+						', '.join('%s %.3fs' % (phase, results['%s/%s' % (key, phase)]) for phase in SYNC_PHASES))
+
+				glacier_sync.close()
+			finally:
+				shutil.rmtree(tempdir)
+
+	return results
+
+def benchmark_restoredb(sizes, args):
+	''' Rebuilds catalogue of each backend from synthetic inventory, then merges the inventory into it as restoredb does '''
+	results = {}
+
+	for size in sizes:
+		tempdir = tempfile.mkdtemp()
+
+		try:
+			with tempfile.TemporaryFile() as inventory_file:
+				synthetic_inventory(inventory_file, size)
+
+				for extension in ('files', 'sqlite'):
+					inventory_file.seek(0)
+					METRICS.reset()
+
+					database = open_local_database(os.path.join(tempdir, 'catalogue.' + extension))
+					elapsed = timed(lambda: database.restore_from_amazon(iter_inventory_archives(inventory_file)))
+
+					key = 'restoredb/%s/%d' % (extension, size)
+					results[key] = elapsed
+					results[key + '/db_write'] = METRICS.report()['phases'].get('db_write', {}).get('seconds', 0)
+
+					# what restoredb does now: the same inventory merged into the catalogue it matches
+					inventory_file.seek(0)
+					header = {}
+					merged = timed(lambda: database.merge_from_amazon(iter_inventory_archives(inventory_file, header=header), header))
+					database.close()
+
+					results['restoredb-merge/%s/%d' % (extension, size)] = merged
+
+					print '%10d archives, %-6s catalogue: restore %.3fs (write %.3fs), merge %.3fs' % (size, extension, elapsed, results[key + '/db_write'], merged)
+		finally:
+			shutil.rmtree(tempdir)
+
+	return results
+
+# timings this short are mostly noise, they are not compared
+MIN_COMPARED_SECONDS = 0.05
+
+def git_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+	except (OSError, subprocess.CalledProcessError): # not a git checkout
+		return None
+
+def compare(results, baseline, threshold):
+	''' Prints timings next to baseline ones, returns keys that got slower by more than threshold '''
+	regressions = []
+
+	for key in sorted(results):
+		before = baseline['results'].get(key)
+
+		if before is None or before < MIN_COMPARED_SECONDS:
+			continue
+
+		change = results[key] / before - 1
+		print '%-50s %9.3fs -> %9.3fs %+6.0f%%%s' % (key, before, results[key], change * 100, ' REGRESSION' if change > threshold else '')
+
+		if change > threshold:
+			regressions.append(key)
+
+	return regressions
+
+BENCHMARKS = {
+	'differ': (benchmark_differ, [10000, 100000, 1000000]),
+	'database': (benchmark_database, [1000000]),
+	'files': (benchmark_files, [1000000]),
+	'engine': (benchmark_engine, [200]),
+	'sync': (benchmark_sync, [1000]),
+	'restoredb': (benchmark_restoredb, [1000000]),
+}
+
+def main():
+	parser = argparse.ArgumentParser(description='Runs glacsync benchmarks on synthetic data')
+	parser.add_argument('benchmark', choices=sorted(BENCHMARKS), help='Benchmark to run')
+	parser.add_argument('sizes', nargs='*', type=int, help='Number of entries, defaults depend on benchmark')
+	parser.add_argument('--max-nested', type=int, default=10000, help='Largest size the quadratic differ is run on')
+	parser.add_argument('--latency', type=float, default=0.02, help='Seconds fake Glacier server takes to answer (engine)')
+	parser.add_argument('--file-size', type=int, default=64 * 1024, help='Size of uploaded files (engine)')
+	parser.add_argument('--engines', nargs='+', choices=sorted(TRANSFER_ENGINES), default=sorted(TRANSFER_ENGINES), help='Transfer engines to compare (engine)')
+	parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16], help='Transfer concurrency levels (engine)')
+	parser.add_argument('--bandwidth', type=int, default=0, help='Bytes per second fake vault link carries, 0 means unlimited (sync)')
+	parser.add_argument('--transfer-concurrency', type=int, default=8, help='Transfer concurrency of synced files (sync)')
+	parser.add_argument('--db', choices=('files', 'sqlite'), default='files', help='Catalogue backend (sync)')
+	parser.add_argument('--output', help='JSON file timings are saved to, with commit they were measured on (sync, restoredb)')
+	parser.add_argument('--compare', help='JSON file saved by --output earlier, exit status is 1 when something got slower')
+	parser.add_argument('--threshold', type=float, default=0.2, help='Slowdown (fraction) --compare tolerates')
+
+	args = parser.parse_args()
+
+	function, default_sizes = BENCHMARKS[args.benchmark]
+	results = function(args.sizes or default_sizes, args) or {}
+
+	if args.output:
+		with open(args.output, 'w') as output:
+			json.dump({'benchmark': args.benchmark, 'commit': git_commit(), 'created_at': time.time(), 'results': results}, output, indent=1, sort_keys=True)
+
+	if args.compare:
+		with open(args.compare) as baseline_file:
+			baseline = json.load(baseline_file)
+
+		print 'Compared with %s (commit %s)' % (args.compare, baseline.get('commit'))
+
+		if compare(results, baseline, args.threshold):
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
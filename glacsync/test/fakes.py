@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#
+# Application that sync folders to Amazon Glacier.
+# https://github.com/Teeed/glacsync
+#
+# Copyright (C) 2014 Tadeusz Magura-Witkowski
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import json
+import threading
+import time
+from StringIO import StringIO
+
+from boto.glacier.layer1 import Layer1
+from boto.glacier.utils import bytes_to_hex, chunk_hashes, tree_hash
+from boto.glacier.vault import Vault
+from boto.regioninfo import RegionInfo
+
+from ..glacsync import PooledEngine, TokenBucket
+
+class FakeVaultError(Exception):
+	pass
+
+class FakeJobOutput(dict):
+	''' What Layer1.get_job_output returns: headers as dict items, body to read() '''
+	def __init__(self, data):
+		super(FakeJobOutput, self).__init__()
+		self['TreeHash'] = bytes_to_hex(tree_hash(chunk_hashes(data)))
+
+		self._body = StringIO(data)
+
+	def read(self, amt=None):
+		return self._body.read() if amt is None else self._body.read(amt)
+
+class FakeLayer1(object):
+	''' Job related part of boto.glacier.layer1.Layer1 API, backed by FakeVault '''
+	def __init__(self, vault, page_size=2):
+		super(FakeLayer1, self).__init__()
+		self.vault = vault
+		self.page_size = page_size
+
+		self.calls = dict((name, 0) for name in ('initiate_job', 'describe_job', 'list_jobs', 'get_job_output',
+			'upload_archive', 'initiate_multipart_upload', 'upload_part', 'complete_multipart_upload', 'abort_multipart_upload'))
+		self.uploads = {}
+		self.failing_part_starts = set()
+
+	def _count(self, name):
+		with self.vault._lock: # transfer workers call concurrently
+			self.calls[name] += 1
+
+	def initiate_job(self, vault_name, job_data):
+		self._count('initiate_job')
+		self.vault._call()
+
+		if job_data['Type'] == 'inventory-retrieval': # inventory of vault as it is now
+			job = {'JobId': 'job-%s' % self.vault._new_archive_id(), 'Action': 'InventoryRetrieval', 'Completed': False, 'StatusCode': 'InProgress'}
+			self.vault.jobs[job['JobId']] = job
+			self.vault.inventories[job['JobId']] = json.dumps({
+				'VaultARN': 'arn:aws:glacier:us-west-2:0:vaults/%s' % self.vault.name,
+				'InventoryDate': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+				'ArchiveList': [{'ArchiveId': archive_id, 'ArchiveDescription': description, 'Size': len(data)}
+					for archive_id, (data, description) in sorted(self.vault.archives.items())],
+			})
+
+			return {'JobId': job['JobId']}
+
+		archive_data = self.vault.archives[job_data['ArchiveId']][0]
+		job = {
+			'JobId': 'job-%s' % self.vault._new_archive_id(),
+			'Action': 'ArchiveRetrieval',
+			'ArchiveId': job_data['ArchiveId'],
+			'ArchiveSizeInBytes': len(archive_data),
+			'RetrievalByteRange': job_data.get('RetrievalByteRange'),
+			'Completed': False,
+			'StatusCode': 'InProgress',
+		}
+		self.vault.jobs[job['JobId']] = job
+
+		return {'JobId': job['JobId']}
+
+	def describe_job(self, vault_name, job_id):
+		self._count('describe_job')
+		self.vault._call()
+
+		return dict(self.vault.jobs[job_id])
+
+	def list_jobs(self, vault_name, completed=None, status_code=None, limit=None, marker=None):
+		self._count('list_jobs')
+
+		job_ids = sorted(self.vault.jobs)
+		start = job_ids.index(marker) if marker else 0
+		page = job_ids[start:start + self.page_size]
+		next_marker = job_ids[start + self.page_size] if start + self.page_size < len(job_ids) else None
+
+		return {'JobList': [dict(self.vault.jobs[job_id]) for job_id in page], 'Marker': next_marker}
+
+	def get_job_output(self, vault_name, job_id, byte_range=None):
+		self._count('get_job_output')
+		self.vault._call()
+
+		job = self.vault.jobs[job_id]
+
+		if job['Action'] == 'InventoryRetrieval':
+			return FakeJobOutput(self.vault.inventories[job_id])
+
+		data = self.vault.archives[job['ArchiveId']][0]
+
+		if job['RetrievalByteRange']:
+			first, last = map(int, job['RetrievalByteRange'].split('-'))
+			data = data[first:last + 1]
+
+		if byte_range is not None:
+			data = data[byte_range[0]:byte_range[1] + 1]
+
+		self.vault._transfer(len(data))
+		output = FakeJobOutput(data)
+
+		if self.vault.corrupt_outputs:
+			output._body = StringIO(data[:-1] + chr((ord(data[-1]) + 1) % 256))
+
+		return output
+
+	def upload_archive(self, vault_name, archive, linear_hash, tree_hash_hex, description=None):
+		self._count('upload_archive')
+		self.vault._call()
+
+		if archive.name in self.vault.failing_paths:
+			raise FakeVaultError('upload of %s failed' % archive.name)
+
+		data = archive.read()
+		self.vault._transfer(len(data))
+
+		assert linear_hash == hashlib.sha256(data).hexdigest()
+		assert tree_hash_hex == bytes_to_hex(tree_hash(chunk_hashes(data)))
+
+		archive_id = self.vault._new_archive_id()
+		self.vault.archives[archive_id] = (data, description)
+
+		return {'ArchiveId': archive_id}
+
+	def initiate_multipart_upload(self, vault_name, part_size, description=None):
+		self._count('initiate_multipart_upload')
+		self.vault._call()
+
+		upload_id = 'upload-%s' % self.vault._new_archive_id()
+		self.uploads[upload_id] = {'part_size': part_size, 'description': description, 'parts': {}}
+
+		return {'UploadId': upload_id}
+
+	def upload_part(self, vault_name, upload_id, linear_hash, tree_hash_hex, byte_range, part_data):
+		self._count('upload_part')
+		self.vault._call()
+
+		if byte_range[0] in self.failing_part_starts:
+			raise FakeVaultError('upload of part at %d failed' % byte_range[0])
+
+		upload = self.uploads[upload_id]
+		self.vault._transfer(len(part_data))
+
+		assert byte_range[0] % upload['part_size'] == 0 and byte_range[1] - byte_range[0] + 1 == len(part_data) <= upload['part_size']
+		assert linear_hash == hashlib.sha256(part_data).hexdigest()
+		assert tree_hash_hex == bytes_to_hex(tree_hash(chunk_hashes(part_data)))
+
+		upload['parts'][byte_range[0]] = part_data
+
+		return {}
+
+	def complete_multipart_upload(self, vault_name, upload_id, sha256_treehash, archive_size):
+		self._count('complete_multipart_upload')
+		self.vault._call()
+
+		upload = self.uploads.pop(upload_id)
+		data = ''.join(part_data for start, part_data in sorted(upload['parts'].items()))
+
+		assert len(data) == archive_size
+		assert sha256_treehash == bytes_to_hex(tree_hash(chunk_hashes(data)))
+
+		archive_id = self.vault._new_archive_id()
+		self.vault.archives[archive_id] = (data, upload['description'])
+
+		return {'ArchiveId': archive_id}
+
+	def abort_multipart_upload(self, vault_name, upload_id):
+		self._count('abort_multipart_upload')
+		self.vault._call()
+
+		del self.uploads[upload_id]
+
+		return {}
+
+class FakeVault(object):
+	'''
+	In-memory stand-in for boto.glacier.vault.Vault. Every call takes latency seconds, data
+	goes through one shared link of bandwidth bytes per second (0 means unlimited).
+	'''
+	def __init__(self, latency=0, failing_paths=(), bandwidth=0):
+		super(FakeVault, self).__init__()
+		self.name = 'fake-vault'
+		self.latency = latency
+		self.link = TokenBucket(bandwidth)
+		self.failing_paths = set(failing_paths)
+		self.corrupt_outputs = False
+
+		self.layer1 = FakeLayer1(self)
+		self.archives = {}
+		self.jobs = {}
+		self.inventories = {}
+		self.in_flight = 0
+		self.max_in_flight = 0
+
+		self._lock = threading.Lock()
+		self._next_id = 0
+
+	def _call(self):
+		with self._lock:
+			self.in_flight += 1
+			self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+		time.sleep(self.latency)
+
+		with self._lock:
+			self.in_flight -= 1
+
+	def _transfer(self, size):
+		self.link.consume(size)
+
+	def _new_archive_id(self):
+		with self._lock:
+			self._next_id += 1
+			return 'archive-%d' % self._next_id
+
+	def concurrent_create_archive_from_file(self, filename, description=None):
+		self._call()
+
+		if filename in self.failing_paths:
+			raise FakeVaultError('upload of %s failed' % filename)
+
+		with open(filename, 'rb') as archive_file:
+			data = archive_file.read()
+		self._transfer(len(data))
+
+		archive_id = self._new_archive_id()
+		self.archives[archive_id] = (data, description)
+
+		return archive_id
+
+	def complete_jobs(self):
+		for job in self.jobs.values():
+			job['Completed'] = True
+			job['StatusCode'] = 'Succeeded'
+
+	def delete_archive(self, archive_id):
+		self._call()
+
+		if archive_id not in self.archives:
+			raise FakeVaultError('no such archive %s' % archive_id)
+
+		del self.archives[archive_id]
+
+class FakeEngine(PooledEngine):
+	''' PooledEngine reading raw job output from FakeLayer1, as boto's HTTP request behind open_job_output can't be faked '''
+	def open_job_output(self, job_id):
+		return self.layer1.get_job_output(self.vault_name, job_id)
+
+class FakeGlacierHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	''' Accepts uploads and deletes like Glacier would, throws the data away '''
+	protocol_version = 'HTTP/1.1' # keep-alive, so client connection pooling matters
+
+	def log_message(self, format, *args):
+		pass
+
+	def _read_body(self):
+		remaining = int(self.headers.getheader('Content-Length', 0))
+
+		while remaining:
+			remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+
+	def _respond(self, status, headers=()):
+		self.server.count_request()
+		time.sleep(self.server.latency)
+
+		self.send_response(status)
+		for name, value in headers:
+			self.send_header(name, value)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def do_POST(self):
+		self._read_body()
+
+		if self.path.endswith('/multipart-uploads'):
+			self._respond(201, [('x-amz-multipart-upload-id', self.server.new_id())])
+		else: # single upload or multipart upload completion
+			self._respond(201, [('x-amz-archive-id', self.server.new_id())])
+
+	def do_PUT(self):
+		self._read_body()
+		self._respond(204)
+
+	def do_DELETE(self):
+		self._respond(204)
+
+class FakeGlacierServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	''' Local HTTP stand-in for Glacier, answering every request after latency seconds '''
+	daemon_threads = True
+	request_queue_size = 128 # default 5 drops connects of bigger client pools
+
+	def __init__(self, latency=0):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeGlacierHandler)
+		self.latency = latency
+		self.requests = 0
+
+		self._lock = threading.Lock()
+		self._next_id = 0
+
+	def count_request(self):
+		with self._lock:
+			self.requests += 1
+
+	def new_id(self):
+		with self._lock:
+			self._next_id += 1
+			return 'archive-%d' % self._next_id
+
+	def start(self):
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def vault(self, name='fake-vault'):
+		''' boto Vault talking to this server, with fresh connection pool '''
+		region = RegionInfo(name='us-east-1', endpoint=self.server_address[0])
+		layer1 = Layer1(aws_access_key_id='fake', aws_secret_access_key='fake', region=region, is_secure=False, port=self.server_address[1])
+
+		vault = Vault(layer1)
+		vault.name = name
+
+		return vault
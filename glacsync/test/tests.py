@@ -23,8 +23,10 @@ from datetime import datetime, timedelta
 import tempfile
 import time
 import copy
+from StringIO import StringIO
 
 from ..glacsync import *
+from .fakes import FakeEngine, FakeVault
 
 class Struct:
 	def __init__(self, **entries): 
@@ -110,18 +112,240 @@ class TestSimpleDiffer(unittest.TestCase):
 	def test_mixed(self):
 		self._test([1, 2, 3], [2, 3, 4], [1], [4], [(2, 2), (3, 3)])
 
+	def test_stream_pairs_by_path(self):
+		local = FileTested(path='path/1.txt')
+		remote = FileTested(path='path/1.txt', uuid='remote')
+
+		differ = SimpleDiffer(set([local, FileTested(path='path/2.txt')]), set([remote, FileTested(path='path/3.txt')]))
+		stream = sorted(differ.stream())
+
+		self.assertEqual([bucket for bucket, item in stream], ['deleted_files', 'maybe_modified_files', 'new_files'])
+		self.assertIs(stream[1][1][0], local)
+		self.assertIs(stream[1][1][1], remote)
+
 
 class TestLastModifiedDiffer(unittest.TestCase):
-	def test_local_newer(self):
-		differ = LastModifiedDiffer(200, 100)
+	MTIME = 1403644047.123456
 
-		self.assertTrue(differ.local_is_modified)
+	def _is_modified(self, local_mtime, local_size=10, tolerance=0, **changes):
+		catalogued = LocalFile('share/1.txt', 10, self.MTIME, 1)
+		file_entry = GlacierLocalDatabase._file_entry(catalogued, 'uuid')
+		file_entry.update(changes)
+
+		return LastModifiedDiffer(LocalFile('share/1.txt', local_size, local_mtime, 1), RemoteFile(file_entry), tolerance).local_is_modified
+
+	def test_local_newer(self):
+		self.assertTrue(self._is_modified(self.MTIME + 100))
+		self.assertTrue(self._is_modified(self.MTIME + 0.001))
 
 	def test_local_older(self):
-		differ = LastModifiedDiffer(100, 200)
+		self.assertFalse(self._is_modified(self.MTIME - 100))
+
+	def test_sub_second_mtime_unchanged(self):
+		self.assertFalse(self._is_modified(self.MTIME))
+
+	def test_size_changed(self):
+		self.assertTrue(self._is_modified(self.MTIME, local_size=11))
+
+	def test_tolerance(self):
+		self.assertFalse(self._is_modified(self.MTIME + 1.5, tolerance=2))
+		self.assertTrue(self._is_modified(self.MTIME + 2.5, tolerance=2))
+
+	def test_entry_without_mtime_ns(self):
+		''' Catalogued by older version, only whole seconds of wall clock time known '''
+		self.assertFalse(self._is_modified(self.MTIME, mtime_ns=None))
+		self.assertFalse(self._is_modified(self.MTIME + 0.5, mtime_ns=None))
+		self.assertTrue(self._is_modified(self.MTIME + 1, mtime_ns=None))
+
+class TestLastModifiedDifferTimezones(unittest.TestCase):
+	''' Catalogue must not depend on time zone or DST of the host '''
+	def setUp(self):
+		self.original_tz = os.environ.get('TZ')
+
+	def tearDown(self):
+		self._set_tz(self.original_tz)
+
+	def _set_tz(self, tz):
+		if tz is None:
+			os.environ.pop('TZ', None)
+		else:
+			os.environ['TZ'] = tz
 
-		self.assertFalse(differ.local_is_modified)
+		time.tzset()
+
+	def _catalogue(self, mtime):
+		return RemoteFile(GlacierLocalDatabase._file_entry(LocalFile('share/1.txt', 10, mtime, 1), 'uuid'))
+
+	def _is_modified(self, local_mtime, remote_file):
+		return LastModifiedDiffer(LocalFile('share/1.txt', 10, local_mtime, 1), remote_file).local_is_modified
+
+	def test_unchanged_in_any_timezone(self):
+		for tz in ('UTC', 'Europe/Warsaw', 'America/New_York', 'Australia/Lord_Howe'):
+			self._set_tz(tz)
+
+			for mtime in (1403644047.25, 1414283400.5, 1396141200.75): # summer, DST end, DST start in Warsaw
+				self.assertFalse(self._is_modified(mtime, self._catalogue(mtime)), '%s %s' % (tz, mtime))
+
+	def test_host_timezone_changed(self):
+		self._set_tz('America/New_York')
+		remote_file = self._catalogue(1403644047.5)
+
+		self._set_tz('Europe/Warsaw')
+		self.assertFalse(self._is_modified(1403644047.5, remote_file))
+		self.assertTrue(self._is_modified(1403644048.5, remote_file))
+
+	def test_repeated_hour_at_dst_end(self):
+		''' 02:30 happens twice on 2014-10-26 in Warsaw, modification an hour later must still count '''
+		self._set_tz('Europe/Warsaw')
+		remote_file = self._catalogue(1414283400) # 02:30 CEST
+
+		self.assertEqual(time.localtime(1414283400)[:6], time.localtime(1414283400 + 3600)[:6])
+		self.assertTrue(self._is_modified(1414283400 + 3600, remote_file)) # 02:30 CET
+
+	def test_sync_in_non_utc_timezone(self):
+		''' Files with sub-second mtimes used to be uploaded again on every run '''
+		self._set_tz('Europe/Warsaw')
+		tempdir = tempfile.mkdtemp()
+
+		try:
+			sharedir = os.path.join(tempdir, 'share')
+			os.mkdir(sharedir)
+
+			path = os.path.join(sharedir, 'file.txt')
+			with open(path, 'w') as share_file:
+				share_file.write('data')
+			os.utime(path, (1414283400.25, 1414283400.25))
+
+			vault = FakeVault()
+			glacier_sync = GlacierSync(None, os.path.join(tempdir, 'config.ini.files'), False, [sharedir], vault=vault)
+			glacier_sync.sync()
+			glacier_sync.sync()
+
+			self.assertEqual(len(vault.archives), 1)
+		finally:
+			import shutil
+			shutil.rmtree(tempdir)
 	
+class TestTreeHashFile(unittest.TestCase):
+	def runTest(self):
+		from boto.glacier.utils import compute_hashes_from_fileobj
+
+		for size in (0, 1, MEGABYTE, 2 * MEGABYTE + MEGABYTE // 2):
+			with tempfile.NamedTemporaryFile() as hashed_file:
+				hashed_file.write(os.urandom(size))
+				hashed_file.flush()
+				hashed_file.seek(0)
+
+				self.assertEqual(tree_hash_file(hashed_file.name), compute_hashes_from_fileobj(hashed_file)[1])
+
+class TestExternalSort(unittest.TestCase):
+	def test_sort(self):
+		items = [[key, index] for index, key in enumerate([5, 3, 9, 3, 1, 7, 3])]
+
+		for run_size in (1, 3, 100):
+			self.assertEqual(list(external_sort(items, lambda item: item[0], run_size)), sorted(items))
+
+		self.assertEqual(list(external_sort([], lambda item: item, 2)), [])
+
+	def test_merge_join(self):
+		joined = list(merge_join([1, 2, 2, 4], [2, 3, 4, 4], lambda item: item, lambda item: item))
+
+		self.assertEqual(joined, [(1, [1], []), (2, [2, 2], [2]), (3, [], [3]), (4, [4], [4, 4])])
+
+class TestChunkFile(unittest.TestCase):
+	def _chunks(self, data, average_size=4096):
+		with tempfile.NamedTemporaryFile() as chunked_file:
+			chunked_file.write(data)
+			chunked_file.flush()
+
+			return chunk_file(chunked_file.name, average_size)
+
+	def test_chunks_cover_file(self):
+		data = os.urandom(200 * 1024)
+		chunks = self._chunks(data)
+
+		self.assertEqual(sum(length for chunk_hash, offset, length in chunks), len(data))
+		self.assertTrue(all(1024 <= length <= 16384 for chunk_hash, offset, length in chunks[:-1]))
+
+		for chunk_hash, offset, length in chunks:
+			self.assertEqual(hashlib.sha256(data[offset:offset + length]).hexdigest(), chunk_hash)
+
+		self.assertEqual(self._chunks(''), [])
+
+	def test_insert_keeps_other_chunks(self):
+		data = os.urandom(200 * 1024)
+		changed = data[:100 * 1024] + 'inserted' + data[100 * 1024:]
+
+		hashes = set(chunk_hash for chunk_hash, offset, length in self._chunks(data))
+		changed_hashes = [chunk_hash for chunk_hash, offset, length in self._chunks(changed)]
+
+		# only chunks around the insert are new
+		self.assertLessEqual(len([chunk_hash for chunk_hash in changed_hashes if chunk_hash not in hashes]), 3)
+
+class TestContentHashDiffer(unittest.TestCase):
+	def setUp(self):
+		self.tempfile = tempfile.NamedTemporaryFile()
+		self.tempfile.write('content')
+		self.tempfile.flush()
+
+		self.local_file = LocalFile(self.tempfile.name)
+
+	def _remote(self, **changes):
+		file_entry = GlacierLocalDatabase._file_entry(self.local_file, 'uuid')
+		file_entry['tree_hash'] = tree_hash_file(self.tempfile.name)
+		file_entry.update(changes)
+
+		return RemoteFile(file_entry)
+
+	def _is_modified(self, remote_file):
+		return ContentHashDiffer(self.local_file, remote_file).local_is_modified
+
+	def test_unchanged_not_hashed(self):
+		self.assertFalse(self._is_modified(self._remote(tree_hash='not even a hash')))
+		self.assertIsNone(self.local_file.cached_tree_hash)
+
+	def test_touched(self):
+		self.assertFalse(self._is_modified(self._remote(mtime_ns=self.local_file.mtime_ns - 100 * NANOSECONDS)))
+		self.assertIsNotNone(self.local_file.cached_tree_hash)
+
+	def test_changed_content(self):
+		self.assertTrue(self._is_modified(self._remote(mtime_ns=self.local_file.mtime_ns - 100 * NANOSECONDS, tree_hash=tree_hash_file(__file__))))
+
+	def test_changed_size(self):
+		self.assertTrue(self._is_modified(self._remote(size=1)))
+
+	def test_no_remote_hash(self):
+		self.assertTrue(self._is_modified(self._remote(mtime_ns=self.local_file.mtime_ns - 100 * NANOSECONDS, tree_hash=None)))
+
+	def test_needs_tree_hash(self):
+		touched = ContentHashDiffer(self.local_file, self._remote(mtime_ns=self.local_file.mtime_ns - 100 * NANOSECONDS))
+
+		self.assertFalse(ContentHashDiffer(self.local_file, self._remote()).needs_tree_hash)
+		self.assertFalse(ContentHashDiffer(self.local_file, self._remote(size=1, mtime_ns=0)).needs_tree_hash)
+		self.assertTrue(touched.needs_tree_hash)
+
+		touched.local_is_modified
+		self.assertFalse(touched.needs_tree_hash)
+
+	def test_parallel_hashing(self):
+		remote_file = self._remote(mtime_ns=self.local_file.mtime_ns - 100 * NANOSECONDS)
+		cpu_pool = CpuPool(2)
+
+		try:
+			differ_runner = DifferRunner(Struct(files=[self.local_file]), Struct(files=[remote_file]), [ContentHashDiffer], cpu_pool=cpu_pool)
+
+			self.assertEqual(differ_runner.differences['modified_files'], set())
+			self.assertEqual(self.local_file.cached_tree_hash, remote_file.tree_hash)
+		finally:
+			cpu_pool.close()
+
+	def test_hash_stored_in_catalogue(self):
+		self.local_file.tree_hash
+		file_entry = GlacierLocalDatabase._file_entry(self.local_file, 'uuid')
+
+		self.assertEqual(file_entry['tree_hash'], tree_hash_file(self.tempfile.name))
+		self.assertEqual(file_entry['size'], len('content'))
+
 class TestDifferRunner(unittest.TestCase):
 	class FilesystemObject(object):
 		def __init__(self, files):
@@ -184,8 +408,149 @@ class TestLocalFilesystem(unittest.TestCase):
 		for i in range(10):
 			self.assertIsInstance(files.pop(), LocalFile)
 
+class TestLocalFilesystemRecursive(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+
+		for relative_path in ('a.txt', 'b.tmp', 'sub/c.txt', 'sub/deeper/d.txt', 'sub/.cache/e.txt', 'other/f.log'):
+			path = os.path.join(self.tempdir, relative_path)
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+
+			with open(path, 'w') as test_file:
+				test_file.write(relative_path)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tempdir)
+
+	def _files(self, **options):
+		local_filesystem = LocalFilesystem(self.tempdir, **options)
+
+		return sorted(os.path.relpath(local_file.path, self.tempdir) for local_file in local_filesystem.files)
+
+	def test_recursive(self):
+		self.assertEqual(self._files(), ['a.txt', 'b.tmp', 'other/f.log', 'sub/.cache/e.txt', 'sub/c.txt', 'sub/deeper/d.txt'])
+
+	def test_threaded(self):
+		self.assertEqual(self._files(scan_threads=4), self._files())
+
+	def test_exclude(self):
+		self.assertEqual(self._files(exclude=['*.tmp', '.cache', 'sub/deeper']), ['a.txt', 'other/f.log', 'sub/c.txt'])
+
+	def test_include(self):
+		self.assertEqual(self._files(include=['*.txt'], exclude=['sub/*']), ['a.txt'])
+
+	def test_stat_captured_once(self):
+		local_file = [local_file for local_file in LocalFilesystem(self.tempdir).files if local_file.path.endswith('a.txt')][0]
+		file_stat = os.stat(local_file.path)
+
+		self.assertEqual((local_file.size, local_file.mtime, local_file.inode), (file_stat.st_size, file_stat.st_mtime, file_stat.st_ino))
+
+		os.unlink(local_file.path)
+		self.assertEqual(local_file.last_modified, datetime.fromtimestamp(file_stat.st_mtime))
+
+	def test_unreadable_directory(self):
+		with self.assertRaises(OSError):
+			list(LocalFilesystem(os.path.join(self.tempdir, 'missing'), scan_threads=2).files)
+
+	def test_file_removed_while_listing(self):
+		module = sys.modules[LocalFilesystem.__module__]
+		module_scandir, listdir = module.scandir, os.listdir
+		module.scandir = None # only os.listdir can be made to report a file that isn't there
+		os.listdir = lambda directory: listdir(directory) + ['removed.tmp']
+
+		try:
+			self.assertEqual(self._files(), ['a.txt', 'b.tmp', 'other/f.log', 'sub/.cache/e.txt', 'sub/c.txt', 'sub/deeper/d.txt'])
+		finally:
+			module.scandir, os.listdir = module_scandir, listdir
+
+class TestScanCache(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.sharedir = os.path.join(self.tempdir, 'share')
+		os.makedirs(os.path.join(self.sharedir, 'sub'))
+		self.cachefilename = os.path.join(self.tempdir, 'config.ini.scancache')
+
+		for relative_path in ('a.txt', 'sub/b.txt'):
+			self._write(relative_path, relative_path)
+
+		self._scan().scan_cache.save()
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tempdir)
+
+	def _write(self, relative_path, data):
+		with open(os.path.join(self.sharedir, relative_path), 'w') as test_file:
+			test_file.write(data)
+
+	def _scan(self, **options):
+		local_filesystem = LocalFilesystem(self.sharedir, scan_cache=ScanCache(self.cachefilename), **options)
+		local_filesystem.listed = []
+
+		list_directory = local_filesystem._list_directory
+		def counting_list_directory(root, directory):
+			local_filesystem.listed.append(os.path.relpath(directory, self.sharedir))
+			return list_directory(root, directory)
+		local_filesystem._list_directory = counting_list_directory
+
+		local_filesystem.scanned = dict((os.path.relpath(local_file.path, self.sharedir), local_file) for local_file in local_filesystem.files)
+
+		return local_filesystem
+
+	def test_unchanged_directories_not_listed(self):
+		local_filesystem = self._scan()
+
+		self.assertEqual(local_filesystem.listed, [])
+		self.assertEqual(sorted(local_filesystem.scanned), ['a.txt', 'sub/b.txt'])
+
+	def test_changed_directory_listed(self):
+		self._write('sub/c.txt', 'c')
+		os.utime(os.path.join(self.sharedir, 'sub'), (time.time() + 10, time.time() + 10))
+
+		local_filesystem = self._scan()
+
+		self.assertEqual(local_filesystem.listed, ['sub'])
+		self.assertEqual(sorted(local_filesystem.scanned), ['a.txt', 'sub/b.txt', 'sub/c.txt'])
+
+	def test_modification_in_unchanged_directory(self):
+		self._write('a.txt', 'modified a')
+
+		local_filesystem = self._scan()
+		self.assertEqual(local_filesystem.scanned['a.txt'].size, len('modified a'))
+		self.assertFalse(local_filesystem.scan_cache.unchanged(local_filesystem.scanned['a.txt']))
+		self.assertTrue(local_filesystem.scan_cache.unchanged(local_filesystem.scanned['sub/b.txt']))
+
+		# trusting directory mtime we don't even look at the file
+		local_filesystem = self._scan(trust_directory_mtime=True)
+		self.assertEqual(local_filesystem.scanned['a.txt'].size, len('a.txt'))
+
+	def test_forget(self):
+		local_filesystem = self._scan()
+		local_filesystem.scan_cache.forget(os.path.join(self.sharedir, 'sub', 'b.txt'))
+		local_filesystem.scan_cache.save()
+
+		local_filesystem = self._scan(trust_directory_mtime=True)
+
+		self.assertEqual(local_filesystem.listed, ['sub'])
+		self.assertFalse(local_filesystem.scan_cache.unchanged(local_filesystem.scanned['sub/b.txt']))
+
+	def test_signature_change_invalidates(self):
+		ScanCache(self.cachefilename, signature={'exclude': ['*.tmp']}).save()
+
+		self.assertEqual(self._scan().listed, ['.', 'sub'])
+
+	def test_differ_runner_skips_unchanged(self):
+		local_filesystem = self._scan()
+		remote_files = [FileTested(path=local_file.path) for local_file in local_filesystem.scanned.values()]
+
+		differ_runner = DifferRunner(local_filesystem, TestDifferRunner.FilesystemObject(remote_files), [lambda local, remote: self.fail('differ called')], local_filesystem.scan_cache)
+
+		self.assertEqual(differ_runner.differences['modified_files'], set([]))
+
 class TestRemoteFile(unittest.TestCase):
-	def runTest(self):
+	def test_fields(self):
 		file_data = {
 			'uuid': 'test uuIDd',
 			'path': 'share/test1.txt',
@@ -197,6 +562,21 @@ class TestRemoteFile(unittest.TestCase):
 		self.assertEqual(remote_file.last_modified, datetime.utcfromtimestamp(file_data['last_modified']))
 		self.assertEqual(remote_file.uuid, file_data['uuid'])
 		self.assertEqual(remote_file.path, file_data['path'])
+		self.assertEqual(remote_file.file_json_data, file_data)
+		self.assertFalse(hasattr(remote_file, '__dict__'))
+
+	def test_unknown_fields_kept(self):
+		file_data = {'uuid': 'uuid', 'path': 'share/test1.txt', 'last_modified': 1403651231, 'uploaded_at': 1403651231, 'size': 10, 'future_field': [1, 2]}
+
+		self.assertEqual(RemoteFile(file_data).file_json_data, file_data)
+
+	def test_compared_as_catalogue_stores_time(self):
+		local_file = LocalFile(__file__)
+		file_data = {'uuid': 'uuid', 'path': __file__, 'last_modified': timegm(local_file.last_modified.timetuple())}
+
+		self.assertFalse(RemoteFile(file_data) > local_file)
+		self.assertEqual(local_file > RemoteFile(file_data), local_file.mtime % 1 != 0)
+		self.assertTrue(local_file > RemoteFile(dict(file_data, last_modified=file_data['last_modified'] - 1)))
 
 class TestGlacierLocalDatabaseFile(unittest.TestCase):
 	def _create_empty_db(self):
@@ -330,10 +710,1820 @@ class TestGlacierLocalDatabaseFile(unittest.TestCase):
 			'last_modified': 1403644047,
 			'path': 'share/testtest.txt',
 			'uploaded_at': 1403644047,
-			'uuid': '123456'}
+			'uuid': '123456',
+			'size': 32,
+			'tree_hash': 'ce4b64e5ba4e4a37bbb39b8361352270d5cb6c403d84d5898f79fa61a7ff6dda'}
 		])
 
+	def test_mutations_only_append_to_journal(self):
+		self._create_empty_db()
+		snapshot = open(self.dbfile.name).read()
+
+		fileobj1, fileobj2 = self._add_two_files()
+
+		self.assertEqual(open(self.dbfile.name).read(), snapshot)
+		self.assertEqual(len(open(self.localdatabase.journal_filename).readlines()), 2)
+
+		self._test_if_db_files_is([fileobj1, fileobj2])
+
+	def test_compact(self):
+		self._create_empty_db()
+
+		fileobj1, fileobj2 = self._add_two_files()
+		self.localdatabase.write()
+
+		self.assertFalse(os.path.exists(self.localdatabase.journal_filename))
+		self._test_if_db_files_is([fileobj1, fileobj2])
+
+	def test_compact_every(self):
+		self._create_empty_db()
+		self.localdatabase.compact_every = 2
+
+		fileobj1, fileobj2 = self._add_two_files()
+
+		self.assertFalse(os.path.exists(self.localdatabase.journal_filename))
+		self._test_if_db_files_is([fileobj1, fileobj2])
+
+	def test_torn_journal_record(self):
+		self._create_empty_db()
+
+		fileobj1, fileobj2 = self._add_two_files()
+		self.localdatabase.close()
+
+		with open(self.localdatabase.journal_filename, 'a') as journal:
+			journal.write('{"op": "delete_file", "uu')
+
+		self._test_if_db_files_is([fileobj1, fileobj2])
+
+		# broken tail is cut off, so new records land on a clean line
+		self.localdatabase.delete_file(Struct(uuid='1234567'))
+		self._test_if_db_files_is([fileobj2])
+
+	def test_journal_already_in_snapshot(self):
+		''' Crash after snapshot was replaced but before journal was removed '''
+		self._create_empty_db()
+
+		fileobj1, fileobj2 = self._add_two_files()
+		self.localdatabase.close()
+		journal = open(self.localdatabase.journal_filename).read()
+
+		self.localdatabase.write()
+		with open(self.localdatabase.journal_filename, 'w') as journal_file:
+			journal_file.write(journal)
+
+		self._test_if_db_files_is([fileobj1, fileobj2])
+
+	def test_job_parts(self):
+		self._create_empty_db()
+
+		job = MultipartUploadJob({'uuid': 'upload', 'path': 'share/1.txt', 'size': 3 * MEGABYTE, 'last_modified': 1403701810, 'part_size': MEGABYTE, 'parts': {}})
+		self.localdatabase.add_pending_job(job)
+		self.localdatabase.add_job_part(job, 2, 'abcd')
+		self.localdatabase.close()
+
+		self._read_database()
+		jobs = list(self.localdatabase.pending_jobs)
+		self.assertIsInstance(jobs[0], MultipartUploadJob)
+		self.assertEqual(jobs[0].parts, {'2': 'abcd'})
+		self.assertEqual(jobs[0].missing_parts, [0, 1])
+
+	def test_delete_queue(self):
+		self._create_empty_db()
+
+		for uuid, uploaded_at in (('b', 300), ('a', 100), ('c', 200)):
+			self.localdatabase.queue_delete(Struct(uuid=uuid, path='share/%s.txt' % uuid, uploaded_at_epoch=uploaded_at))
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual([queued.uuid for queued in self.localdatabase.due_deletes(200)], ['a', 'c'])
+		self.assertEqual(self.localdatabase.count_queued_deletes(), 3)
+
+		for queued in self.localdatabase.due_deletes(200):
+			self.localdatabase.dequeue_delete(queued)
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual([(queued.uuid, queued.path) for queued in self.localdatabase.due_deletes()], [('b', 'share/b.txt')])
+
+	def test_chunk_index(self):
+		self._create_empty_db()
+
+		self.localdatabase.add_chunks('archive1', [['a', 0, 10], ['b', 10, 20]])
+		self.localdatabase.add_chunks('archive2', [['b', 0, 20], ['c', 20, 5]], 'zlib')
+		self.localdatabase.retain_chunks(['a', 'b', 'b'])
+		self.localdatabase.retain_chunks(['c'])
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual(self.localdatabase.chunk_locations(['a', 'b', 'c', 'd']), {'a': ('archive1', 0, 10, None), 'b': ('archive1', 10, 20, None), 'c': ('archive2', 20, 5, 'zlib')})
+
+		self.assertEqual(self.localdatabase.release_chunks(['a', 'b']), [])
+		self.assertEqual(self.localdatabase.release_chunks(['c']), ['archive2'])
+		self.assertEqual(self.localdatabase.release_chunks(['b']), ['archive1'])
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual(list(self.localdatabase.chunks), [])
+
+	def test_snapshots(self):
+		self._create_empty_db()
+
+		fileobj1, fileobj2 = self._add_two_files()
+		self.assertEqual(self.localdatabase.add_snapshot(100), 1)
+
+		fileobj3 = Struct(path='share/3.txt', last_modified=datetime.utcfromtimestamp(1403701810))
+		self.localdatabase.add_file(fileobj3, '3234567')
+		self.localdatabase.retire_file(Struct(uuid='1234567', path='share/1.txt', offset=None))
+		self.assertEqual(self.localdatabase.add_snapshot(200), 2)
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual(list(self.localdatabase.snapshot_files(1)), [fileobj2, fileobj1])
+		self.assertEqual(list(self.localdatabase.snapshot_files(2)), [fileobj2, fileobj3])
+		self.assertEqual(list(self.localdatabase.files), [fileobj2, fileobj3])
+		self.assertEqual([(remote_file.uuid, remote_file.retired) for remote_file in self.localdatabase.versions], [('1234567', 2)])
+		self.assertEqual(self.localdatabase.count_archive_members('1234567'), 1)
+
+		self.localdatabase.drop_snapshot(1)
+		self.localdatabase.delete_file(Struct(uuid='1234567', offset=None))
+		self.localdatabase.close()
+
+		self._read_database()
+		self.assertEqual(self.localdatabase.snapshots, [(2, 200)])
+		self.assertEqual(list(self.localdatabase.versions), [])
+
+	def test_merge_from_amazon(self):
+		self._create_empty_db()
+
+		self._add_two_files()
+		self.localdatabase.queue_delete(Struct(uuid='queued', path='share/queued.txt', uploaded_at_epoch=100))
+		reported = []
+
+		# inventory made long after our uploads: 2.txt should be there, it's a phantom
+		counts = self.localdatabase.merge_from_amazon([
+			{'ArchiveId': '1234567', 'Size': 10, 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': 'new', 'ArchiveDescription': '{"path": "share/new.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'},
+			{'ArchiveId': 'pack', 'ArchiveDescription': '{"pack": true, "files": 3, "uploaded_at": 1403644047}'},
+			{'ArchiveId': 'queued', 'ArchiveDescription': '{"path": "share/queued.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'},
+		], {'InventoryDate': '2100-01-01T00:00:00Z'}, run_size=2, report=lambda kind, item: reported.append((kind, item.get('uuid', item.get('ArchiveId')))))
+		self.localdatabase.close()
+
+		self.assertEqual(counts, {'archives': 4, 'added': 1, 'orphaned': 1, 'phantom': 1, 'fixed': 1, 'kept': 0, 'superseded': 0})
+		self.assertEqual(sorted(reported), [('fixed', '1234567'), ('orphaned', 'pack'), ('phantom', '2234567')])
+
+		self._read_database()
+		self.assertEqual(sorted((remote_file.uuid, remote_file.size) for remote_file in self.localdatabase.files), [('1234567', 10), ('new', None)])
+
+		# entries uploaded after inventory was made are kept
+		counts = self.localdatabase.merge_from_amazon([], {'InventoryDate': '2014-07-01T00:00:00Z'})
+		self.assertEqual((counts['phantom'], counts['kept']), (1, 1))
+		self.assertEqual([remote_file.uuid for remote_file in self.localdatabase.files], ['1234567'])
+
+	def test_merge_newer_archive_supersedes_entry(self):
+		self._create_empty_db()
+		self._add_two_files()
+
+		# catalogue missed later upload of 1.txt
+		counts = self.localdatabase.merge_from_amazon([
+			{'ArchiveId': '1234567', 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': '2234567', 'ArchiveDescription': '{"path": "share/2.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': 'newer', 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 4102444800, "uploaded_at": 4102444800}'},
+		], {'InventoryDate': '2100-01-01T00:00:00Z'})
+		self.localdatabase.close()
+		self._read_database()
+
+		self.assertEqual((counts['added'], counts['superseded'], counts['orphaned']), (1, 1, 0))
+		self.assertEqual(sorted((remote_file.path, remote_file.uuid) for remote_file in self.localdatabase.files), [('share/1.txt', 'newer'), ('share/2.txt', '2234567')])
+		self.assertEqual(list(self.localdatabase.due_deletes()), []) # restoredb doesn't delete archives
+
+
+class TestGlacierLocalDatabaseSqlite(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.dbfilename = os.path.join(self.tempdir, 'catalogue.sqlite')
+		self.localdatabase = open_local_database(self.dbfilename)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tempdir)
+
+	def _reopen(self):
+		self.localdatabase.close()
+		self.localdatabase = open_local_database(self.dbfilename)
+
+	def _add_two_files(self):
+		last_modified_date = datetime.utcfromtimestamp(1403701810)
+		fileobj1 = Struct(path='share/1.txt', last_modified=last_modified_date)
+		self.localdatabase.add_file(fileobj1, '1234567')
+
+		fileobj2 = Struct(path='share/2.txt', last_modified=last_modified_date)
+		self.localdatabase.add_file(fileobj2, '2234567')
+
+		return (fileobj1, fileobj2)
+
+	def test_backend_selected_by_extension(self):
+		self.assertIsInstance(self.localdatabase, GlacierLocalDatabaseSqlite)
+		self.assertIsInstance(open_local_database(os.path.join(self.tempdir, 'config.ini.files')), GlacierLocalDatabaseFile)
+
+	def test_add_and_delete_file(self):
+		fileobj1, fileobj2 = self._add_two_files()
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.files), [fileobj1, fileobj2])
+		self.assertEqual([remote_file.uuid for remote_file in self.localdatabase.files], ['1234567', '2234567'])
+
+		self.localdatabase.delete_file(Struct(uuid='1234567'))
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.files), [fileobj2])
+
+	def test_batched_commit(self):
+		self.localdatabase.commit_every = 2
+		other_connection = sqlite3.connect(self.dbfilename)
+		count = lambda: other_connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+		self.localdatabase.add_file(Struct(path='share/1.txt', last_modified=datetime.now()), '1')
+		self.assertEqual(count(), 0)
+
+		self.localdatabase.add_file(Struct(path='share/2.txt', last_modified=datetime.now()), '2')
+		self.assertEqual(count(), 2)
+
+	def test_pending_jobs(self):
+		job1 = RetreiveInvetoryJob('12345')
+		job2 = PendingJob('123456')
+		self.localdatabase.add_pending_job(job1)
+		self.localdatabase.add_pending_job(job2)
+		self._reopen()
+
+		self.assertEqual(set(self.localdatabase.pending_jobs), set([job1, job2]))
+
+		self.localdatabase.delete_pending_job(job1)
+		self._reopen()
+
+		jobs = list(self.localdatabase.pending_jobs)
+		self.assertEqual(jobs, [job2])
+		self.assertIsInstance(jobs[0], PendingJob)
+
+	def test_job_parts(self):
+		job = MultipartUploadJob({'uuid': 'upload', 'path': 'share/1.txt', 'size': 3 * MEGABYTE, 'last_modified': 1403701810, 'part_size': MEGABYTE, 'parts': {'0': 'ab'}})
+		self.localdatabase.add_pending_job(job)
+		self.localdatabase.add_job_part(job, 2, 'cd')
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.pending_jobs)[0].parts, {'0': 'ab', '2': 'cd'})
+
+		self.localdatabase.delete_pending_job(job)
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.pending_jobs), [])
+		self.assertEqual(self.localdatabase._connection.execute('SELECT COUNT(*) FROM job_parts').fetchone()[0], 0)
+
+	def test_delete_queue(self):
+		for i in range(7):
+			self.localdatabase.queue_delete(Struct(uuid='archive-%d' % i, path='share/%d.txt' % i, uploaded_at_epoch=100 * (i % 3)))
+		self._reopen()
+
+		# paged read keeps going right while entries are dequeued under it
+		due = []
+		for queued in self.localdatabase.due_deletes(100, page_size=2):
+			due.append(queued.uuid)
+			self.localdatabase.dequeue_delete(queued)
+
+		self.assertEqual(due, ['archive-0', 'archive-3', 'archive-6', 'archive-1', 'archive-4'])
+		self._reopen()
+
+		self.assertEqual([queued.uuid for queued in self.localdatabase.due_deletes()], ['archive-2', 'archive-5'])
+		self.assertEqual(self.localdatabase.count_queued_deletes(), 2)
+
+	def test_queued_archive_skipped_on_restore(self):
+		self.localdatabase.queue_delete(Struct(uuid='old', path='share/testtest.txt', uploaded_at_epoch=1403644047))
+
+		self.localdatabase.restore_from_amazon([{'ArchiveId': archive_id,
+			'ArchiveDescription': '{"path": "share/testtest.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'} for archive_id in ('old', 'new')])
+
+		self.assertEqual([remote_file.uuid for remote_file in self.localdatabase.files], ['new'])
+
+	def test_evil_job(self):
+		self.localdatabase.add_pending_job(Struct(uuid='evil'))
+
+		with self.assertRaises(InvalidJobTypeException):
+			list(self.localdatabase.pending_jobs)
+
+	def test_amazon_restore(self):
+		self._add_two_files()
+
+		self.localdatabase.restore_from_amazon([{'ArchiveId': '123456',
+			'ArchiveDescription': '{"path": "share/testtest.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'}])
+		self._reopen()
+
+		self.assertEqual([remote_file.file_json_data for remote_file in self.localdatabase.files], [{
+			'last_modified': 1403644047,
+			'path': 'share/testtest.txt',
+			'uploaded_at': 1403644047,
+			'uuid': '123456'}
+		])
+
+	def test_amazon_restore_encoded(self):
+		self.localdatabase.restore_from_amazon([{'ArchiveId': '123456', 'Size': 300, 'SHA256TreeHash': 'of encoded data',
+			'ArchiveDescription': '{"path": "share/log.txt", "last_modified": 1403644047, "uploaded_at": 1403644047, "codec": "zlib", "size": 5000}'}])
+
+		self.assertEqual([remote_file.file_json_data for remote_file in self.localdatabase.files], [{
+			'last_modified': 1403644047,
+			'path': 'share/log.txt',
+			'uploaded_at': 1403644047,
+			'uuid': '123456',
+			'codec': 'zlib',
+			'size': 5000,
+			'archive_size': 300}
+		])
+
+	def test_migrate_from_json(self):
+		json_database = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		json_database.add_file(Struct(path='share/1.txt', last_modified=datetime.now()), '1')
+		json_database.add_pending_job(RetreiveInvetoryJob('job'))
+
+		self.localdatabase.migrate_from(json_database)
+		self._reopen()
+
+		self.assertEqual([remote_file.file_json_data for remote_file in self.localdatabase.files], list(json_database._filedata['files']))
+		self.assertEqual(list(self.localdatabase.pending_jobs), [RetreiveInvetoryJob('job')])
+
+	def test_migrate_twice(self):
+		json_database = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		json_database.add_file(Struct(path='share/1.txt', last_modified=datetime.now()), '1')
+		json_database.add_pending_job(RetreiveInvetoryJob('job'))
+
+		self.localdatabase.migrate_from(json_database)
+		self.assertRaises(ValueError, self.localdatabase.migrate_from, json_database)
+		self._reopen()
+
+		self.assertEqual([remote_file.path for remote_file in self.localdatabase.files], ['share/1.txt'])
+		self.assertEqual(list(self.localdatabase.pending_jobs), [RetreiveInvetoryJob('job')])
+
+	def test_migrate_delete_queue(self):
+		json_database = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		json_database.queue_delete(Struct(uuid='1', path='share/1.txt', uploaded_at_epoch=100))
+
+		self.localdatabase.migrate_from(json_database)
+		self._reopen()
+
+		self.assertEqual([(queued.uuid, queued.path, queued.uploaded_at) for queued in self.localdatabase.due_deletes()], [('1', 'share/1.txt', 100)])
+
+	def test_chunk_index(self):
+		self.localdatabase.add_chunks('archive1', [['a', 0, 10], ['b', 10, 20]])
+		self.localdatabase.add_chunks('archive2', [['b', 0, 20], ['c', 20, 5]], 'zlib')
+		self.localdatabase.retain_chunks(['a', 'b', 'b'])
+		self.localdatabase.retain_chunks(['c'])
+		self._reopen()
+
+		self.assertEqual(self.localdatabase.chunk_locations(['a', 'b', 'c', 'd']), {'a': ('archive1', 0, 10, None), 'b': ('archive1', 10, 20, None), 'c': ('archive2', 20, 5, 'zlib')})
+
+		self.assertEqual(self.localdatabase.release_chunks(['a', 'b']), [])
+		self.assertEqual(self.localdatabase.release_chunks(['c']), ['archive2'])
+		self.assertEqual(self.localdatabase.release_chunks(['b']), ['archive1'])
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.chunks), [])
+
+	def test_snapshots(self):
+		fileobj1, fileobj2 = self._add_two_files()
+		self.assertEqual(self.localdatabase.add_snapshot(100), 1)
+
+		fileobj3 = Struct(path='share/3.txt', last_modified=datetime.utcfromtimestamp(1403701810))
+		self.localdatabase.add_file(fileobj3, '3234567')
+		self.localdatabase.retire_file(Struct(uuid='1234567', path='share/1.txt', offset=None))
+		self.assertEqual(self.localdatabase.add_snapshot(200), 2)
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.snapshot_files(1)), [fileobj2, fileobj1])
+		self.assertEqual(list(self.localdatabase.snapshot_files(2)), [fileobj2, fileobj3])
+		self.assertEqual(list(self.localdatabase.files), [fileobj2, fileobj3])
+		self.assertEqual([(remote_file.uuid, remote_file.retired) for remote_file in self.localdatabase.versions], [('1234567', 2)])
+		self.assertEqual(self.localdatabase.count_archive_members('1234567'), 1)
+
+		self.localdatabase.drop_snapshot(1)
+		self.localdatabase.delete_file(Struct(uuid='1234567', offset=None))
+		self._reopen()
+
+		self.assertEqual(self.localdatabase.snapshots, [(2, 200)])
+		self.assertEqual(list(self.localdatabase.versions), [])
+
+	def test_merge_from_amazon(self):
+		self._add_two_files()
+		self.localdatabase.queue_delete(Struct(uuid='queued', path='share/queued.txt', uploaded_at_epoch=100))
+		reported = []
+
+		# inventory made long after our uploads: 2.txt should be there, it's a phantom
+		counts = self.localdatabase.merge_from_amazon([
+			{'ArchiveId': '1234567', 'Size': 10, 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': 'new', 'ArchiveDescription': '{"path": "share/new.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'},
+			{'ArchiveId': 'pack', 'ArchiveDescription': '{"pack": true, "files": 3, "uploaded_at": 1403644047}'},
+			{'ArchiveId': 'queued', 'ArchiveDescription': '{"path": "share/queued.txt", "last_modified": 1403644047, "uploaded_at": 1403644047}'},
+		], {'InventoryDate': '2100-01-01T00:00:00Z'}, run_size=2, report=lambda kind, item: reported.append((kind, item.get('uuid', item.get('ArchiveId')))))
+		self._reopen()
+
+		self.assertEqual(counts, {'archives': 4, 'added': 1, 'orphaned': 1, 'phantom': 1, 'fixed': 1, 'kept': 0, 'superseded': 0})
+		self.assertEqual(sorted(reported), [('fixed', '1234567'), ('orphaned', 'pack'), ('phantom', '2234567')])
+		self.assertEqual(sorted((remote_file.uuid, remote_file.size) for remote_file in self.localdatabase.files), [('1234567', 10), ('new', None)])
+
+		# entries uploaded after inventory was made are kept
+		counts = self.localdatabase.merge_from_amazon([], {'InventoryDate': '2014-07-01T00:00:00Z'})
+		self.assertEqual((counts['phantom'], counts['kept']), (1, 1))
+		self.assertEqual([remote_file.uuid for remote_file in self.localdatabase.files], ['1234567'])
+
+	def test_merge_newer_archive_supersedes_entry(self):
+		self._add_two_files()
+
+		# catalogue missed later upload of 1.txt
+		counts = self.localdatabase.merge_from_amazon([
+			{'ArchiveId': '1234567', 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': '2234567', 'ArchiveDescription': '{"path": "share/2.txt", "last_modified": 1403701810, "uploaded_at": 1403701810}'},
+			{'ArchiveId': 'newer', 'ArchiveDescription': '{"path": "share/1.txt", "last_modified": 4102444800, "uploaded_at": 4102444800}'},
+		], {'InventoryDate': '2100-01-01T00:00:00Z'})
+		self._reopen()
+
+		self.assertEqual((counts['added'], counts['superseded'], counts['orphaned']), (1, 1, 0))
+		self.assertEqual(sorted((remote_file.path, remote_file.uuid) for remote_file in self.localdatabase.files), [('share/1.txt', 'newer'), ('share/2.txt', '2234567')])
+		self.assertEqual(list(self.localdatabase.due_deletes()), []) # restoredb doesn't delete archives
+
+	def test_migrate_snapshots(self):
+		json_database = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		json_database.add_file(Struct(path='share/1.txt', last_modified=datetime.now()), '1')
+		json_database.add_snapshot(100)
+		json_database.retire_file(Struct(uuid='1', path='share/1.txt', offset=None))
+
+		self.localdatabase.migrate_from(json_database)
+		self._reopen()
+
+		self.assertEqual(self.localdatabase.snapshots, [(1, 100)])
+		self.assertEqual([remote_file.path for remote_file in self.localdatabase.snapshot_files(1)], ['share/1.txt'])
+		self.assertEqual(list(self.localdatabase.files), [])
+
+	def test_migrate_chunk_index(self):
+		json_database = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		json_database.add_chunks('archive1', [['a', 0, 10]])
+		json_database.retain_chunks(['a'])
+
+		self.localdatabase.migrate_from(json_database)
+		self._reopen()
+
+		self.assertEqual(list(self.localdatabase.chunks), [['a', 'archive1', 0, 10, None, 1]])
+
+class TestTransferScheduler(unittest.TestCase):
+	def test_runs_concurrently(self):
+		vault = FakeVault(latency=0.05)
+		scheduler = TransferScheduler(4)
+
+		for i in range(8):
+			scheduler.submit('call %d' % i, vault._call)
+
+		self.assertEqual(scheduler.join(), [])
+		scheduler.close()
+
+		self.assertEqual(vault.max_in_flight, 4)
+
+	def test_callbacks_in_joining_thread(self):
+		scheduler = TransferScheduler(2)
+		results = []
+
+		def follow_up(value):
+			results.append((value, threading.current_thread()))
+			if value < 3:
+				scheduler.submit('follow up', lambda: value + 1, on_success=follow_up)
+
+		scheduler.submit('first', lambda: 0, on_success=follow_up)
+		scheduler.join()
+		scheduler.close()
+
+		self.assertEqual([value for value, thread in results], [0, 1, 2, 3])
+		self.assertEqual(set(thread for value, thread in results), set([threading.current_thread()]))
+
+	def test_failures_reported(self):
+		reported = []
+		scheduler = TransferScheduler(2, report=reported.append)
+
+		def fail():
+			raise ValueError('nope')
+
+		scheduler.submit('ok', lambda: 1)
+		scheduler.submit('bad', fail, on_success=lambda result: self.fail('callback of failed task called'))
+		failed = scheduler.join()
+		scheduler.close()
+
+		self.assertEqual([task.description for task in failed], ['bad'])
+		self.assertIsInstance(failed[0].error, ValueError)
+		self.assertEqual(sorted(task.description for task in reported), ['bad', 'ok'])
+
+class FakeClock(object):
+	def __init__(self, now=0):
+		self.now = now
+		self.slept = []
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.slept.append(seconds)
+		self.now += seconds
+
+class TestThrottle(unittest.TestCase):
+	def test_token_bucket(self):
+		clock = FakeClock()
+		bucket = TokenBucket(100, clock, clock.sleep)
+
+		self.assertEqual(bucket.consume(100), 0) # full second of burst
+		self.assertEqual(bucket.consume(50), 0.5)
+		self.assertEqual(bucket.consume(250), 2.5)
+
+		clock.now += 10 # idle time doesn't pile up more than a second worth
+		self.assertEqual(bucket.consume(150), 0.5)
+
+	def test_unlimited(self):
+		clock = FakeClock()
+		bucket = TokenBucket(0, clock, clock.sleep)
+
+		self.assertEqual(bucket.consume(10 ** 12), 0)
+		self.assertEqual(clock.slept, [])
+
+	def test_schedule(self):
+		clock = FakeClock(time.mktime((2014, 6, 25, 12, 0, 0, 0, 0, -1)))
+		throttle = Throttle(1000, 10, [{'from': '08:00', 'to': '18:00', 'bytes_per_second': 100}, {'from': '22:00', 'to': '06:00', 'requests_per_second': 1}], clock, clock.sleep)
+
+		self.assertEqual(throttle.limits(), (100, 0))
+
+		clock.now += 8 * 3600 # 20:00
+		self.assertEqual(throttle.limits(), (1000, 10))
+
+		clock.now += 3 * 3600 # 23:00, window wrapping midnight
+		self.assertEqual(throttle.limits(), (0, 1))
+
+		clock.now += 2 * 3600 # 01:00
+		self.assertEqual(throttle.limits(), (0, 1))
+
+	def test_counters(self):
+		clock = FakeClock()
+		throttle = Throttle(100, 0, clock=clock, sleep=clock.sleep)
+
+		for i in range(5):
+			throttle.request()
+			throttle.transfer(200)
+
+		self.assertEqual((throttle.requests, throttle.bytes_transferred), (5, 1000))
+		self.assertEqual(clock.now, 9) # first 100 bytes were burst
+		self.assertEqual(throttle.throughput, 100)
+
+		clock.now += 100
+		self.assertEqual(throttle.throughput, 0)
+
+class TestCpuPool(unittest.TestCase):
+	def setUp(self):
+		self.cpu_pool = CpuPool(2, window=3)
+
+	def tearDown(self):
+		self.cpu_pool.close()
+
+	def test_imap_bounded(self):
+		produced = []
+
+		def items():
+			for i in range(20):
+				produced.append(i)
+				yield i
+
+		results = self.cpu_pool.imap(abs, (-i for i in items()))
+
+		self.assertEqual(next(results), 0)
+		self.assertEqual(len(produced), 3) # read ahead no more than window
+		self.assertEqual(list(results), range(1, 20))
+
+	def test_call(self):
+		with tempfile.NamedTemporaryFile() as hashed_file:
+			hashed_file.write('x' * 3000000)
+			hashed_file.flush()
+
+			self.assertEqual(self.cpu_pool.call(tree_hash_file, hashed_file.name), tree_hash_file(hashed_file.name))
+
+	def test_encode(self):
+		data = ('compressible ' * 10000) + os.urandom(5000)
+		encoded = StringIO()
+		ChunkCodec('zlib').encode(StringIO(data), encoded, 4096, cpu_pool=self.cpu_pool)
+
+		decoded = StringIO()
+		ChunkCodec('zlib').decode(StringIO(encoded.getvalue()), decoded)
+		self.assertEqual(decoded.getvalue(), data)
+
+class TestChunkCodec(unittest.TestCase):
+	DATA = ('compressible ' * 10000) + os.urandom(5000)
+
+	def _round_trip(self, codec, data, chunk_size=4096):
+		encoded = StringIO()
+		written = codec.encode(StringIO(data), encoded, chunk_size)
+		self.assertEqual(written, len(encoded.getvalue()))
+
+		decoded = StringIO()
+		self.assertEqual(codec.decode(StringIO(encoded.getvalue()), decoded), len(data))
+		self.assertEqual(decoded.getvalue(), data)
+
+		return encoded.getvalue()
+
+	def test_zlib(self):
+		encoded = self._round_trip(ChunkCodec('zlib'), self.DATA)
+
+		self.assertLess(len(encoded), len(self.DATA) // 2)
+		self.assertEqual(ChunkCodec('zlib').name, 'zlib')
+
+	def test_incompressible_chunks_stored(self):
+		data = os.urandom(10000)
+
+		self.assertEqual(len(self._round_trip(ChunkCodec('zlib'), data)), len(data) + 3 * 5)
+
+	def test_empty_and_chunk_aligned(self):
+		for data in ('', 'x' * 8192):
+			self._round_trip(ChunkCodec('zlib'), data)
+
+	def test_truncated(self):
+		encoded = StringIO()
+		ChunkCodec('zlib').encode(StringIO(self.DATA), encoded, 4096)
+
+		with self.assertRaises(CodecError):
+			ChunkCodec('zlib').decode(StringIO(encoded.getvalue()[:-10]), StringIO())
+
+	def test_from_name(self):
+		self.assertEqual(ChunkCodec.from_name('zlib').compression, 'zlib')
+
+		for name in ('gzip', 'zlib+zlib'):
+			with self.assertRaises(CodecError):
+				ChunkCodec.from_name(name)
+
+		with self.assertRaises(CodecError): # no key to decrypt with
+			ChunkCodec.from_name('zlib+aes-gcm')
+
+	@unittest.skipIf(AESGCM is None, 'cryptography module is not installed')
+	def test_encrypted(self):
+		key = os.urandom(32)
+		encoded = self._round_trip(ChunkCodec('zlib', key), self.DATA)
+		self.assertNotIn('compressible', encoded)
+		self.assertEqual(ChunkCodec.from_name('zlib+aes-gcm', key).name, 'zlib+aes-gcm')
+
+		with self.assertRaises(CodecError):
+			ChunkCodec('zlib', os.urandom(32)).decode(StringIO(encoded), StringIO())
+
+		# swapped frames don't decrypt either
+		first_length = struct.unpack('>I', encoded[:4])[0] + 4
+		second_length = struct.unpack('>I', encoded[first_length:first_length + 4])[0] + 4
+		swapped = encoded[first_length:first_length + second_length] + encoded[:first_length] + encoded[first_length + second_length:]
+
+		with self.assertRaises(CodecError):
+			ChunkCodec('zlib', key).decode(StringIO(swapped), StringIO())
+
+	@unittest.skipIf(zstandard is None, 'zstandard module is not installed')
+	def test_zstd(self):
+		self._round_trip(ChunkCodec('zstd'), self.DATA)
+
+	def test_encryption_key_file(self):
+		with tempfile.NamedTemporaryFile() as key_file:
+			key_file.write('ab' * 32 + '\n')
+			key_file.flush()
+
+			self.assertEqual(read_encryption_key(key_file.name), '\xab' * 32)
+
+			key_file.write('short')
+			key_file.flush()
+
+			with self.assertRaises(CodecError):
+				read_encryption_key(key_file.name)
+
+class TestMetrics(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock(1000)
+		self.metrics = Metrics(self.clock)
+
+	def test_report(self):
+		self.metrics.count('files_scanned', 10)
+		self.metrics.count('files_scanned')
+
+		for seconds in (1, 2):
+			with self.metrics.timed('scan'):
+				self.clock.now += seconds
+
+		self.metrics.observe_latency('upload_part', 0.07)
+		self.metrics.observe_latency('upload_part', 500)
+
+		report = self.metrics.report()
+		self.assertEqual(report['seconds'], 3)
+		self.assertEqual(report['counters'], {'files_scanned': 11})
+		self.assertEqual(report['phases'], {'scan': {'count': 2, 'seconds': 3}})
+
+		histogram = report['api_latency']['upload_part']
+		self.assertEqual((histogram['count'], histogram['seconds']), (2, 500.07))
+		self.assertEqual(histogram['buckets'][1], (0.1, 1))
+		self.assertEqual(histogram['buckets'][-1], ('+Inf', 1))
+
+		self.metrics.reset()
+		self.assertEqual(self.metrics.report()['counters'], {})
+
+	def test_prometheus(self):
+		self.metrics.count('bytes_uploaded', 100)
+		self.metrics.observe_latency('create_archive', 0.3)
+
+		lines = self.metrics.prometheus().splitlines()
+
+		self.assertIn('glacsync_bytes_uploaded_total 100', lines)
+		self.assertIn('glacsync_api_latency_seconds_bucket{call="create_archive",le="0.25"} 0', lines)
+		self.assertIn('glacsync_api_latency_seconds_bucket{call="create_archive",le="0.5"} 1', lines)
+		self.assertIn('glacsync_api_latency_seconds_bucket{call="create_archive",le="+Inf"} 1', lines)
+		self.assertIn('glacsync_api_latency_seconds_count{call="create_archive"} 1', lines)
+
+class TestInventoryParser(unittest.TestCase):
+	ARCHIVES = 20000
+	PATH = u'share/zażółć/%d.txt'
+
+	def setUp(self):
+		self.inventory_file = tempfile.TemporaryFile()
+
+		archives = [{
+			'ArchiveId': 'archive-%d' % i,
+			'ArchiveDescription': json.dumps({'path': self.PATH % i, 'last_modified': 1403644047, 'uploaded_at': 1403644047}),
+			'CreationDate': '2014-06-24T21:07:27Z',
+			'Size': i,
+			'SHA256TreeHash': '%064x' % i,
+		} for i in range(self.ARCHIVES)]
+		self.inventory = {'VaultARN': 'arn:aws:glacier:us-west-2:0:vaults/test', 'InventoryDate': '2014-06-25T00:00:00Z', 'ArchiveList': archives}
+
+		json.dump(self.inventory, self.inventory_file, indent=2)
+		self.inventory_file.seek(0)
+
+	def test_parse(self):
+		header = {}
+		parsed = list(iter_inventory_archives(self.inventory_file, chunk_size=777, header=header))
+
+		self.assertEqual(parsed, self.inventory['ArchiveList'])
+		self.assertEqual(header, {'VaultARN': 'arn:aws:glacier:us-west-2:0:vaults/test', 'InventoryDate': '2014-06-25T00:00:00Z'})
+
+	def test_empty_archive_list(self):
+		self.assertEqual(list(iter_inventory_archives(StringIO('{"VaultARN": "x", "ArchiveList": [ ]}'), chunk_size=3)), [])
+
+	def test_truncated(self):
+		truncated = StringIO(self.inventory_file.read()[:-1000])
+
+		with self.assertRaises(InventoryFormatError):
+			list(iter_inventory_archives(truncated))
+
+	def test_restore_streams_in_batches(self):
+		tempdir = tempfile.mkdtemp()
+		progress = []
+
+		try:
+			localdatabase = open_local_database(os.path.join(tempdir, 'catalogue.sqlite'))
+			localdatabase.restore_from_amazon(iter_inventory_archives(self.inventory_file), progress=progress.append, batch_size=3000)
+
+			self.assertEqual(progress, range(3000, self.ARCHIVES, 3000) + [self.ARCHIVES])
+			self.assertEqual(localdatabase.count_archive_members('archive-1234'), 1)
+			self.assertEqual([remote_file.path for remote_file in localdatabase.files][-1], self.PATH % (self.ARCHIVES - 1))
+		finally:
+			import shutil
+			shutil.rmtree(tempdir)
+
+class GlacierSyncTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tempdir = tempfile.mkdtemp()
+		self.sharedir = os.path.join(self.tempdir, 'share')
+		os.mkdir(self.sharedir)
+
+		self.vault = FakeVault(latency=0.01)
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.tempdir)
+
+	def _write(self, name, data):
+		path = os.path.join(self.sharedir, name)
+		with open(path, 'w') as share_file:
+			share_file.write(data)
+
+		return path
+
+	def _catalogue(self, glacier_sync):
+		return dict((remote_file.path, remote_file.uuid) for remote_file in glacier_sync._database.files)
+
+class TestGlacierSyncSync(GlacierSyncTestCase):
+	def _glacier_sync(self):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, vault=self.vault)
+
+	def test_sync(self):
+		paths = [self._write('%d.txt' % i, 'data %d' % i) for i in range(10)]
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		catalogue = self._catalogue(glacier_sync)
+		self.assertEqual(sorted(catalogue), sorted(paths))
+		self.assertEqual(sorted(self.vault.archives), sorted(catalogue.values()))
+		self.assertEqual(self.vault.archives[catalogue[paths[3]]][0], 'data 3')
+
+		# one removed, one modified
+		os.unlink(paths[0])
+		self._write('1.txt', 'new data')
+		os.utime(paths[1], (time.time() + 10, time.time() + 10))
+
+		self.assertEqual(glacier_sync.sync(), [])
+
+		catalogue = self._catalogue(glacier_sync)
+		self.assertEqual(sorted(catalogue), sorted(paths[1:]))
+		self.assertEqual(sorted(self.vault.archives), sorted(catalogue.values()))
+		self.assertEqual(self.vault.archives[catalogue[paths[1]]][0], 'new data')
+
+	def test_traffic_counted(self):
+		self._write('1.txt', 'x' * 100)
+		self._write('2.txt', 'y' * 50)
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual((glacier_sync._throttle.requests, glacier_sync._throttle.bytes_transferred), (2, 150))
+
+	def test_metrics_written(self):
+		self._write('1.txt', 'x' * 100)
+
+		glacier_sync = self._glacier_sync()
+		glacier_sync.metrics_file = os.path.join(self.tempdir, 'metrics.json')
+		glacier_sync.prometheus_file = os.path.join(self.tempdir, 'metrics.prom')
+		self.assertEqual(glacier_sync.sync(), [])
+
+		with open(glacier_sync.metrics_file) as metrics_file:
+			report = json.load(metrics_file)
+
+		self.assertEqual(report['counters']['files_scanned'], 1)
+		self.assertEqual(report['counters']['bytes_uploaded'], 100)
+		self.assertEqual(report['api_latency']['create_archive']['count'], 1)
+		self.assertTrue(set(['scan', 'catalogue_read', 'diff', 'transfer', 'sync']).issubset(report['phases']))
+
+		with open(glacier_sync.prometheus_file) as prometheus_file:
+			self.assertIn('glacsync_files_uploaded_total 1\n', prometheus_file.read())
+
+	def test_merge_inventory_older_than_sync(self):
+		path = self._write('a.txt', 'version 1')
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+		inventory = [{'ArchiveId': uuid, 'ArchiveDescription': description} for uuid, (data, description) in self.vault.archives.items()]
+		old_uuid, = self.vault.archives
+
+		# archive of version 1 is deleted after inventory was made
+		self._write('a.txt', 'version 2')
+		os.utime(path, (time.time() + 10, time.time() + 10))
+		self.assertEqual(glacier_sync.sync(), [])
+		catalogue = self._catalogue(glacier_sync)
+
+		reported = []
+		counts = glacier_sync._database.merge_from_amazon(inventory, {'InventoryDate': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')},
+			report=lambda kind, item: reported.append((kind, item['ArchiveId'])))
+
+		self.assertEqual((counts['added'], counts['kept']), (0, 1))
+		self.assertEqual(reported, [('orphaned', old_uuid)])
+		self.assertEqual(self._catalogue(glacier_sync), catalogue)
+		self.assertEqual(len(list(glacier_sync._database.files)), 1)
+
+	def test_unknown_transfer_engine(self):
+		with self.assertRaises(ValueError) as raised:
+			GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_engine='pooledd', vault=self.vault)
+
+		self.assertIn('layer2, pooled', str(raised.exception))
+
+	def test_restoredb(self):
+		paths = [self._write('%d.txt' % i, 'data %d' % i) for i in range(2)]
+		self.assertEqual(self._glacier_sync().sync(), [])
+
+		# catalogue lost, rebuilt from inventory
+		glacier_sync = GlacierSync(None, os.path.join(self.tempdir, 'restored.files'), False, [self.sharedir], vault=self.vault)
+		glacier_sync._remote_filesystem.engine = MeteredEngine(FakeEngine(self.vault))
+		METRICS.reset()
+
+		self.assertFalse(glacier_sync.restoredb())
+		self.assertFalse(glacier_sync.restoredb())
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restoredb())
+
+		self.assertEqual(sorted(self._catalogue(glacier_sync)), paths)
+		self.assertEqual(list(glacier_sync._database.pending_jobs), [])
+
+		# vault calls go through throttle and metrics
+		inventory_size = len(self.vault.inventories.values()[0])
+		self.assertEqual((glacier_sync._throttle.requests, glacier_sync._throttle.bytes_transferred), (4, inventory_size))
+		self.assertEqual(METRICS.report()['api_latency']['describe_job']['count'], 2)
+		self.assertEqual(METRICS.report()['api_latency']['open_job_output']['count'], 1)
+
+	def test_failed_upload_not_recorded(self):
+		good = self._write('good.txt', 'good')
+		bad = self._write('bad.txt', 'bad')
+		self.vault.failing_paths.add(bad)
+
+		glacier_sync = self._glacier_sync()
+		failed = glacier_sync.sync()
+
+		self.assertEqual([task.args[0].path for task in failed], [bad])
+		self.assertEqual(list(self._catalogue(glacier_sync)), [good])
+
+class TestGlacierSyncSyncPooled(TestGlacierSyncSync):
+	def _glacier_sync(self):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, transfer_engine='pooled', vault=self.vault)
+
+	def test_single_request_per_archive(self):
+		self._write('1.txt', 'data')
+
+		self.assertEqual(self._glacier_sync().sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['upload_archive'], 1)
+		self.assertEqual(self.vault.layer1.calls['initiate_multipart_upload'], 0)
+
+class TestGlacierSyncPacking(GlacierSyncTestCase):
+	def _glacier_sync(self):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, pack_files_below=100, vault=self.vault)
+
+	def _member_data(self, remote_file):
+		data, description = self.vault.archives[remote_file.uuid]
+
+		return data[remote_file.offset:remote_file.offset + remote_file.length]
+
+	def test_packing(self):
+		small = [self._write('small%d.txt' % i, 'small %d' % i) for i in range(3)]
+		big = self._write('big.txt', 'x' * 1000)
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		remote_files = dict((remote_file.path, remote_file) for remote_file in glacier_sync._database.files)
+		self.assertEqual(len(self.vault.archives), 2)
+		self.assertIsNone(remote_files[big].offset)
+		self.assertEqual(len(set(remote_files[path].uuid for path in small)), 1)
+
+		for i, path in enumerate(small):
+			self.assertEqual(self._member_data(remote_files[path]), 'small %d' % i)
+
+		pack_uuid = remote_files[small[0]].uuid
+		self.assertTrue(json.loads(self.vault.archives[pack_uuid][1])['pack'])
+
+		# modified member goes to new pack, old pack still holds two files
+		self._write('small0.txt', 'changed')
+		os.utime(small[0], (time.time() + 10, time.time() + 10))
+		os.unlink(small[1])
+		self.assertEqual(glacier_sync.sync(), [])
+
+		remote_files = dict((remote_file.path, remote_file) for remote_file in glacier_sync._database.files)
+		self.assertEqual(sorted(remote_files), sorted([small[0], small[2], big]))
+		self.assertIn(pack_uuid, self.vault.archives)
+		self.assertEqual(self._member_data(remote_files[small[0]]), 'changed')
+		self.assertEqual(self._member_data(remote_files[small[2]]), 'small 2')
+
+		# last file of the old pack gone, pack is deleted
+		os.unlink(small[2])
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertNotIn(pack_uuid, self.vault.archives)
+		self.assertEqual(len(self.vault.archives), 2)
+
+	def test_failed_pack_delete_keeps_last_member(self):
+		paths = [self._write('small%d.txt' % i, 'small %d' % i) for i in range(2)]
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+		pack_uuid, = self.vault.archives
+
+		for path in paths:
+			os.unlink(path)
+
+		# vault fails the delete
+		pack = self.vault.archives.pop(pack_uuid)
+		self.assertEqual(len(glacier_sync.sync()), 1)
+
+		# archive is still referred to, next sync tries again
+		self.assertEqual([remote_file.uuid for remote_file in glacier_sync._database.files], [pack_uuid])
+
+		self.vault.archives[pack_uuid] = pack
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.archives, {})
+		self.assertEqual(list(glacier_sync._database.files), [])
+
+	def test_packed_archive_skipped_on_restore(self):
+		localdatabase = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		localdatabase.restore_from_amazon([{'ArchiveId': 'pack', 'ArchiveDescription': '{"pack": true, "files": 3, "uploaded_at": 1403644047}'}])
+
+		self.assertEqual(list(localdatabase.files), [])
+
+class TestGlacierSyncDelayedDelete(GlacierSyncTestCase):
+	def _glacier_sync(self, **options):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), True, [self.sharedir], transfer_concurrency=4, vault=self.vault, **options)
+
+	def test_young_archives_queued(self):
+		paths = [self._write('%d.txt' % i, 'data %d' % i) for i in range(3)]
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+		old_uuids = self._catalogue(glacier_sync)
+
+		# one removed, one modified: old archives stay in vault, but not in catalogue
+		os.unlink(paths[0])
+		self._write('1.txt', 'new data')
+		os.utime(paths[1], (time.time() + 10, time.time() + 10))
+		self.assertEqual(glacier_sync.sync(), [])
+
+		catalogue = self._catalogue(glacier_sync)
+		self.assertEqual(sorted(catalogue), sorted(paths[1:]))
+		self.assertEqual(len(self.vault.archives), 4)
+		self.assertEqual(sorted(queued.uuid for queued in glacier_sync._database.due_deletes()), sorted([old_uuids[paths[0]], old_uuids[paths[1]]]))
+
+		# nothing due yet
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual(len(self.vault.archives), 4)
+
+		# later sync, once they are old enough
+		glacier_sync.min_storage_seconds = 0
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(sorted(self.vault.archives), sorted(catalogue.values()))
+		self.assertEqual(glacier_sync._database.count_queued_deletes(), 0)
+
+	def test_old_archives_deleted_at_once(self):
+		path = self._write('1.txt', 'data')
+
+		glacier_sync = self._glacier_sync(min_storage_days=0)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		os.unlink(path)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.archives, {})
+		self.assertEqual(glacier_sync._database.count_queued_deletes(), 0)
+
+	def test_packed_archive_queued_when_empty(self):
+		paths = [self._write('small%d.txt' % i, 'small %d' % i) for i in range(2)]
+
+		glacier_sync = self._glacier_sync(pack_files_below=100)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		os.unlink(paths[0])
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual(glacier_sync._database.count_queued_deletes(), 0)
+
+		os.unlink(paths[1])
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual(glacier_sync._database.count_queued_deletes(), 1)
+
+		glacier_sync.min_storage_seconds = 0
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual(self.vault.archives, {})
+
+class TestGlacierSyncDedup(GlacierSyncTestCase):
+	def _glacier_sync(self, **options):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, vault=self.vault,
+			dedup=True, dedup_min_size=1000, dedup_chunk_size=4096, **options)
+
+	def _stored_bytes(self):
+		return sum(len(data) for data, description in self.vault.archives.values())
+
+	def test_identical_files_stored_once(self):
+		data = os.urandom(100 * 1024)
+		self._write('1.img', data)
+		self._write('2.img', data)
+		self._write('small.txt', 'small')
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(len(self.vault.archives), 2)
+		self.assertEqual(self._stored_bytes(), len(data) + len('small'))
+
+		remote_files = dict((os.path.basename(remote_file.path), remote_file) for remote_file in glacier_sync._database.files)
+		self.assertEqual(remote_files['1.img'].chunks, remote_files['2.img'].chunks)
+		self.assertIsNone(remote_files['small.txt'].chunks)
+
+	def test_changed_file_sends_new_chunks(self):
+		data = os.urandom(200 * 1024)
+		path = self._write('1.img', data)
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+		first_archive = list(self.vault.archives)
+
+		self._write('1.img', data[:100 * 1024] + 'changed' + data[100 * 1024:])
+		os.utime(path, (time.time() + 10, time.time() + 10))
+		self.assertEqual(glacier_sync.sync(), [])
+
+		# old version shares most chunks with the new one, so its archive stays
+		self.assertEqual(len(self.vault.archives), 2)
+		self.assertIn(first_archive[0], self.vault.archives)
+		self.assertLess(self._stored_bytes(), len(data) + 50 * 1024)
+		self.assertEqual(len(list(glacier_sync._database.files)), 1)
+
+		os.unlink(path)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.archives, {})
+		self.assertEqual(list(glacier_sync._database.chunks), [])
+
+	def test_deleted_file_shares_chunks_with_new_one(self):
+		data = os.urandom(200 * 1024)
+		old_path = self._write('dump-1.img', data)
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+		first_archive = list(self.vault.archives)
+
+		# rotated dump: old one gone, new one is mostly the same
+		os.unlink(old_path)
+		new_data = data + os.urandom(50 * 1024)
+		new_path = self._write('dump-2.img', new_data)
+		self.vault.latency = 0.05
+		self.assertEqual(glacier_sync.sync(), [])
+		self.vault.latency = 0
+
+		self.assertGreaterEqual(METRICS.report()['counters']['bytes_deduplicated'], 150 * 1024)
+		self.assertIn(first_archive[0], self.vault.archives)
+
+		remote_file, = glacier_sync._database.files
+		self.assertEqual(remote_file.path, new_path)
+		self.assertEqual(len(glacier_sync._database.chunk_locations(remote_file.chunks)), len(set(remote_file.chunks)))
+
+		os.unlink(new_path)
+		self.assertFalse(glacier_sync.restore())
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restore())
+
+		with open(new_path) as restored_file:
+			self.assertEqual(restored_file.read(), new_data)
+
+	def test_failed_chunk_upload_fails_files_waiting_for_it(self):
+		data = os.urandom(100 * 1024)
+		paths = [self._write('1.img', data), self._write('2.img', data)]
+
+		glacier_sync = self._glacier_sync(scan_cache=os.path.join(self.tempdir, 'config.ini.scancache'))
+		remote_filesystem = glacier_sync._remote_filesystem
+		upload_chunks = remote_filesystem.upload_chunks
+
+		def failing_upload_chunks(local_file, chunks, codec=None):
+			raise IOError('upload failed')
+
+		# whichever file sends the chunks, the other one waits for them
+		remote_filesystem.upload_chunks = failing_upload_chunks
+		failed = glacier_sync.sync()
+
+		self.assertEqual(sorted(task.args[0].path for task in failed), paths)
+		self.assertEqual(list(glacier_sync._database.files), [])
+
+		# neither is taken for unchanged by scan cache
+		remote_filesystem.upload_chunks = upload_chunks
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(sorted(self._catalogue(glacier_sync)), paths)
+		self.assertEqual(len(self.vault.archives), 1)
+
+	def test_restore(self):
+		data = os.urandom(100 * 1024)
+		files = {
+			self._write('1.img', data): data,
+			self._write('2.img', data + 'tail'): data + 'tail',
+			self._write('log.txt', 'line\n' * 10000): 'line\n' * 10000,
+		}
+
+		glacier_sync = self._glacier_sync(compression='zlib')
+		self.assertEqual(glacier_sync.sync(), [])
+
+		for path in files:
+			os.unlink(path)
+
+		# chunk archive shared by files is retrieved once
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(len(self.vault.jobs), len(self.vault.archives))
+
+		self.vault.complete_jobs()
+		METRICS.reset()
+		self.assertTrue(glacier_sync.restore())
+		self.assertIn('transfer', METRICS.report()['phases'])
+
+		for path, data in files.items():
+			with open(path) as restored_file:
+				self.assertEqual(restored_file.read(), data)
+
+		self.assertEqual(sorted(os.listdir(self.sharedir)), ['1.img', '2.img', 'log.txt'])
+		self.assertFalse(os.path.exists(glacier_sync._chunk_cache))
+
+	def test_chunk_archive_skipped_on_restore(self):
+		localdatabase = GlacierLocalDatabaseFile(os.path.join(self.tempdir, 'config.ini.files'))
+		localdatabase.restore_from_amazon([{'ArchiveId': 'chunks', 'ArchiveDescription': '{"chunks": 3, "uploaded_at": 1403644047}'}])
+
+		self.assertEqual(list(localdatabase.files), [])
+
+class TestGlacierSyncVersions(GlacierSyncTestCase):
+	def _glacier_sync(self, **options):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, vault=self.vault,
+			keep_versions_days=30, **options)
+
+	def _change(self, path, data, seconds):
+		self._write(os.path.basename(path), data)
+		os.utime(path, (time.time() + seconds, time.time() + seconds))
+
+	def test_restore_snapshot(self):
+		changed = self._write('changed.txt', 'version 1')
+		deleted = self._write('deleted.txt', 'deleted later')
+
+		glacier_sync = self._glacier_sync(pack_files_below=10)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self._change(changed, 'version 2', 10)
+		os.unlink(deleted)
+		added = self._write('added.txt', 'added later')
+		self.assertEqual(glacier_sync.sync(), [])
+
+		# old versions stay in vault for snapshot 1
+		self.assertEqual([snapshot_id for snapshot_id, taken_at in glacier_sync.snapshots], [1, 2])
+		self.assertEqual(len(self.vault.archives), 4)
+		self.assertEqual(glacier_sync.snapshot_at(glacier_sync.snapshots[-1][1]), 2)
+
+		self.assertFalse(glacier_sync.restore(snapshot=1))
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restore(snapshot=1))
+
+		for path, data in ((changed, 'version 1'), (deleted, 'deleted later'), (added, 'added later')):
+			with open(path) as restored_file:
+				self.assertEqual(restored_file.read(), data)
+
+		with self.assertRaises(ValueError):
+			glacier_sync.restore(snapshot=5)
+
+	def test_expired_versions_deleted(self):
+		path = self._write('1.txt', 'version 1')
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self._change(path, 'version 2', 10)
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual(len(self.vault.archives), 2)
+
+		# snapshots older than keep_versions_days go, and so do versions only they needed
+		for snapshot in glacier_sync._database._filedata['snapshots']:
+			snapshot[1] -= 31 * 24 * 3600
+
+		self.assertEqual(glacier_sync.sync(), [])
+		self.assertEqual([snapshot_id for snapshot_id, taken_at in glacier_sync.snapshots], [3])
+		self.assertEqual(sorted(self.vault.archives), sorted(self._catalogue(glacier_sync).values()))
+		self.assertEqual(list(glacier_sync._database.versions), [])
+
+class TestSyncDaemon(GlacierSyncTestCase):
+	def setUp(self):
+		super(TestSyncDaemon, self).setUp()
+		self.clock = FakeClock(1000)
+		self.daemon = SyncDaemon(4, self.clock)
+
+		self.vaults = {}
+		for name in ('a', 'b'):
+			os.mkdir(os.path.join(self.sharedir, name))
+			self.vaults[name] = FakeVault()
+			self.daemon.add(name, GlacierSync(None, os.path.join(self.tempdir, '%s.files' % name), False, [os.path.join(self.sharedir, name)], vault=self.vaults[name]), 60, 30)
+
+	def tearDown(self):
+		self.daemon.scheduler.close()
+		self.daemon.close()
+		super(TestSyncDaemon, self).tearDown()
+
+	def test_syncs_on_interval(self):
+		self._write('a/1.txt', 'data')
+		self._write('b/1.txt', 'data')
+
+		self.assertEqual(self.daemon.run_due(), 30)
+		self.assertEqual([len(self.vaults[name].archives) for name in 'ab'], [1, 1])
+
+		self._write('a/2.txt', 'data')
+		self.clock.now += 30
+		self.assertEqual(self.daemon.run_due(), 30) # only polls were due
+		self.assertEqual(len(self.vaults['a'].archives), 1)
+
+		self.clock.now += 30
+		self.daemon.run_due()
+		self.assertEqual(len(self.vaults['a'].archives), 2)
+
+	def test_failure_doesnt_stop_others(self):
+		self._write('b/1.txt', 'data')
+
+		def failing_sync(plan=None, scheduler=None):
+			raise IOError('share is gone')
+
+		self.daemon._scheduled[0].glacier_sync.sync = failing_sync
+
+		stderr, sys.stderr = sys.stderr, StringIO()
+		try:
+			self.daemon.run_due()
+			errors = sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+
+		self.assertEqual(errors, 'sync of a failed: share is gone\n')
+		self.assertEqual(len(self.vaults['b'].archives), 1)
+
+	def test_sync_skipped_while_restoring(self):
+		path = self._write('a/1.txt', 'data')
+		self.daemon.run_due()
+
+		os.unlink(path)
+		glacier_sync = self.daemon._scheduled[0].glacier_sync
+		glacier_sync.restore()
+		self.assertTrue(glacier_sync.restoring())
+
+		self.clock.now += 60
+		stderr, sys.stderr = sys.stderr, StringIO()
+		try:
+			self.daemon.run_due()
+			errors = sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+
+		self.assertEqual(errors, 'sync of a skipped: restore is waiting for archives\n')
+		self.assertEqual(len(self.vaults['a'].archives), 1)
+		self.assertEqual(len(list(glacier_sync._database.files)), 1)
+
+	def test_catalogue_saved_after_sync(self):
+		os.mkdir(os.path.join(self.sharedir, 'c'))
+		self.daemon.add('c', GlacierSync(None, os.path.join(self.tempdir, 'c.sqlite'), False, [os.path.join(self.sharedir, 'c')], vault=FakeVault()), 60, 30)
+
+		for i in range(20):
+			self._write('c/%d.txt' % i, 'data')
+
+		for i in range(3):
+			self.daemon.run_due()
+			self.clock.now += 30
+
+		# GlacierSync stays open, other connections still see what it uploaded
+		connection = sqlite3.connect(os.path.join(self.tempdir, 'c.sqlite'))
+		try:
+			self.assertEqual(connection.execute('SELECT COUNT(*) FROM files').fetchone()[0], 20)
+		finally:
+			connection.close()
+
+	def test_scan_cache_between_syncs(self):
+		os.makedirs(os.path.join(self.sharedir, 'c', 'sub'))
+		gone = self._write('c/sub/gone', 'data')
+		self._write('c/kept', 'data')
+
+		glacier_sync = GlacierSync(None, os.path.join(self.tempdir, 'c.files'), False, [os.path.join(self.sharedir, 'c')], vault=FakeVault(),
+			scan_cache=os.path.join(self.tempdir, 'c.scancache'))
+		self.daemon.add('c', glacier_sync, 60, 30)
+
+		local_filesystem = glacier_sync._local_filesystem
+		list_directory = local_filesystem._list_directory
+		listed = []
+
+		def counting_list_directory(root, directory):
+			listed.append(os.path.relpath(directory, self.sharedir))
+			return list_directory(root, directory)
+
+		local_filesystem._list_directory = counting_list_directory
+
+		self.daemon.run_due()
+		self.assertEqual(sorted(listed), ['c', 'c/sub'])
+
+		# same GlacierSync again: only the changed directory is listed, removed file is forgotten
+		os.unlink(gone)
+		del listed[:]
+		self.clock.now += 60
+		self.daemon.run_due()
+
+		self.assertEqual(listed, ['c/sub'])
+		self.assertEqual(sorted(glacier_sync._scan_cache._previous['files']), [os.path.join(self.sharedir, 'c', 'kept')])
+
+	def test_poll_doesnt_start_jobs(self):
+		self.daemon.run_due()
+
+		self.assertEqual(self.vaults['a'].jobs, {})
+		self.assertEqual(list(self.daemon._scheduled[0].glacier_sync._database.pending_jobs), [])
+
+class TestGlacierSyncMultipart(GlacierSyncTestCase):
+	DATA = 'a' * MEGABYTE + 'b' * MEGABYTE + 'c' * 100
+
+	def _glacier_sync(self, **kwargs):
+		glacier_sync = GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, multipart_threshold=MEGABYTE, vault=self.vault, **kwargs)
+		glacier_sync._remote_filesystem.min_part_size = MEGABYTE
+
+		return glacier_sync
+
+	def _uploads(self, glacier_sync):
+		return [job for job in glacier_sync._database.pending_jobs if isinstance(job, MultipartUploadJob)]
+
+	def test_upload(self):
+		path = self._write('big.bin', self.DATA)
+		self._write('small.txt', 'small')
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		remote_files = dict((remote_file.path, remote_file) for remote_file in glacier_sync._database.files)
+		self.assertEqual(self.vault.archives[remote_files[path].uuid][0], self.DATA)
+		self.assertEqual(remote_files[path].tree_hash, tree_hash_file(path))
+		self.assertEqual(self.vault.layer1.calls['upload_part'], 3)
+		self.assertEqual(self._uploads(glacier_sync), [])
+
+	def test_resume(self):
+		path = self._write('big.bin', self.DATA)
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(len(glacier_sync.sync()), 1)
+		self.assertEqual(self._catalogue(glacier_sync), {})
+		self.assertEqual([job.missing_parts for job in self._uploads(glacier_sync)], [[1]])
+		glacier_sync.close()
+
+		self.vault.layer1.failing_part_starts.clear()
+		self.vault.layer1.calls['upload_part'] = 0
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['upload_part'], 1)
+		self.assertEqual(self.vault.layer1.calls['initiate_multipart_upload'], 1)
+		self.assertEqual(self.vault.archives[self._catalogue(glacier_sync)[path]][0], self.DATA)
+		self.assertEqual(self._uploads(glacier_sync), [])
+
+	def test_changed_file_starts_over(self):
+		path = self._write('big.bin', self.DATA)
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync()
+		glacier_sync.sync()
+
+		self.vault.layer1.failing_part_starts.clear()
+		self._write('big.bin', self.DATA + 'more')
+		os.utime(path, (time.time() + 10, time.time() + 10))
+
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['abort_multipart_upload'], 1)
+		self.assertEqual(self.vault.layer1.uploads, {})
+		self.assertEqual(self.vault.archives[self._catalogue(glacier_sync)[path]][0], self.DATA + 'more')
+
+	def test_rewrite_within_same_second_starts_over(self):
+		path = self._write('big.bin', self.DATA)
+		second = int(time.time()) + 10
+		os.utime(path, (second + 0.1, second + 0.1))
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync()
+		glacier_sync.sync()
+
+		# same size and whole second, parts of old content must not be mixed in
+		self.vault.layer1.failing_part_starts.clear()
+		new_data = self.DATA.replace('a', 'x')
+		self._write('big.bin', new_data)
+		os.utime(path, (second + 0.6, second + 0.6))
+
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['abort_multipart_upload'], 1)
+		self.assertEqual(self.vault.archives[self._catalogue(glacier_sync)[path]][0], new_data)
+
+	def _decoded(self, uuid, codec):
+		decoded = StringIO()
+		ChunkCodec.from_name(codec, '\x01' * 32).decode(StringIO(self.vault.archives[uuid][0]), decoded)
+
+		return decoded.getvalue()
+
+	def test_encoded_upload_resumes(self):
+		data = os.urandom(2 * MEGABYTE + 100) # stored as it is, so it takes three parts
+		self._write('big.bin', data)
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync(compression='zlib')
+		self.assertEqual(len(glacier_sync.sync()), 1)
+		self.assertEqual([(job.codec, sorted(job.parts)) for job in self._uploads(glacier_sync)], [('zlib', ['0'])])
+		self.assertEqual(self.vault.layer1.calls['upload_part'], 2)
+		glacier_sync.close()
+
+		self.vault.layer1.failing_part_starts.clear()
+		self.vault.layer1.calls['upload_part'] = 0
+
+		glacier_sync = self._glacier_sync(compression='zlib')
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['upload_part'], 2)
+		self.assertEqual(self.vault.layer1.calls['initiate_multipart_upload'], 1)
+		self.assertEqual(self._uploads(glacier_sync), [])
+
+		remote_file = list(glacier_sync._database.files)[0]
+		self.assertEqual((remote_file.codec, remote_file.archive_size), ('zlib', len(self.vault.archives[remote_file.uuid][0])))
+		self.assertEqual(self._decoded(remote_file.uuid, 'zlib'), data)
+
+	@unittest.skipIf(AESGCM is None, 'cryptography module is not installed')
+	def test_encrypted_upload_starts_over(self):
+		data = os.urandom(2 * MEGABYTE + 100)
+		path = self._write('big.bin', data)
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync(encryption_key='\x01' * 32)
+		self.assertEqual(len(glacier_sync.sync()), 1)
+
+		# parts sent are encrypted under nonces which won't come again
+		self.vault.layer1.failing_part_starts.clear()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.calls['abort_multipart_upload'], 1)
+		self.assertEqual(self.vault.layer1.uploads, {})
+		self.assertEqual(self._decoded(self._catalogue(glacier_sync)[path], 'aes-gcm'), data)
+
+	def test_deleted_file_upload_aborted(self):
+		path = self._write('big.bin', self.DATA)
+		self.vault.layer1.failing_part_starts.add(MEGABYTE)
+
+		glacier_sync = self._glacier_sync()
+		glacier_sync.sync()
+
+		os.unlink(path)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		self.assertEqual(self.vault.layer1.uploads, {})
+		self.assertEqual(self._uploads(glacier_sync), [])
+
+	def test_throttled_upload_sent_in_parts(self):
+		path = self._write('big.bin', self.DATA)
+		transfers = []
+
+		class RecordingThrottle(Throttle):
+			def transfer(self, size):
+				transfers.append(size)
+				super(RecordingThrottle, self).transfer(size)
+
+		clock = FakeClock()
+		throttle = RecordingThrottle(MEGABYTE, clock=clock, sleep=clock.sleep)
+
+		for engine in (Layer2Engine, PooledEngine):
+			remote_filesystem = RemoteFilesystem(None, engine(self.vault), throttle=throttle)
+			uuid = remote_filesystem.upload_archive(LocalFile(path))
+
+			self.assertEqual(self.vault.archives[uuid][0], self.DATA)
+
+		# paid for as parts go, not all before the first byte
+		self.assertEqual(transfers, [MEGABYTE, MEGABYTE, 100] * 2)
+		self.assertEqual(self.vault.layer1.calls['upload_part'], 6)
+		self.assertEqual(self.vault.layer1.uploads, {})
+
+	def test_part_size(self):
+		self.assertEqual(multipart_part_size(MEGABYTE), MULTIPART_MIN_PART_SIZE)
+		self.assertEqual(multipart_part_size(50 * 1024 * MEGABYTE), MULTIPART_MIN_PART_SIZE)
+		self.assertEqual(multipart_part_size(200 * 1024 * MEGABYTE), 32 * MEGABYTE)
+
+class TestGlacierSyncPlan(GlacierSyncTestCase):
+	def _glacier_sync(self, **options):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, transfer_engine='pooled', vault=self.vault, **options)
+
+	def _changed_share(self):
+		paths = [self._write('%d.txt' % i, 'data %d' % i) for i in range(3)]
+
+		glacier_sync = self._glacier_sync()
+		self.assertEqual(glacier_sync.sync(), [])
+
+		os.unlink(paths[0])
+		self._write('1.txt', 'new data')
+		os.utime(paths[1], (time.time() + 10, time.time() + 10))
+		new = self._write('new.txt', 'x' * 100)
+
+		return glacier_sync, paths, new
+
+	def test_plan(self):
+		glacier_sync, paths, new = self._changed_share()
+		archives = dict(self.vault.archives)
+
+		output = StringIO()
+		summary = glacier_sync.plan(output)
+
+		records = [json.loads(line) for line in output.getvalue().splitlines()]
+		by_path = dict((record.get('path'), record) for record in records)
+
+		self.assertEqual(self.vault.archives, archives) # nothing transferred
+		self.assertEqual(records[-1], summary)
+		self.assertEqual((summary['uploads'], summary['updates'], summary['deletes'], summary['bytes'], summary['requests']), (1, 1, 1, 108, 4))
+
+		self.assertEqual(by_path[new]['action'], 'upload')
+		self.assertEqual((by_path[new]['size'], by_path[new]['requests']), (100, 1))
+		self.assertEqual(by_path[paths[1]]['action'], 'update')
+		self.assertEqual(by_path[paths[1]]['requests'], 2) # upload and delete of old version
+		self.assertEqual(by_path[paths[0]]['action'], 'delete')
+		self.assertEqual(by_path[paths[0]]['seconds'], 1.0 / PLAN_REQUESTS_PER_SECOND)
+
+	def test_sync_executes_plan_without_scanning(self):
+		glacier_sync, paths, new = self._changed_share()
+
+		output = StringIO()
+		glacier_sync.plan(output)
+
+		glacier_sync._local_filesystem = None
+		self.assertEqual(glacier_sync.sync(output.getvalue().splitlines()), [])
+
+		catalogue = self._catalogue(glacier_sync)
+		self.assertEqual(sorted(catalogue), sorted([paths[1], paths[2], new]))
+		self.assertEqual(sorted(self.vault.archives), sorted(catalogue.values()))
+		self.assertEqual(self.vault.archives[catalogue[paths[1]]][0], 'new data')
+
+	def test_plan_executed_twice(self):
+		glacier_sync, paths, new = self._changed_share()
+
+		output = StringIO()
+		glacier_sync.plan(output)
+		plan = output.getvalue().splitlines()
+
+		glacier_sync._local_filesystem = None
+		self.assertEqual(glacier_sync.sync(plan), [])
+		catalogue = self._catalogue(glacier_sync)
+		archives = dict(self.vault.archives)
+
+		# grown since plan was made, is sent whole
+		self._write('new.txt', 'x' * 200)
+
+		METRICS.reset()
+		self.assertEqual(glacier_sync.sync(plan), [])
+
+		self.assertEqual(METRICS.report()['counters']['plan_entries_skipped'], 3)
+		self.assertEqual(self._catalogue(glacier_sync), catalogue)
+		self.assertEqual(self.vault.archives, archives)
+
+	def test_plan_uploads_current_size(self):
+		glacier_sync = self._glacier_sync(pack_files_below=1000)
+		path = self._write('small.txt', 'x' * 100)
+
+		output = StringIO()
+		glacier_sync.plan(output)
+		self._write('small.txt', 'x' * 300)
+
+		self.assertEqual(glacier_sync.sync(output.getvalue().splitlines()), [])
+
+		remote_file, = glacier_sync._database.files
+		self.assertEqual((remote_file.path, remote_file.size), (path, 300))
+
+	def test_packed_requests_in_summary(self):
+		glacier_sync = self._glacier_sync(pack_files_below=100, pack_size=1000)
+
+		for i in range(30):
+			self._write('%d.txt' % i, 'x' * 50)
+
+		summary = glacier_sync.plan(StringIO())
+
+		self.assertEqual((summary['uploads'], summary['bytes'], summary['requests']), (30, 1500, 2))
+
+class TestGlacierSyncRestore(GlacierSyncTestCase):
+	def _glacier_sync(self, **options):
+		return GlacierSync(None, os.path.join(self.tempdir, 'config.ini.files'), False, [self.sharedir], transfer_concurrency=4, pack_files_below=100, vault=self.vault, **options)
+
+	def _synced(self, **options):
+		files = {
+			self._write('small0.txt', 'small 0'): 'small 0',
+			self._write('small1.txt', 'small 1'): 'small 1',
+			self._write('big.txt', 'x' * 1000): 'x' * 1000,
+		}
+		mtime = int(os.stat(next(iter(files))).st_mtime)
+
+		glacier_sync = self._glacier_sync(**options)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		for path in files:
+			os.unlink(path)
+
+		return glacier_sync, files, mtime
+
+	def test_restore(self):
+		glacier_sync, files, mtime = self._synced(content_hash=True)
+
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(self.vault.layer1.calls['initiate_job'], 3)
+		ranges = [job['RetrievalByteRange'] for job in self.vault.jobs.values()]
+		self.assertEqual(ranges.count(None), 1)
+
+		# jobs still running, nothing requested twice
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(self.vault.layer1.calls['initiate_job'], 3)
+
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restore())
+
+		for path, data in files.items():
+			with open(path) as restored_file:
+				self.assertEqual(restored_file.read(), data)
+			self.assertEqual(int(os.stat(path).st_mtime), mtime)
+
+		self.assertEqual(sorted(os.listdir(self.sharedir)), ['big.txt', 'small0.txt', 'small1.txt'])
+		self.assertEqual(list(glacier_sync._database.pending_jobs), [])
+
+	def test_restore_compressed(self):
+		compressible = self._write('log.txt', 'line\n' * 10000)
+		self._write('photo.jpg', 'jpeg data' * 100)
+
+		glacier_sync = self._glacier_sync(compression='zlib', content_hash=True)
+		self.assertEqual(glacier_sync.sync(), [])
+
+		remote_files = dict((os.path.basename(remote_file.path), remote_file) for remote_file in glacier_sync._database.files)
+		self.assertEqual((remote_files['log.txt'].codec, remote_files['log.txt'].size), ('zlib', 50000))
+		self.assertLess(len(self.vault.archives[remote_files['log.txt'].uuid][0]), 1000)
+		self.assertEqual(remote_files['log.txt'].archive_size, len(self.vault.archives[remote_files['log.txt'].uuid][0]))
+		self.assertIsNone(remote_files['photo.jpg'].codec)
+
+		# inventory brings codec and original size back
+		description = json.loads(self.vault.archives[remote_files['log.txt'].uuid][1])
+		self.assertEqual((description['codec'], description['size']), ('zlib', 50000))
+
+		os.unlink(compressible)
+		glacier_sync.restore()
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restore())
+
+		with open(compressible) as restored_file:
+			self.assertEqual(restored_file.read(), 'line\n' * 10000)
+		self.assertEqual(sorted(os.listdir(self.sharedir)), ['log.txt', 'photo.jpg'])
+
+	def test_restore_with_cpu_pool(self):
+		glacier_sync, files, mtime = self._synced(content_hash=True, compression='zlib', cpu_processes=2)
+
+		try:
+			glacier_sync.restore()
+			self.vault.complete_jobs()
+			self.assertTrue(glacier_sync.restore())
+
+			for path, data in files.items():
+				with open(path) as restored_file:
+					self.assertEqual(restored_file.read(), data)
+		finally:
+			glacier_sync.close()
+
+	def test_batch_size(self):
+		glacier_sync, files, mtime = self._synced(restore_batch_size=2)
+
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(len(self.vault.jobs), 2)
+
+		# batch is full, third file waits for its turn
+		glacier_sync.print_status = True
+		stdout, sys.stdout = sys.stdout, StringIO()
+		try:
+			self.assertFalse(glacier_sync.restore())
+			output = sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+		glacier_sync.print_status = False
+
+		self.assertIn('Files waiting for Glacier: 2, not requested yet: 1, failed: 0.', output)
+		self.assertEqual(len(self.vault.jobs), 2)
+
+		self.vault.complete_jobs()
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(len(self.vault.jobs), 3)
+
+		self.vault.complete_jobs()
+		self.assertTrue(glacier_sync.restore())
+		self.assertEqual(sorted(os.listdir(self.sharedir)), ['big.txt', 'small0.txt', 'small1.txt'])
+
+	def test_expired_job_requested_again(self):
+		glacier_sync, files, mtime = self._synced()
+
+		glacier_sync.restore()
+		self.vault.jobs.clear()
+
+		self.assertFalse(glacier_sync.restore())
+		self.assertEqual(len(self.vault.jobs), 3)
+
+	def test_corrupted_download(self):
+		glacier_sync, files, mtime = self._synced()
+
+		glacier_sync.restore()
+		self.vault.complete_jobs()
+		self.vault.corrupt_outputs = True
+
+		self.assertFalse(glacier_sync.restore())
+		self.assertFalse(any(os.path.exists(path) for path in files))
+		self.assertEqual(len(list(glacier_sync._database.pending_jobs)), 3)
+
+		self.vault.corrupt_outputs = False
+		self.assertTrue(glacier_sync.restore())
+
+	def test_download_resumes(self):
+		self.vault.archives['archive'] = ('a' * MEGABYTE + 'b' * MEGABYTE + 'c', None)
+		job_id = self.vault.layer1.initiate_job(self.vault.name, {'Type': 'archive-retrieval', 'ArchiveId': 'archive'})['JobId']
+		self.vault.complete_jobs()
+
+		path = os.path.join(self.sharedir, 'restored')
+		job = RetreiveArchiveJob({'uuid': job_id, 'archive_id': 'archive', 'path': path, 'range_start': 0, 'offset': None,
+			'length': None, 'tree_hash': None, 'last_modified': 1403644047})
+
+		# first chunk made it before interruption, second one only partially
+		with open(path + PART_SUFFIX, 'wb') as part_file:
+			part_file.write('a' * MEGABYTE + 'b' * 10)
+
+		remote_filesystem = RemoteFilesystem(None, Layer2Engine(self.vault))
+		remote_filesystem.download_job(job, self.vault.layer1.list_jobs(self.vault.name)['JobList'][0], chunk_size=MEGABYTE)
+
+		self.assertEqual(self.vault.layer1.calls['get_job_output'], 2)
+		with open(path) as restored_file:
+			self.assertEqual(restored_file.read(), 'a' * MEGABYTE + 'b' * MEGABYTE + 'c')
+		self.assertFalse(os.path.exists(path + PART_SUFFIX))
+
+	def test_megabyte_aligned_range(self):
+		self.assertEqual(megabyte_aligned_range(512, 100, 10000), (0, 9999))
+		self.assertEqual(megabyte_aligned_range(MEGABYTE + 10, MEGABYTE, 5 * MEGABYTE), (MEGABYTE, 3 * MEGABYTE - 1))
+		self.assertEqual(megabyte_aligned_range(MEGABYTE, MEGABYTE, 5 * MEGABYTE), (MEGABYTE, 2 * MEGABYTE - 1))
 
-		
 if __name__ == '__main__':
 	unittest.main()
\ No newline at end of file